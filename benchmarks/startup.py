@@ -0,0 +1,52 @@
+""" Benchmark of the time to open a scan split into many files.
+
+Links a ScanImage tiff file num_files times into a temporary directory (as if the scan
+had been split into that many files) and times read_scan(...) and read_scan(...).shape.
+
+Run as:
+    python benchmarks/startup.py data/scan_5_1_001.tif --num-files 200
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import scanreader
+
+
+def time_startup(filename, num_files=200, repeats=5):
+    """ Time read_scan and the first call to shape of a scan with num_files files.
+
+    Returns:
+        A dictionary with the median time (in seconds) of each step over repeats.
+    """
+    times = {'read_scan': [], 'shape': []}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i in range(num_files):
+            os.symlink(os.path.abspath(filename),
+                       os.path.join(tmp_dir, 'scan_{:05d}.tif'.format(i + 1)))
+
+        for _ in range(repeats):
+            start = time.perf_counter()
+            scan = scanreader.read_scan(os.path.join(tmp_dir, '*.tif'))
+            times['read_scan'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            shape = scan.shape
+            times['shape'].append(time.perf_counter() - start)
+
+    results = {'{}_seconds'.format(step): sorted(step_times)[len(step_times) // 2] for
+               step, step_times in times.items()}
+    results.update({'num_files': num_files, 'scan_shape': list(shape)})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('filename', help='ScanImage tiff file')
+    parser.add_argument('--num-files', type=int, default=200)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    print(json.dumps(time_startup(args.filename, args.num_files, args.repeats), indent=2))
@@ -0,0 +1,148 @@
+""" Benchmarks of the read path on synthetic ScanImage scans.
+
+Writes synthetic scans (see scanreader.synthetic) into a temporary directory and times
+opening them, indexing their pages, reading the whole scan, a single field and random
+frames, iterating over fields and exporting them. Prints (or saves) the results as JSON
+so runs can be compared to catch regressions. Files are read right after being written
+so these are warm cache timings.
+
+Run as:
+    python benchmarks/suite.py --num-frames 1000 --output results.json
+    python benchmarks/suite.py --scans multiroi --benchmarks read_all read_field
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+import scanreader
+from scanreader import synthetic
+
+SCANS = {
+    'plain': {'version': '2016b', 'num_channels': 2, 'depths': [0, 50, 100],
+              'height': 256, 'width': 256},
+    'multiroi': {'version': '2018b', 'num_channels': 2, 'depths': [0, 100],
+                 'rois': [{'height': 240, 'width': 120}, {'height': 240, 'width': 120},
+                          {'height': 120, 'width': 120, 'depths': [100]}]},
+    'slow_stack': {'version': '5.1', 'num_channels': 2, 'depths': list(range(10)),
+                   'height': 256, 'width': 256, 'slow_stack': True},
+}
+
+
+def _open(pathname, tmp_dir):
+    return scanreader.read_scan(pathname)
+
+
+def _num_pages(pathname, tmp_dir):
+    return scanreader.read_scan(pathname)._num_pages
+
+
+def _read_all(pathname, tmp_dir):
+    scan = scanreader.read_scan(pathname)
+    return scan[:] if not scan.is_multiROI else [field for field in scan]
+
+
+def _read_field(pathname, tmp_dir):
+    return scanreader.read_scan(pathname)[0]
+
+
+def _random_frames(pathname, tmp_dir, num_reads=100):
+    scan = scanreader.read_scan(pathname)
+    frames = np.random.default_rng(0).integers(scan.num_frames, size=num_reads)
+    return [scan[0, :, :, :, frame] for frame in frames]
+
+
+def _iterate(pathname, tmp_dir):
+    return sum(field.shape[-1] for field in scanreader.read_scan(pathname))
+
+
+def _to_binary(pathname, tmp_dir):
+    scanreader.read_scan(pathname).to_binary(os.path.join(tmp_dir, 'binary'))
+
+
+def _to_zarr(pathname, tmp_dir):
+    scanreader.read_scan(pathname).to_zarr(os.path.join(tmp_dir, 'scan.zarr'))
+
+
+def _to_hdf5(pathname, tmp_dir):
+    scanreader.read_scan(pathname).to_hdf5(os.path.join(tmp_dir, 'scan.h5'))
+
+
+BENCHMARKS = {'open': _open, 'num_pages': _num_pages, 'read_all': _read_all,
+              'read_field': _read_field, 'random_frames': _random_frames,
+              'iterate': _iterate, 'to_binary': _to_binary, 'to_zarr': _to_zarr,
+              'to_hdf5': _to_hdf5}
+
+
+def run(scans=SCANS, benchmarks=BENCHMARKS, num_frames=100, num_files=1, repeats=5):
+    """ Time each benchmark on each synthetic scan.
+
+    Args:
+        scans: Dictionary. Name to arguments for synthetic.write_scan.
+        benchmarks: Dictionary. Name to function called with the pathname of the scan
+            and a temporary directory for its output.
+        num_frames: Integer. Number of frames of each scan.
+        num_files: Integer. Number of files each scan is split into.
+        repeats: Integer. Number of times each benchmark is run.
+
+    Returns:
+        A dictionary with the environment and a list of results (median and minimum time
+            in seconds of each benchmark on each scan).
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scan_name, scan_args in scans.items():
+            prefix = os.path.join(tmp_dir, scan_name)
+            filenames = synthetic.write_scan(prefix, num_frames=num_frames,
+                                             num_files=num_files, **scan_args)
+            pathname = prefix + '_*.tif'
+            scan_nbytes = sum(os.path.getsize(filename) for filename in filenames)
+
+            for benchmark_name, benchmark in benchmarks.items():
+                times = []
+                for _ in range(repeats):
+                    with tempfile.TemporaryDirectory(dir=tmp_dir) as output_dir:
+                        try:
+                            start = time.perf_counter()
+                            benchmark(pathname, output_dir)
+                            times.append(time.perf_counter() - start)
+                        except ImportError as error: # optional dependency missing
+                            times = None
+                            skip_reason = str(error)
+                            break
+                result = {'scan': scan_name, 'benchmark': benchmark_name,
+                          'file_nbytes': scan_nbytes}
+                if times is None:
+                    result['skipped'] = skip_reason
+                else:
+                    result.update({'median_seconds': float(np.median(times)),
+                                   'min_seconds': min(times), 'repeats': repeats})
+                results.append(result)
+
+    environment = {'python': platform.python_version(), 'numpy': np.__version__,
+                   'platform': platform.platform(), 'num_frames': num_frames,
+                   'num_files': num_files}
+    return {'environment': environment, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scans', nargs='+', choices=list(SCANS), default=list(SCANS))
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS),
+                        default=list(BENCHMARKS))
+    parser.add_argument('--num-frames', type=int, default=100)
+    parser.add_argument('--num-files', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', help='JSON file to save the results to')
+    args = parser.parse_args()
+
+    report = run({name: SCANS[name] for name in args.scans},
+                 {name: BENCHMARKS[name] for name in args.benchmarks}, args.num_frames,
+                 args.num_files, args.repeats)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
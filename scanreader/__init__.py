@@ -1 +1,6 @@
-from .core import read_scan
\ No newline at end of file
+from .core import read_scan
+from .concat import concatenate
+from .pyramid import Pyramid
+from .progress import CancelToken
+from .sampling import CropSampler
+from .catalog import Catalog
@@ -0,0 +1,258 @@
+"""
+Non-blocking reads for asyncio applications (e.g., a web service serving frames).
+
+await scan.aread(key) is scan[key] and 'async for frames, blocks in scan.aiter_chunks()'
+streams the scan in chunks of frames (as follow() does for live scans). Reads run in a
+pool of I/O threads owned by the scan (an AsyncReader) so they never block the event
+loop.
+
+Requests for the same region (field, y, x and channel indices) made while others are
+waiting to be read are merged: all requests made in the same iteration of the event loop
+(or within AsyncReader.merge_delay seconds) become a single read of the union of their
+frames, and requests for frames that are already being read wait for that read rather
+than reading them again. Every request still receives its own copy of scan[key].
+
+Cancelling a request (e.g., the client went away) stops its read as soon as no other
+request is waiting for it: the read stops with ReadCancelled before its next file or
+batch of pages (see progress.py).
+"""
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import numpy as np
+from . import parallel
+from . import utils
+from .exceptions import ReadCancelled
+from .progress import CancelToken, Progress, tracking
+
+
+def _read(token, func, *args):
+    """ func(*args) in an I/O thread, stopping with ReadCancelled once token is cancelled."""
+    with tracking(Progress(cancel=token)):
+        return func(*args)
+
+
+def _hashable(index):
+    """ Hashable version of a (valid) index so equal indices give equal keys."""
+    if isinstance(index, slice):
+        return ('slice', index.start, index.stop, index.step)
+    if isinstance(index, (list, tuple, np.ndarray)):
+        return ('list', ) + tuple(int(x) for x in index)
+    return int(index)
+
+
+class _Batch:
+    """ A read of the union of the frames of a group of requests for the same region.
+
+    Attributes:
+        region: Tuple. Field, y, x and channel indices of the read.
+        frames: Set of integers. Frames to read.
+        frame_list: List of integers. Sorted frames once the read has started.
+        future: asyncio.Future. Set to the output of the read.
+        token: CancelToken. Cancelled once no request waits for the read.
+        num_requests: Integer. Requests served by this read.
+        num_waiting: Integer. Requests still waiting for it.
+    """
+    def __init__(self, region, future):
+        self.region = region
+        self.frames = set()
+        self.frame_list = None
+        self.future = future
+        self.token = CancelToken()
+        self.num_requests = 0
+        self.num_waiting = 0
+
+
+class AsyncReader:
+    """ Serves reads of a scan to asyncio code from a pool of I/O threads, merging
+    concurrent requests for the same region into single reads.
+
+    Use scan.aread and scan.aiter_chunks (scan.async_reader is the AsyncReader of the
+    scan).
+
+    Attributes:
+        scan: Scan object.
+        workers: Integer or None. Number of I/O threads. None uses the default of
+            concurrent.futures.ThreadPoolExecutor.
+        merge_delay: Float. Seconds requests wait for other requests to merge with. The
+            default (0) merges requests made in the same iteration of the event loop.
+    """
+    def __init__(self, scan, workers=None, merge_delay=0):
+        self.scan = scan
+        self.workers = workers
+        self.merge_delay = merge_delay
+        self._pool = None
+        self._pending = {} # (loop, region): batch waiting to be read
+        self._in_flight = collections.defaultdict(list) # (loop, region): batches being read
+
+    @property
+    def pool(self):
+        """ ThreadPoolExecutor running the reads (created on first use)."""
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='scanreader-io')
+        return self._pool
+
+    def close(self):
+        """ Stop the I/O threads (after the reads in progress finish)."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    async def read(self, key=slice(None)):
+        """ scan[key] read in an I/O thread (merged with concurrent requests for the same
+        region; see module docstring).
+
+        Raises:
+            TypeError, IndexError: As scan[key], before anything is read.
+        """
+        full_key = utils.fill_key(key, num_dimensions=5)
+        for i, index in enumerate(full_key):
+            utils.check_index_type(i, index)
+        utils.check_index_is_in_bounds(4, full_key[4], self.scan.num_frames)
+        frame_list = utils.listify_index(full_key[4], self.scan.num_frames)
+        if len(frame_list) == 0: # nothing to merge
+            return await self._run(self.scan.__getitem__, full_key)
+
+        loop = asyncio.get_running_loop()
+        batch_key = (loop, tuple(_hashable(index) for index in full_key[:4]))
+        frames = set(frame_list)
+        batch = next((b for b in self._in_flight[batch_key] if frames <= b.frames), None)
+        if batch is None:
+            batch = self._pending.get(batch_key)
+            if batch is None:
+                batch = _Batch(full_key[:4], loop.create_future())
+                self._pending[batch_key] = batch
+                loop.call_later(self.merge_delay, self._start, loop, batch_key)
+            batch.frames.update(frames)
+        batch.num_requests += 1
+        batch.num_waiting += 1
+
+        try:
+            item = await asyncio.shield(batch.future)
+        except asyncio.CancelledError:
+            batch.num_waiting -= 1
+            if batch.num_waiting == 0:
+                self._cancel(batch_key, batch)
+            raise
+        except Exception:
+            batch.num_waiting -= 1
+            if batch.num_requests == 1:
+                raise
+            return await self._run(self.scan.__getitem__, full_key) # e.g., union too big
+        batch.num_waiting -= 1
+
+        if item.size == 0: # empty y, x or channel selection
+            return item
+        if batch.num_requests == 1 and batch.frame_list == frame_list:
+            return item[..., 0] if _is_integer(full_key[4]) else item
+        item = item[..., np.searchsorted(batch.frame_list, frame_list)] # a copy
+        return item[..., 0] if _is_integer(full_key[4]) else item
+
+    async def iter_chunks(self, fields=None, channels=None, chunk_frames=None,
+                          prefetch=2):
+        """ Async generator with the scan in consecutive chunks of frames, reading the
+        next prefetch chunks while the current one is processed.
+
+        Args:
+            fields: Integer, list of integers or None. Fields to read. None for all.
+            channels: Integer, list of integers or None. Channels to read. None for all.
+                If an integer, that axis is dropped from the output (as in scan[...]).
+            chunk_frames: Integer. Maximum number of frames per chunk. Default reads
+                ~64 MB per chunk (all requested fields), fitted to the memory budget of
+                the scan.
+            prefetch: Integer. Number of chunks read ahead.
+
+        Yields:
+            (frames, blocks) tuples. frames is a slice object with the frames read;
+                blocks is a list with a [y, x, channels, frames] array per field.
+        """
+        field_list = parallel.as_list(fields, self.scan.num_fields)
+        channel_list = parallel.as_list(channels, self.scan.num_channels)
+        chunk_frames = parallel.fit_chunk_frames(self.scan, field_list, len(channel_list),
+                                                 chunk_frames, workers=prefetch)
+        drop_channel = np.issubdtype(type(channels), np.signedinteger)
+
+        loop = asyncio.get_running_loop()
+        frame_slices = iter(parallel.frame_chunks(self.scan.num_frames, chunk_frames))
+        in_flight = collections.deque() # (frames, token, future) read ahead
+        def submit(frame_slice):
+            token = CancelToken()
+            frame_list = list(range(frame_slice.start, frame_slice.stop))
+            future = loop.run_in_executor(self.pool, _read, token, self.scan._read_fields,
+                                          field_list, channel_list, frame_list)
+            in_flight.append((frame_slice, token, future))
+
+        try:
+            for frame_slice in itertools.islice(frame_slices, max(prefetch, 1)):
+                submit(frame_slice)
+            while in_flight:
+                frame_slice, _, future = in_flight[0]
+                blocks = await future
+                in_flight.popleft()
+                next_slice = next(frame_slices, None)
+                if next_slice is not None:
+                    submit(next_slice)
+                if drop_channel:
+                    blocks = [block[:, :, 0] for block in blocks]
+                yield frame_slice, blocks
+        finally: # stop reading ahead if the consumer stopped early or was cancelled
+            for _, token, future in in_flight:
+                token.cancel()
+                future.cancel()
+
+    def _start(self, loop, batch_key):
+        """ Start reading a pending batch in the I/O threads."""
+        batch = self._pending.pop(batch_key, None)
+        if batch is None: # all its requests were cancelled
+            return
+        batch.frame_list = sorted(batch.frames)
+        self._in_flight[batch_key].append(batch)
+        future = loop.run_in_executor(self.pool, _read, batch.token,
+                                      self.scan.__getitem__,
+                                      batch.region + (batch.frame_list, ))
+        future.add_done_callback(lambda future: self._finish(batch_key, batch, future))
+
+    def _finish(self, batch_key, batch, future):
+        self._forget(batch_key, batch)
+        error = None if future.cancelled() else future.exception()
+        if batch.future.done(): # cancelled
+            return
+        if future.cancelled() or isinstance(error, ReadCancelled):
+            batch.future.cancel()
+        elif error is not None:
+            batch.future.set_exception(error)
+        else:
+            batch.future.set_result(future.result())
+
+    def _cancel(self, batch_key, batch):
+        """ Cancel a batch no request is waiting for (pending or being read)."""
+        if self._pending.get(batch_key) is batch:
+            del self._pending[batch_key]
+        self._forget(batch_key, batch)
+        batch.token.cancel()
+        batch.future.cancel()
+
+    def _forget(self, batch_key, batch):
+        """ Stop merging new requests into batch."""
+        batches = self._in_flight.get(batch_key, [])
+        if batch in batches:
+            batches.remove(batch)
+        if not batches:
+            self._in_flight.pop(batch_key, None)
+
+    async def _run(self, func, *args):
+        """ func(*args) in an I/O thread, stopped if the caller is cancelled."""
+        token = CancelToken()
+        future = asyncio.get_running_loop().run_in_executor(self.pool, _read, token, func,
+                                                            *args)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            token.cancel()
+            raise
+
+
+def _is_integer(index):
+    return np.issubdtype(type(index), np.signedinteger)
@@ -0,0 +1,370 @@
+"""
+Catalog of the scans in a directory tree, stored in a SQLite database.
+
+Indexing a scan (parsing its ScanImage metadata and walking the IFDs of its files) is
+done once, in parallel over scans, and saved with the scan's metadata (version, fields,
+channels, frames, fps...) so scans can be searched with SQL and opened without reading
+their tiff headers again. Updating the catalog only re-indexes files whose size or
+modification time changed.
+
+Files are grouped into scans by name: ScanImage saves long scans as name_00001.tif,
+name_00002.tif, ... so files in the same directory that only differ in their final
+number are one scan.
+
+Example:
+    catalog = Catalog('/data/scans.db')
+    catalog.update('/data/experiments', workers=8)
+    for record in catalog.records('num_frames > ? AND num_channels = 2', (1000, )):
+        scan = catalog.open(record['pathname'])
+"""
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import fnmatch
+import glob
+import json
+import os
+import re
+import sqlite3
+import time
+import zlib
+import numpy as np
+from . import core
+from . import pages
+from .exceptions import CatalogError
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    scan_id INTEGER PRIMARY KEY,
+    pathname TEXT UNIQUE NOT NULL,
+    version TEXT,
+    is_multiROI INTEGER,
+    is_slow_stack INTEGER,
+    num_fields INTEGER,
+    num_channels INTEGER,
+    num_frames INTEGER,
+    num_scanning_depths INTEGER,
+    fps REAL,
+    field_heights TEXT,
+    field_widths TEXT,
+    field_depths TEXT,
+    num_files INTEGER,
+    nbytes INTEGER,
+    header TEXT NOT NULL,
+    roi_metadata TEXT,
+    indexed_at REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    scan_id INTEGER NOT NULL REFERENCES scans(scan_id) ON DELETE CASCADE,
+    file_number INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    mtime_ns INTEGER,
+    size INTEGER,
+    page_height INTEGER,
+    page_width INTEGER,
+    dtype TEXT,
+    is_contiguous INTEGER,
+    last_ifd_offset INTEGER,
+    offsets BLOB,
+    PRIMARY KEY (scan_id, file_number)
+);
+"""
+# Columns returned by Catalog.records (JSON columns are decoded)
+RECORD_COLUMNS = ('scan_id', 'pathname', 'version', 'is_multiROI', 'is_slow_stack',
+                  'num_fields', 'num_channels', 'num_frames', 'num_scanning_depths', 'fps',
+                  'field_heights', 'field_widths', 'field_depths', 'num_files', 'nbytes',
+                  'indexed_at')
+_JSON_COLUMNS = ('field_heights', 'field_widths', 'field_depths')
+
+
+def group_files(root, pattern='*.tif'):
+    """ Find the scans in a directory tree.
+
+    Args:
+        root: String. Directory to search (recursively).
+        pattern: String. Filename pattern of the scan files.
+
+    Returns:
+        A dictionary mapping each scan's pathname pattern (e.g., '/data/scan_*.tif') to
+            its (absolute, sorted) filenames.
+    """
+    groups = {}
+    for dirpath, _, filenames in os.walk(os.path.abspath(root)):
+        for filename in fnmatch.filter(filenames, pattern):
+            stem, extension = os.path.splitext(filename)
+            prefix = re.sub(r'_\d+$', '', stem)
+            pathname = (os.path.join(dirpath, glob.escape(prefix) + '_*' + extension) if
+                        prefix != stem else os.path.join(dirpath, glob.escape(filename)))
+            groups.setdefault(pathname, []).append(os.path.join(dirpath, filename))
+    return {pathname: sorted(filenames, key=os.path.basename) for pathname, filenames in
+            groups.items()}
+
+
+def _file_state(filename):
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _index_scan(filenames, header=None, roi_metadata=None, page_indices=None):
+    """ Index the files of a scan (reusing the page indices of files that did not change)
+    and describe it. Runs in the worker threads/processes of Catalog.update.
+
+    Args:
+        filenames: List of strings. Files of the scan.
+        header, roi_metadata: ScanImage metadata, if known (None reads it).
+        page_indices: Dictionary. PageIndex of the files whose index can be reused.
+
+    Returns:
+        A (record, files) tuple: record is a dictionary with the columns of the scans
+            table, files a list of (filename, mtime_ns, size, PageIndex) tuples.
+    """
+    states = [_file_state(filename) for filename in filenames] # before reading them
+    if header is None:
+        header, roi_metadata = pages.read_scanimage_header(filenames[0])
+    known_indices = page_indices or {}
+    page_indices = [known_indices.get(filename) or pages.index_pages(filename) for filename
+                    in filenames]
+    scan = core.create_scan(filenames, header, roi_metadata, page_indices=page_indices)
+
+    record = {'version': scan.version, 'is_multiROI': scan.is_multiROI,
+              'is_slow_stack': scan.is_slow_stack, 'num_fields': scan.num_fields,
+              'num_channels': scan.num_channels, 'num_frames': scan.num_frames,
+              'num_scanning_depths': scan.num_scanning_depths, 'fps': scan.fps,
+              'field_heights': json.dumps(scan.field_heights),
+              'field_widths': json.dumps(scan.field_widths),
+              'field_depths': json.dumps(scan.field_depths),
+              'num_files': len(filenames), 'nbytes': sum(size for _, size in states),
+              'header': header, 'roi_metadata': json.dumps(roi_metadata),
+              'indexed_at': time.time()}
+    files = [(filename, mtime_ns, size, page_index) for filename, (mtime_ns, size),
+             page_index in zip(filenames, states, page_indices)]
+    return record, files
+
+
+class Catalog:
+    """ SQLite catalog of scans: their metadata and page indices.
+
+    Attributes:
+        path: String. SQLite database file (created if needed).
+
+    Example:
+        catalog = Catalog('/data/scans.db')
+        catalog.update('/data/experiments')
+        scan = catalog.open('/data/experiments/mouse1/scan_*.tif')
+    """
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM scans').fetchone()[0]
+
+    def update(self, root, pattern='*.tif', workers=None, executor='thread'):
+        """ Add the scans in a directory tree to the catalog, re-index those whose files
+        changed (size or modification time) and drop those that no longer exist.
+
+        Args:
+            root: String. Directory to search (recursively).
+            pattern: String. Filename pattern of the scan files.
+            workers: Integer or None. Number of scans indexed in parallel. None indexes
+                them one by one; -1 uses one worker per core.
+            executor: String. 'thread' or 'process'.
+
+        Returns:
+            A dictionary with the pathnames 'added', 'updated', 'removed' and
+                'unchanged', and a dictionary of 'failed' pathnames to error messages
+                (e.g., tiff files that are not ScanImage scans).
+        """
+        if executor not in ['thread', 'process']:
+            raise ValueError("executor should be 'thread' or 'process', received "
+                             "{}".format(executor))
+        groups = group_files(root, pattern)
+        summary = {'added': [], 'updated': [], 'removed': [], 'unchanged': [],
+                   'failed': {}}
+
+        # Scans under root that are gone
+        root_dir = os.path.join(os.path.abspath(root), '')
+        for scan_id, pathname in self._connection.execute(
+                'SELECT scan_id, pathname FROM scans WHERE substr(pathname, 1, ?) = ?',
+                (len(root_dir), root_dir)).fetchall():
+            if pathname not in groups:
+                with self._connection:
+                    self._delete(scan_id)
+                summary['removed'].append(pathname)
+
+        # Scans to (re)index
+        tasks = {}
+        for pathname, filenames in groups.items():
+            known = self._known_files(pathname)
+            states = {filename: _file_state(filename) for filename in filenames}
+            unchanged = {filename: page_index for filename, (state, page_index) in
+                         known.items() if states.get(filename) == state}
+            if len(unchanged) == len(filenames) == len(known):
+                summary['unchanged'].append(pathname)
+                continue
+            header = roi_metadata = None
+            if filenames[0] in unchanged: # metadata is read from the first file
+                header, roi_metadata = self._metadata(pathname)
+            tasks[pathname] = (filenames, header, roi_metadata, unchanged)
+
+        # Index them in parallel and save them as they finish
+        is_serial = workers is None or (workers != -1 and workers <= 1)
+        if is_serial:
+            results = ((pathname, _try_index_scan(*args)) for pathname, args in
+                       tasks.items())
+            self._save_all(results, summary)
+        else:
+            max_workers = os.cpu_count() if workers == -1 else workers
+            Executor = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+            with Executor(max_workers=max_workers) as pool:
+                futures = {pathname: pool.submit(_try_index_scan, *args) for pathname, args
+                           in tasks.items()}
+                self._save_all(((pathname, future.result()) for pathname, future in
+                                futures.items()), summary)
+
+        return summary
+
+    def records(self, where=None, params=()):
+        """ Metadata of the cataloged scans (see RECORD_COLUMNS).
+
+        Args:
+            where: String or None. SQL condition on the columns of the scans table, e.g.,
+                'num_frames > ? AND version = ?'.
+            params: Tuple. Values of the ? placeholders in where.
+
+        Returns:
+            A list of dictionaries (one per scan) sorted by pathname.
+        """
+        query = 'SELECT {} FROM scans'.format(', '.join(RECORD_COLUMNS))
+        if where is not None:
+            query += ' WHERE ' + where
+        records = []
+        for row in self._connection.execute(query + ' ORDER BY pathname', params):
+            record = dict(zip(RECORD_COLUMNS, row))
+            for column in _JSON_COLUMNS:
+                record[column] = json.loads(record[column])
+            records.append(record)
+        return records
+
+    def open(self, pathname, dtype=np.int16, join_contiguous=False, max_memory=None,
+             check_files=True):
+        """ Open a cataloged scan without reading its metadata or indexing its pages.
+
+        Args:
+            pathname: String or integer. Pathname pattern (as in records()) or scan_id.
+            dtype, join_contiguous, max_memory: As in scanreader.read_scan.
+            check_files: Boolean. Whether to check (with a stat per file) that the files
+                did not change since they were indexed.
+
+        Returns:
+            A Scan object, as returned by read_scan(pathname).
+
+        Raises:
+            CatalogError: If the scan is not in the catalog or its files changed since
+                they were indexed (call update).
+        """
+        column = 'scan_id' if isinstance(pathname, (int, np.integer)) else 'pathname'
+        row = self._connection.execute(
+            'SELECT scan_id, pathname, header, roi_metadata FROM scans WHERE {} = '
+            '?'.format(column), (pathname, )).fetchone()
+        if row is None:
+            raise CatalogError('Scan {} is not in the catalog {}'.format(pathname,
+                                                                         self.path))
+        scan_id, pathname, header, roi_metadata = row
+
+        files = [(filename, (mtime_ns, size), page_index) for filename, mtime_ns, size,
+                 page_index in self._files(scan_id)]
+        if check_files:
+            for filename, state, _ in files:
+                try:
+                    is_changed = _file_state(filename) != state
+                except FileNotFoundError:
+                    is_changed = True
+                if is_changed:
+                    raise CatalogError('{} changed since it was cataloged; update the '
+                                       'catalog'.format(filename))
+
+        scan = core.create_scan([filename for filename, *_ in files], header,
+                                json.loads(roi_metadata), dtype=dtype,
+                                join_contiguous=join_contiguous,
+                                page_indices=[page_index for *_, page_index in files])
+        scan.pathnames = pathname
+        scan.max_memory = max_memory
+        return scan
+
+    def _save_all(self, results, summary):
+        """ Save (pathname, (record, files, error)) results as they arrive."""
+        for pathname, (record, files, error) in results:
+            if error is not None:
+                summary['failed'][pathname] = error
+                continue
+            row = self._connection.execute('SELECT scan_id FROM scans WHERE pathname = ?',
+                                           (pathname, )).fetchone()
+            with self._connection:
+                if row is not None:
+                    self._delete(row[0])
+                self._insert(pathname, record, files)
+            summary['added' if row is None else 'updated'].append(pathname)
+
+    def _insert(self, pathname, record, files):
+        columns = ['pathname'] + list(record)
+        cursor = self._connection.execute(
+            'INSERT INTO scans ({}) VALUES ({})'.format(', '.join(columns),
+                                                         ', '.join('?' * len(columns))),
+            [pathname] + list(record.values()))
+        self._connection.executemany(
+            'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(cursor.lastrowid, i, filename, mtime_ns, size, page_index.height,
+              page_index.width, page_index.dtype.str, int(page_index.is_contiguous),
+              page_index.last_ifd_offset, zlib.compress(page_index.offsets.tobytes()))
+             for i, (filename, mtime_ns, size, page_index) in enumerate(files)])
+
+    def _delete(self, scan_id):
+        self._connection.execute('DELETE FROM scans WHERE scan_id = ?', (scan_id, ))
+
+    def _files(self, scan_id):
+        """ (filename, mtime_ns, size, PageIndex) of each file of a scan."""
+        rows = self._connection.execute(
+            'SELECT filename, mtime_ns, size, page_height, page_width, dtype, '
+            'is_contiguous, last_ifd_offset, offsets FROM files WHERE scan_id = ? ORDER BY '
+            'file_number', (scan_id, )).fetchall()
+        return [(filename, mtime_ns, size, pages.PageIndex(
+                    filename, np.frombuffer(zlib.decompress(offsets), dtype=np.int64),
+                    height, width, np.dtype(dtype), bool(is_contiguous), size,
+                    last_ifd_offset))
+                for filename, mtime_ns, size, height, width, dtype, is_contiguous,
+                last_ifd_offset, offsets in rows]
+
+    def _known_files(self, pathname):
+        """ {filename: ((mtime_ns, size), PageIndex)} of a cataloged scan (empty if it
+        is not in the catalog)."""
+        row = self._connection.execute('SELECT scan_id FROM scans WHERE pathname = ?',
+                                       (pathname, )).fetchone()
+        if row is None:
+            return {}
+        return {filename: ((mtime_ns, size), page_index) for filename, mtime_ns, size,
+                page_index in self._files(row[0])}
+
+    def _metadata(self, pathname):
+        header, roi_metadata = self._connection.execute(
+            'SELECT header, roi_metadata FROM scans WHERE pathname = ?',
+            (pathname, )).fetchone()
+        return header, json.loads(roi_metadata)
+
+
+def _try_index_scan(filenames, header, roi_metadata, page_indices):
+    """ _index_scan returning (record, files, error message) rather than raising, so a
+    file that is not a (supported) ScanImage scan does not stop the update."""
+    try:
+        return (*_index_scan(filenames, header, roi_metadata, page_indices), None)
+    except Exception as error:
+        return None, None, '{}: {}'.format(type(error).__name__, error)
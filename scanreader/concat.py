@@ -0,0 +1,178 @@
+"""
+Several scans with the same settings (e.g., consecutive acquisitions of a session) seen
+as a single scan concatenated along time.
+
+Each scan keeps its own number of frames (an acquisition that ended with a partial
+volume drops it), unlike reading all files as one scan with read_scan, which would count
+frames over the combined pages and misalign every acquisition after the first partial
+volume. Global frames are mapped to (scan, frame in that scan) with a table of frame
+offsets and each scan reads its frames straight into the shared output.
+"""
+import numpy as np
+from . import utils
+from .exceptions import ScanMismatchError, MemoryBudgetError
+
+# Properties that have to be the same in all concatenated scans (slow stacks and scans
+# order their pages differently)
+_MATCHING_PROPERTIES = ('version', 'is_multiROI', 'is_slow_stack', 'num_fields',
+                        'num_channels', 'field_heights', 'field_widths', 'field_depths',
+                        'fps', 'dtype')
+
+
+def concatenate(scans, **kwargs):
+    """ Concatenate scans along time.
+
+    Args:
+        scans: List of Scan objects or of pathnames (as accepted by read_scan).
+        kwargs: Arguments for read_scan (e.g., dtype) if scans are pathnames.
+
+    Returns:
+        A ConcatenatedScan.
+
+    Example:
+        scan = scanreader.concatenate(['/data/session_00001_*.tif',
+                                       '/data/session_00002_*.tif'])
+        scan[0, :, :, 0, 900:1100]    frames from the end of the first acquisition and the
+            start of the second
+    """
+    from .core import read_scan # core imports this module
+
+    scans = [read_scan(scan, **kwargs) if isinstance(scan, (str, list, tuple)) else scan
+             for scan in scans]
+    return ConcatenatedScan(scans)
+
+
+class ConcatenatedScan:
+    """ Scans with the same fields and channels concatenated along time.
+
+    Indexable and iterable as a scan (scan[field, y, x, channel, frame] and
+    'for field in scan:'), with frames numbered across all scans.
+
+    Attributes:
+        scans: List of Scan objects.
+        frame_offsets: Array of integers. First (global) frame of each scan, plus the
+            total number of frames at the end.
+
+    Raises:
+        ScanMismatchError: If the scans have different fields, channels, dtype, frame
+            rate, ScanImage version or are not all slow stacks (or all scans).
+    """
+    def __init__(self, scans):
+        if len(scans) == 0:
+            raise ValueError('Expected at least one scan to concatenate')
+        for prop in _MATCHING_PROPERTIES:
+            values = [getattr(scan, prop) for scan in scans]
+            if any(value != values[0] for value in values[1:]):
+                raise ScanMismatchError('Scans with different {} cannot be concatenated: '
+                                        '{}'.format(prop, values))
+        self.scans = list(scans)
+        self.frame_offsets = np.cumsum([0] + [scan.num_frames for scan in scans])
+
+    @property
+    def num_frames(self):
+        return int(self.frame_offsets[-1])
+
+    @property
+    def num_fields(self):
+        return self.scans[0].num_fields
+
+    @property
+    def num_channels(self):
+        return self.scans[0].num_channels
+
+    @property
+    def field_heights(self):
+        return self.scans[0].field_heights
+
+    @property
+    def field_widths(self):
+        return self.scans[0].field_widths
+
+    @property
+    def field_depths(self):
+        return self.scans[0].field_depths
+
+    @property
+    def is_multiROI(self):
+        return self.scans[0].is_multiROI
+
+    @property
+    def dtype(self):
+        return self.scans[0].dtype
+
+    @property
+    def fps(self):
+        return self.scans[0].fps
+
+    @property
+    def max_memory(self):
+        """ Smallest memory budget of the scans (None if none of them has one)."""
+        budgets = [scan.max_memory for scan in self.scans if scan.max_memory is not None]
+        return min(budgets) if budgets else None
+
+    @property
+    def shape(self):
+        return (*self.scans[0].shape[:4], self.num_frames)
+
+    def __len__(self):
+        return self.num_fields
+
+    def __array__(self, dtype=None, copy=None):
+        # data is read into a new array, never shared with the scan, so copy is moot
+        array = self[:]
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def __iter__(self):
+        return (self[field_id] for field_id in range(self.num_fields))
+
+    def locate(self, frames):
+        """ Scan and frame in that scan of each global frame.
+
+        Args:
+            frames: Integer, slice or list/tuple/array of integers. Global frames.
+
+        Returns:
+            A (scan_ids, local_frames) tuple of arrays of integers.
+        """
+        utils.check_index_is_in_bounds(4, frames, self.num_frames)
+        frame_list = np.array(utils.listify_index(frames, self.num_frames), dtype=np.int64)
+        scan_ids = np.searchsorted(self.frame_offsets, frame_list, side='right') - 1
+        return scan_ids, frame_list - self.frame_offsets[scan_ids]
+
+    def __getitem__(self, key):
+        """ Index by field, y, x, channels, frames as a scan. Frames of each scan are read
+        into their place in the output (no intermediate copies)."""
+        # Fill key to size 5 (raises IndexError if more than 5)
+        full_key = utils.fill_key(key, num_dimensions=5)
+
+        # Check index types are valid
+        for i, index in enumerate(full_key):
+            utils.check_index_type(i, index)
+
+        scan_ids, local_frames = self.locate(full_key[4])
+        plans = {} # one per scan read
+        plan = plans[0] = self.scans[0].plan(full_key[:4])
+        if plan._is_empty or len(scan_ids) == 0:
+            return np.empty(0)
+        nbytes = int(np.prod(plan.shape)) * len(scan_ids) * np.dtype(self.dtype).itemsize
+        if self.max_memory is not None and nbytes > self.max_memory:
+            raise MemoryBudgetError('Reading {} bytes exceeds the memory budget of the '
+                                    'concatenated scans ({} bytes). Read fewer frames at a '
+                                    'time.'.format(nbytes, self.max_memory))
+
+        # Read each run of consecutive frames from the same scan into the output
+        item = np.empty([*plan.shape, len(scan_ids)], dtype=self.dtype)
+        run_starts = np.flatnonzero(np.diff(scan_ids, prepend=-1))
+        run_stops = np.append(run_starts[1:], len(scan_ids))
+        for start, stop in zip(run_starts, run_stops):
+            scan_id = scan_ids[start]
+            if scan_id not in plans:
+                plans[scan_id] = self.scans[scan_id].plan(full_key[:4])
+            plans[scan_id].read(local_frames[start:stop], out=item[..., start:stop])
+
+        # If original index was an integer, delete that axis (as in numpy indexing)
+        squeeze_dims = plan._squeeze_dims + ([4] if np.issubdtype(type(full_key[4]),
+                                                                  np.signedinteger) else [])
+        item = np.squeeze(item, axis=tuple(squeeze_dims))
+
+        return item
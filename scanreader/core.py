@@ -7,13 +7,13 @@ Example:
     for field in scan:
         #process field
 """
-from tifffile import TiffFile
 from glob import glob
 from os import path
 import numpy as np
 import re
 from .exceptions import ScanImageVersionError, PathnameError
 from . import scans
+from . import pages
 
 _scans = {'5.1': scans.Scan5Point1, '5.2': scans.Scan5Point2, '5.3': scans.Scan5Point3,
           '5.4': scans.Scan5Point4, '5.5': scans.Scan5Point5, 
@@ -24,7 +24,8 @@ _scans = {'5.1': scans.Scan5Point1, '5.2': scans.Scan5Point2, '5.3': scans.Scan5
           '2019a': scans.Scan2019a, '2019b': scans.Scan2019b,
           '2020': scans.Scan2020,}
 
-def read_scan(pathnames, dtype=np.int16, join_contiguous=False):
+def read_scan(pathnames, dtype=np.int16, join_contiguous=False, live=False,
+              max_memory=None, allow_truncated=False):
     """ Reads a ScanImage scan.
 
     Args:
@@ -33,6 +34,16 @@ def read_scan(pathnames, dtype=np.int16, join_contiguous=False):
         join_contiguous: Boolean. For multiROI scans (2016b and beyond) it will join
             contiguous scanfields in the same depth. No effect in non-multiROI scans. See
             help of ScanMultiROI._join_contiguous_fields for details.
+        live: Boolean. Whether the scan is still being acquired. Pages that are not yet
+            fully written are ignored rather than raising an error; call scan.refresh()
+            or iterate over scan.follow() to pick up new frames as they arrive.
+        max_memory: Integer. Memory budget in bytes. Indexing the scan (scan[...]) raises
+            MemoryBudgetError if the output would be larger; chunked methods (reduce,
+            map_blocks, to_zarr, ...) pick chunks small enough to fit it. None for no
+            limit.
+        allow_truncated: Boolean. Whether to read scans whose last file is truncated
+            (e.g., after a crash) up to its last complete page rather than raising an
+            error when indexing it. See scan.verify() to check the files of a scan.
 
     Returns:
         A Scan object (subclass of BaseScan) with metadata and data. See Readme for details.
@@ -43,15 +54,44 @@ def read_scan(pathnames, dtype=np.int16, join_contiguous=False):
         error_msg = 'Pathname(s) {} do not match any files in disk.'.format(pathnames)
         raise PathnameError(error_msg)
 
-    # Read version from one of the tiff files
-    with TiffFile(filenames[0]) as tiff_file:
-        file_info = tiff_file.pages[0].description + '\n' + tiff_file.pages[0].software
-    version = get_scanimage_version(file_info)
+    # Read metadata (and version) from the first tiff file; other files are not opened
+    # until their pages are needed
+    file_info, roi_metadata = pages.read_scanimage_header(filenames[0])
+    scan = create_scan(filenames, file_info, roi_metadata, dtype=dtype,
+                       join_contiguous=join_contiguous, live=live,
+                       allow_truncated=allow_truncated)
+    scan.pathnames = pathnames
+    scan.max_memory = max_memory
+
+    return scan
+
+def create_scan(filenames, header, roi_metadata=None, dtype=np.int16,
+                join_contiguous=False, live=False, allow_truncated=False, page_indices=None):
+    """ Creates the Scan object for a scan whose ScanImage metadata was already read
+    (e.g., from a catalog, see catalog.py). Nothing is read from disk, except for the
+    page index of the first file of multiROI scans (to find their page size) if
+    page_indices is not given.
+
+    Args:
+        filenames: List of strings. Absolute filenames of the scan (sorted).
+        header: String. ScanImage metadata (as returned by pages.read_scanimage_header).
+        roi_metadata: Dictionary or None. ROI metadata (2016b and beyond).
+        dtype: Data-type. Data type of the output array.
+        join_contiguous: Boolean. See read_scan.
+        live: Boolean. See read_scan.
+        allow_truncated: Boolean. See read_scan.
+        page_indices: List of PageIndex objects (one per file, see pages.index_pages) or
+            None. Page indices of the files if already known; None indexes the files when
+            their pages are first needed.
+
+    Returns:
+        A Scan object (subclass of BaseScan).
+    """
+    version = get_scanimage_version(header)
 
     # Select the appropriate scan object
-    
     if (version in ['2016b', '2017a', '2017b', '2018a', '2018b', '2019a', '2019b', '2020'] and
-            is_scan_multiROI(file_info)):
+            is_scan_multiROI(header)):
         scan = scans.ScanMultiROI(join_contiguous=join_contiguous)
     elif version in _scans:
         scan = _scans[version]()
@@ -59,8 +99,12 @@ def read_scan(pathnames, dtype=np.int16, join_contiguous=False):
         error_msg = 'Sorry, ScanImage version {} is not supported'.format(version)
         raise ScanImageVersionError(error_msg)
 
-    # Read metadata and data (lazy operation)
-    scan.read_data(filenames, dtype=dtype)
+    # Read metadata and data (lazy operation; multiROI scans index the pages of the first
+    # file to find the page size, so how to treat incomplete pages has to be known before)
+    scan.is_live = live
+    scan.allow_truncated = allow_truncated
+    scan._page_indices = page_indices
+    scan.read_data(filenames, dtype=dtype, header=header, roi_metadata=roi_metadata)
 
     return scan
 
@@ -12,4 +12,24 @@ class PathnameError(ScanReaderException):
 
 class FieldDimensionMismatch(ScanReaderException):
     """ Exception for trying to slice an array with fields of different dimensions."""
-    pass
\ No newline at end of file
+    pass
+
+class PageLayoutError(ScanReaderException):
+    """ Exception for page layouts on disk that cannot be viewed as a strided array."""
+    pass
+
+class MemoryBudgetError(ScanReaderException):
+    """ Exception for reads that would not fit in the memory budget of the scan."""
+    pass
+
+class ReadCancelled(ScanReaderException):
+    """ Exception for reads stopped through their cancellation token."""
+    pass
+
+class CatalogError(ScanReaderException):
+    """ Exception for scans missing from a catalog or changed since they were cataloged."""
+    pass
+
+class ScanMismatchError(ScanReaderException):
+    """ Exception for combining scans with different fields, channels or data types."""
+    pass
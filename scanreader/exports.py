@@ -0,0 +1,461 @@
+"""
+Exporters that convert a scan into formats that are faster to read than ScanImage tiffs.
+
+All exporters stream chunks of frames through BaseScan._read_fields (each page is read
+once even if it holds many fields) on a ChunkPool, so memory is bounded by the chunks in
+flight and conversion can use several cores.
+"""
+import json
+import os
+import zlib
+import numpy as np
+from .parallel import ChunkPool, frame_chunks, fit_chunk_frames, as_list
+from .progress import new_progress
+
+CHUNK_NBYTES = 4 * 1024 ** 2 # default size of a zarr/hdf5 chunk
+BINARY_BUFFER_NBYTES = 16 * 1024 ** 2 # size of the write buffer of each binary file
+
+
+def scan_metadata(scan):
+    """ JSON-serializable dictionary with the scan attributes stored by exporters."""
+    metadata = {'version': scan.version, 'num_fields': scan.num_fields,
+                'num_channels': scan.num_channels, 'num_frames': scan.num_frames,
+                'fps': scan.fps, 'is_multiROI': scan.is_multiROI,
+                'is_slow_stack': scan.is_slow_stack, 'is_bidirectional':
+                scan.is_bidirectional, 'scanner_frequency': scan.scanner_frequency,
+                'seconds_per_line': scan.seconds_per_line, 'field_depths':
+                scan.field_depths, 'scanning_depths': scan.scanning_depths,
+                'motor_position_at_zero': scan.motor_position_at_zero,
+                'dtype': np.dtype(scan.dtype).str, 'header': scan.header}
+    return _to_builtin(metadata)
+
+
+def field_metadata(scan, field_id):
+    """ JSON-serializable dictionary with the geometry of one field."""
+    metadata = {'field_id': field_id, 'height': scan.field_heights[field_id],
+                'width': scan.field_widths[field_id],
+                'depth': scan.field_depths[field_id]}
+    if scan.is_multiROI:
+        field = scan.fields[field_id]
+        metadata.update({'slice_id': field.slice_id, 'roi_ids': field.roi_ids,
+                         'y_in_degrees': field.y, 'x_in_degrees': field.x,
+                         'height_in_degrees': field.height_in_degrees,
+                         'width_in_degrees': field.width_in_degrees,
+                         'height_in_microns': scan.field_heights_in_microns[field_id],
+                         'width_in_microns': scan.field_widths_in_microns[field_id]})
+    else:
+        metadata.update({'slice_id': field_id,
+                         'height_in_microns': getattr(scan, 'image_height_in_microns', None),
+                         'width_in_microns': getattr(scan, 'image_width_in_microns', None),
+                         'zoom': scan.zoom})
+    return _to_builtin(metadata)
+
+
+def _to_builtin(item):
+    """ Transform numpy scalars/arrays (inside lists and dicts) into python objects."""
+    if isinstance(item, dict):
+        return {key: _to_builtin(value) for key, value in item.items()}
+    elif isinstance(item, (list, tuple)):
+        return [_to_builtin(value) for value in item]
+    elif isinstance(item, (np.ndarray, np.generic)):
+        return item.tolist()
+    else:
+        return item
+
+
+def _write_json(filename, obj):
+    with open(filename, 'w') as f:
+        json.dump(obj, f, indent=4)
+
+
+def _chunk_shapes(scan, field_list, chunks, workers=None):
+    """ Chunk shape ([y, x, channels, frames]) of each field.
+
+    Args:
+        chunks: Integer, tuple of 4 integers (None spans the whole dimension) or None.
+            See to_zarr.
+        workers: Integer. Number of workers reading chunks (to fit scan.max_memory).
+
+    Returns:
+        Dictionary with the chunk shape of each field. All fields have the same number of
+            frames per chunk.
+
+    Raises:
+        MemoryBudgetError: If reading chunks of frames of all fields (in every worker)
+            does not fit scan.max_memory.
+    """
+    if chunks is None:
+        frame_nbytes = max(scan.field_heights[field_id] * scan.field_widths[field_id] for
+                           field_id in field_list) * np.dtype(scan.dtype).itemsize
+        chunks = int(max(1, min(CHUNK_NBYTES // frame_nbytes, fit_chunk_frames(
+            scan, field_list, scan.num_channels, workers=workers))))
+    if np.issubdtype(type(chunks), np.integer):
+        chunks = (None, None, 1, chunks)
+
+    chunks_per_field = {}
+    for field_id in field_list:
+        shape = (scan.field_heights[field_id], scan.field_widths[field_id],
+                 scan.num_channels, scan.num_frames)
+        chunks_per_field[field_id] = tuple(max(1, min(c, s)) if c else s for c, s in
+                                           zip(chunks, shape))
+    fit_chunk_frames(scan, field_list, scan.num_channels, chunks_per_field[field_list[0]][-1],
+                     workers) # whole frames of all fields are read at a time
+    return chunks_per_field
+
+
+def _iter_chunks(block, chunk_shape):
+    """ Split a [y, x, channels, frames] block into chunks of chunk_shape (edge chunks
+    are padded with zeros). Yields (chunk_offset, chunk) with the offset (in pixels)
+    inside the block."""
+    for y in range(0, block.shape[0], chunk_shape[0]):
+        for x in range(0, block.shape[1], chunk_shape[1]):
+            for c in range(0, block.shape[2], chunk_shape[2]):
+                chunk = block[y: y + chunk_shape[0], x: x + chunk_shape[1],
+                              c: c + chunk_shape[2]]
+                if chunk.shape != chunk_shape:
+                    padded = np.zeros(chunk_shape, dtype=chunk.dtype)
+                    padded[tuple(slice(0, s) for s in chunk.shape)] = chunk
+                    chunk = padded
+                yield (y, x, c), np.ascontiguousarray(chunk)
+
+
+def to_zarr(scan, path, chunks=None, fields=None, compression=None, compression_level=1,
+            workers=None, executor='thread', progress=None, cancel=None):
+    """ Write each field as a chunked array in a zarr (v2) directory store.
+
+    The store is a group with one array per field (named 'field0', 'field1', ...) so
+    multiROI fields of different shapes live side by side. Arrays are [y, x, channels,
+    frames] (as scan[field_id]). The scan metadata is stored in the group attributes and
+    the field geometry in each array's attributes. Files follow the zarr v2 spec so they
+    can be opened with zarr.open(path) but writing them does not require zarr.
+
+    Args:
+        scan: Scan object.
+        path: String. Directory of the store (created if needed).
+        chunks: Integer or tuple of 4 integers. Chunk shape; None entries span the whole
+            dimension. An integer sets the number of frames per chunk (spanning the whole
+            field in y, x and one channel). Default are ~4 MB chunks.
+        fields: Integer, list of integers or None. Fields to export. None for all.
+        compression: String. None (raw chunks) or 'zlib'.
+        compression_level: Integer. Compression level for zlib.
+        workers: Integer. Number of threads/processes. None runs serially.
+        executor: String. 'thread' or 'process'.
+        progress: Function or None. Called as progress(pages_done, total_pages,
+            bytes_done) as pages are read (see progress.py).
+        cancel: progress.CancelToken or None. Once cancelled, the operation stops with
+            ReadCancelled before reading the next chunk or batch of pages.
+
+    Returns:
+        Path to the store.
+    """
+    if compression not in [None, 'zlib']:
+        raise ValueError("compression should be None or 'zlib', received "
+                         "{}".format(compression))
+    field_list = list(dict.fromkeys(as_list(fields, scan.num_fields)))
+    chunks_per_field = _chunk_shapes(scan, field_list, chunks, workers)
+    chunk_frames = chunks_per_field[field_list[0]][-1]
+
+    # Write group and arrays metadata
+    compressor = None if compression is None else {'id': 'zlib', 'level':
+                                                   compression_level}
+    os.makedirs(path, exist_ok=True)
+    _write_json(os.path.join(path, '.zgroup'), {'zarr_format': 2})
+    _write_json(os.path.join(path, '.zattrs'), scan_metadata(scan))
+    for field_id in field_list:
+        shape = (scan.field_heights[field_id], scan.field_widths[field_id],
+                 scan.num_channels, scan.num_frames)
+        attrs = field_metadata(scan, field_id)
+        attrs['axes'] = ['y', 'x', 'channel', 'frame']
+        write_zarr_metadata(os.path.join(path, 'field{}'.format(field_id)), shape,
+                            chunks_per_field[field_id], scan.dtype, compressor, attrs)
+
+    # Stream chunks of frames (each task writes one row of chunks along time)
+    tasks = [(path, field_list, chunks_per_field, frame_slice, compressor) for
+             frame_slice in frame_chunks(scan.num_frames, chunk_frames)]
+    tracker = new_progress(progress, cancel, scan._count_pages(
+        field_list, range(scan.num_channels), scan.num_frames))
+    with ChunkPool(scan, workers=workers, executor=executor, progress=tracker) as pool:
+        for _ in pool.imap(_write_zarr_chunks, tasks, ordered=False):
+            pass
+
+    return path
+
+
+def _write_zarr_chunks(scan, path, field_list, chunks_per_field, frame_slice, compressor):
+    """ Read a chunk of frames for all fields and write it as zarr chunk files."""
+    frame_list = list(range(frame_slice.start, frame_slice.stop))
+    blocks = scan._read_fields(field_list, list(range(scan.num_channels)), frame_list)
+
+    for field_id, block in zip(field_list, blocks):
+        chunk_shape = chunks_per_field[field_id]
+        write_zarr_chunks(os.path.join(path, 'field{}'.format(field_id)), block,
+                          chunk_shape, frame_slice.start // chunk_shape[-1], compressor)
+
+
+def write_zarr_metadata(array_path, shape, chunks, dtype, compressor, attrs):
+    """ Create a zarr (v2) array directory: its .zarray and .zattrs files.
+
+    Args:
+        array_path: String. Directory of the array (created if needed).
+        shape: Tuple. Shape of the array.
+        chunks: Tuple. Shape of each chunk.
+        dtype: Data type of the array.
+        compressor: Dictionary ({'id': 'zlib', 'level': 1}) or None.
+        attrs: Dictionary. JSON-serializable attributes of the array.
+    """
+    os.makedirs(array_path, exist_ok=True)
+    zarray = {'zarr_format': 2, 'shape': list(shape), 'chunks': list(chunks),
+              'dtype': np.dtype(dtype).str, 'compressor': compressor, 'fill_value': 0,
+              'order': 'C', 'filters': None}
+    _write_json(os.path.join(array_path, '.zarray'), zarray)
+    _write_json(os.path.join(array_path, '.zattrs'), attrs)
+
+
+def write_zarr_chunks(array_path, block, chunk_shape, t, compressor):
+    """ Write a [y, x, channels, frames] block spanning the whole array in y, x and
+    channels and the t-th chunk along frames as zarr chunk files."""
+    for (y, x, c), chunk in _iter_chunks(block, chunk_shape):
+        data = chunk.tobytes()
+        if compressor is not None:
+            data = zlib.compress(data, compressor['level'])
+
+        chunk_key = '{}.{}.{}.{}'.format(y // chunk_shape[0], x // chunk_shape[1],
+                                         c // chunk_shape[2], t)
+        with open(os.path.join(array_path, chunk_key), 'wb') as f:
+            f.write(data)
+
+
+def to_binary(scan, path, fields=None, channels=None, chunk_frames=None, workers=None,
+              executor='thread', buffer_size=BINARY_BUFFER_NBYTES, progress=None,
+              cancel=None):
+    """ Write each field as a flat int16 binary file as expected by suite2p.
+
+    Creates path/plane{i}/data.bin (and data_chan2.bin for a second channel) for each
+    field i, with frames stored one after the other as [frames, y, x] (C order), and a
+    path/metadata.json with the shape, depth and timing of each field. Scans read with
+    another dtype (or calibrated, see calibration.py) are rounded and clipped to the
+    int16 range. The scan is read
+    in a single pass: each chunk of frames is read once (pages in file order), every
+    field is cut from it and appended to its file with large buffered writes.
+
+    Args:
+        scan: Scan object.
+        path: String. Output directory (created if needed). Existing files are replaced.
+        fields: Integer, list of integers or None. Fields to export. None for all.
+        channels: Integer or list of up to two integers. Channels to export; the first
+            one goes to data.bin, the second to data_chan2.bin. None for channel 0.
+        chunk_frames: Integer. Number of frames read at a time. Default reads ~64 MB per
+            chunk (all requested fields) or less to fit scan.max_memory.
+        workers: Integer. Number of threads/processes reading ahead. None runs serially.
+        executor: String. 'thread' or 'process'.
+        buffer_size: Integer. Size in bytes of the write buffer of each file.
+        progress: Function or None. Called as progress(pages_done, total_pages,
+            bytes_done) as pages are read (see progress.py).
+        cancel: progress.CancelToken or None. Once cancelled, the operation stops with
+            ReadCancelled before reading the next chunk or batch of pages.
+
+    Returns:
+        Dictionary with the information saved in metadata.json.
+    """
+    field_list = list(dict.fromkeys(as_list(fields, scan.num_fields)))
+    channel_list = [0] if channels is None else as_list(channels, scan.num_channels)
+    if len(channel_list) > 2:
+        raise ValueError('suite2p binaries hold at most two channels, received '
+                         '{}'.format(channel_list))
+    chunk_frames = fit_chunk_frames(scan, field_list, len(channel_list), chunk_frames,
+                                    workers)
+
+    # Metadata (shapes and timing) of each plane
+    basenames = ['data.bin', 'data_chan2.bin'][:len(channel_list)]
+    metadata = {'scan': scan_metadata(scan), 'channels': channel_list, 'planes': []}
+    for plane_id, field_id in enumerate(field_list):
+        plane = field_metadata(scan, field_id)
+        plane.update({'plane': plane_id, 'Ly': scan.field_heights[field_id],
+                      'Lx': scan.field_widths[field_id], 'nframes': scan.num_frames,
+                      'fs': scan.fps, 'dtype': 'int16',
+                      'time_offset': _time_offset(scan, field_id),
+                      'filenames': [os.path.join('plane{}'.format(plane_id), basename)
+                                    for basename in basenames]})
+        metadata['planes'].append(plane)
+
+    # Open one file per plane and channel
+    files = {}
+    try:
+        for plane_id, field_id in enumerate(field_list):
+            os.makedirs(os.path.join(path, 'plane{}'.format(plane_id)), exist_ok=True)
+            for channel_id, basename in enumerate(basenames):
+                filename = os.path.join(path, 'plane{}'.format(plane_id), basename)
+                files[(field_id, channel_id)] = open(filename, 'wb', buffering=buffer_size)
+
+        # Stream chunks of frames (read ahead in the pool, written here in order)
+        tasks = [(field_list, channel_list, frame_slice) for frame_slice in
+                 frame_chunks(scan.num_frames, chunk_frames)]
+        tracker = new_progress(progress, cancel, scan._count_pages(field_list, channel_list,
+                                                                   scan.num_frames))
+        with ChunkPool(scan, workers=workers, executor=executor,
+                       progress=tracker) as pool:
+            for blocks in pool.imap(_read_binary_blocks, tasks):
+                for field_id, block in zip(field_list, blocks):
+                    for channel_id in range(len(channel_list)):
+                        files[(field_id, channel_id)].write(block[channel_id].data)
+    finally:
+        for f in files.values():
+            f.close()
+
+    _write_json(os.path.join(path, 'metadata.json'), metadata)
+
+    return metadata
+
+
+def _time_offset(scan, field_id):
+    """ Seconds from the start of a volume to the first pixel of a field or None if the
+    scan header does not have the timing information needed."""
+    try:
+        return float(np.min(scan.field_offsets[field_id]))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def _read_binary_blocks(scan, field_list, channel_list, frame_slice):
+    """ Read a chunk of frames of every field as contiguous int16 [channels, frames, y, x]
+    arrays (rounded and clipped to the int16 range if needed)."""
+    frame_list = list(range(frame_slice.start, frame_slice.stop))
+    blocks = scan._read_fields(field_list, channel_list, frame_list)
+    int16_blocks = []
+    for block in blocks:
+        block = block.transpose([2, 3, 0, 1])
+        if block.dtype != np.int16:
+            if np.issubdtype(block.dtype, np.floating):
+                block = np.rint(block)
+            block = np.clip(block, np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+        int16_blocks.append(np.ascontiguousarray(block, dtype=np.int16))
+    return int16_blocks
+
+
+def to_hdf5(scan, path, compression='gzip', compression_level=4, chunks=None,
+            fields=None, workers=None, executor='thread', resume=True, progress=None,
+            cancel=None):
+    """ Write each field as a chunked, compressed dataset in an HDF5 file.
+
+    Datasets are named 'field0', 'field1', ... and are [y, x, channels, frames] (as
+    scan[field_id]). The scan metadata is stored as attributes of the file and the field
+    geometry as attributes of each dataset. Chunks of frames are read and compressed in
+    the pool (zlib releases the GIL so threads compress in parallel) and the compressed
+    chunks are written in order with h5py's direct chunk writes.
+
+    After each chunk of frames is written the number of frames written so far is saved
+    in the file (attribute 'frames_written'); if the export is interrupted, calling
+    to_hdf5 again with resume=True continues from there. The file also stores a
+    fingerprint of the scan (attribute 'scan_fingerprint': files and their sizes, number
+    of frames, dtype, field shapes and calibration) so only an export of the same scan
+    is resumed.
+
+    Args:
+        scan: Scan object.
+        path: String. HDF5 filename.
+        compression: String. 'gzip' or None.
+        compression_level: Integer. Gzip level (0-9).
+        chunks: Integer or tuple of 4 integers. Chunk shape; see to_zarr.
+        fields: Integer, list of integers or None. Fields to export. None for all.
+        workers: Integer. Number of threads/processes. None runs serially.
+        executor: String. 'thread' or 'process'.
+        resume: Boolean. Continue a previous (interrupted) export to this file if it was
+            written from the same scan and its datasets match; otherwise the file is
+            overwritten.
+        progress: Function or None. Called as progress(pages_done, total_pages,
+            bytes_done) as pages are read (see progress.py).
+        cancel: progress.CancelToken or None. Once cancelled, the operation stops with
+            ReadCancelled before reading the next chunk or batch of pages.
+
+    Returns:
+        Path to the file.
+    """
+    import h5py # optional dependency, only needed here
+
+    if compression not in [None, 'gzip']:
+        raise ValueError("compression should be None or 'gzip', received "
+                         "{}".format(compression))
+    field_list = list(dict.fromkeys(as_list(fields, scan.num_fields)))
+    chunks_per_field = _chunk_shapes(scan, field_list, chunks, workers)
+    chunk_frames = chunks_per_field[field_list[0]][-1]
+    dataset_names = {field_id: 'field{}'.format(field_id) for field_id in field_list}
+    shapes = {field_id: (scan.field_heights[field_id], scan.field_widths[field_id],
+                         scan.num_channels, scan.num_frames) for field_id in field_list}
+    fingerprint = _scan_fingerprint(scan)
+
+    with h5py.File(path, 'a') as f:
+        # Check whether we can resume from a previous export (of this same scan)
+        can_resume = (resume and f.attrs.get('scan_fingerprint') == fingerprint and
+                      all(name in f and f[name].shape == shapes[field_id] and
+                          f[name].dtype == scan.dtype and f[name].chunks ==
+                          chunks_per_field[field_id] and f[name].compression ==
+                          compression for field_id, name in dataset_names.items()))
+        start_frame = int(f.attrs.get('frames_written', 0)) if can_resume else 0
+
+        if not can_resume: # create datasets
+            for name in list(f.keys()):
+                del f[name]
+            for name in list(f.attrs.keys()):
+                del f.attrs[name]
+            for key, value in scan_metadata(scan).items():
+                if value is not None:
+                    f.attrs[key] = value
+            f.attrs['scan_fingerprint'] = fingerprint
+            for field_id, name in dataset_names.items():
+                dataset = f.create_dataset(name, shape=shapes[field_id], dtype=scan.dtype,
+                                           chunks=chunks_per_field[field_id],
+                                           compression=compression,
+                                           compression_opts=(compression_level if
+                                                             compression else None))
+                for key, value in field_metadata(scan, field_id).items():
+                    if value is not None:
+                        dataset.attrs[key] = value
+            f.attrs['frames_written'] = 0
+
+        # Stream chunks of frames (compressed in the pool, written here in order)
+        level = compression_level if compression else None
+        tasks = [(field_list, chunks_per_field, frame_slice, level) for frame_slice in
+                 frame_chunks(scan.num_frames, chunk_frames) if frame_slice.start >=
+                 start_frame]
+        tracker = new_progress(progress, cancel, scan._count_pages(
+            field_list, range(scan.num_channels), scan.num_frames - start_frame))
+        with ChunkPool(scan, workers=workers, executor=executor,
+                       progress=tracker) as pool:
+            for (_, _, frame_slice, _), chunks in zip(tasks, pool.imap(
+                    _compress_hdf5_chunks, tasks)):
+                for field_id, chunk_offset, data in chunks:
+                    f[dataset_names[field_id]].id.write_direct_chunk(chunk_offset, data)
+                f.attrs['frames_written'] = frame_slice.stop # checkpoint
+                f.flush()
+
+    return path
+
+
+def _scan_fingerprint(scan):
+    """ JSON string identifying the data of a scan: its files (and their sizes), number of
+    frames, dtype, field shapes and calibration."""
+    fingerprint = {'files': [[os.path.abspath(filename), os.path.getsize(filename)] for
+                             filename in scan.filenames],
+                   'num_frames': scan.num_frames, 'num_channels': scan.num_channels,
+                   'dtype': np.dtype(scan.dtype).str,
+                   'field_shapes': list(zip(scan.field_heights, scan.field_widths)),
+                   'calibration': repr(scan.calibration)}
+    return json.dumps(_to_builtin(fingerprint))
+
+
+def _compress_hdf5_chunks(scan, field_list, chunks_per_field, frame_slice, level):
+    """ Read a chunk of frames for all fields and compress it into hdf5 chunks.
+
+    Returns:
+        List of (field_id, chunk_offset, bytes) with the offset of each chunk in the
+            dataset.
+    """
+    frame_list = list(range(frame_slice.start, frame_slice.stop))
+    blocks = scan._read_fields(field_list, list(range(scan.num_channels)), frame_list)
+
+    chunks = []
+    for field_id, block in zip(field_list, blocks):
+        for (y, x, c), chunk in _iter_chunks(block, chunks_per_field[field_id]):
+            data = chunk.tobytes() if level is None else zlib.compress(chunk, level)
+            chunks.append((field_id, (y, x, c, frame_slice.start), data))
+    return chunks
@@ -0,0 +1,95 @@
+"""
+Bounded pool of open files for scans split into many tiff files.
+
+Long recordings can be split into thousands of files; keeping all of them open hits the
+limit on file descriptors and holding a TiffFile per file costs memory and startup time.
+Files are opened on demand and only the most recently used ones are kept open; what we
+need to know about the rest is in their (compact) page indices (see pages.py).
+"""
+from contextlib import contextmanager
+import collections
+import threading
+
+DEFAULT_MAX_OPEN_FILES = 128
+
+
+class FilePool:
+    """ Opens files on demand keeping at most max_open of them open (least recently used
+    files are closed first). Safe to use from several threads.
+
+    Attributes:
+        filenames: List of strings. Files in the pool.
+        opener: Function. Called with a filename, returns an object with a close() method
+            (e.g., a binary file object or a tifffile.TiffFile).
+        max_open: Integer. Maximum number of files kept open. Files in use (see open) are
+            never closed so this can be exceeded while many threads read different files.
+
+    Example:
+        pool = FilePool(filenames, lambda filename: open(filename, 'rb'))
+        with pool.open(3) as file_handle:
+            # read from the fourth file
+        pool.close()
+    """
+    def __init__(self, filenames, opener, max_open=DEFAULT_MAX_OPEN_FILES):
+        self.filenames = filenames
+        self.opener = opener
+        self.max_open = max_open
+        self._open_files = collections.OrderedDict() # least recently used first
+        self._num_users = collections.Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def num_open(self):
+        return len(self._open_files)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, file_id):
+        """ Open file. It could be closed once max_open other files are requested; use
+        open() to keep it open while in use."""
+        with self._lock:
+            return self._get(file_id)
+
+    def is_open(self, file_id):
+        """ Whether the file is currently open."""
+        return range(len(self.filenames))[file_id] in self._open_files
+
+    @contextmanager
+    def open(self, file_id):
+        """ Context manager with the open file; it won't be closed while in use."""
+        file_id = range(len(self.filenames))[file_id] # same key for negative indices
+        with self._lock:
+            file = self._get(file_id)
+            self._num_users[file_id] += 1
+        try:
+            yield file
+        finally:
+            with self._lock:
+                self._num_users[file_id] -= 1
+                self._evict()
+
+    def close(self):
+        """ Close all open files."""
+        with self._lock:
+            for file in self._open_files.values():
+                file.close()
+            self._open_files.clear()
+
+    def _get(self, file_id):
+        file_id = range(len(self.filenames))[file_id] # normalize negative indices
+        if file_id in self._open_files:
+            self._open_files.move_to_end(file_id)
+        else:
+            self._open_files[file_id] = self.opener(self.filenames[file_id])
+            self._evict()
+        return self._open_files[file_id]
+
+    def _evict(self):
+        """ Close least recently used files (not in use) until at most max_open are open."""
+        most_recent = next(reversed(self._open_files), None)
+        for file_id in list(self._open_files):
+            if len(self._open_files) <= self.max_open:
+                break
+            if self._num_users[file_id] == 0 and file_id != most_recent:
+                self._open_files.pop(file_id).close()
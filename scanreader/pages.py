@@ -0,0 +1,398 @@
+"""
+Compact index of the pages in a tiff file and raw reads of their image data.
+
+ScanImage writes every page uncompressed, with one sample per pixel and all pages in a
+file sharing shape and data type. Once we know where the image data of each page starts
+we can read a page (or a band of rows of it) straight from disk without building
+tifffile page objects. The index is a few numpy arrays so it is cheap to keep around,
+pickle and send to other processes.
+"""
+import json
+import os
+import struct
+import threading
+import numpy as np
+
+# Size in bytes and struct format of the tiff data types found in the tags we parse
+_TAG_TYPES = {1: (1, 'B'), 2: (1, 's'), 3: (2, 'H'), 4: (4, 'I'), 8: (2, 'h'), 9: (4, 'i'),
+              16: (8, 'Q'), 17: (8, 'q')}
+_SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+_INDEX_TAGS = (256, 257, 258, 259, 273, 277, 279, 339) # shape, dtype and strips
+_SCANIMAGE_MAGIC = 0x07030301 # start of the ScanImage metadata block (2016 and beyond)
+_LAYOUT_NAMES = ('shape', 'bits per sample', 'sample format', 'compression',
+                 'samples per pixel', 'image data bytes') # compared by check_pages
+
+_seek_lock = threading.Lock()  # only used where os.pread is not available
+
+
+class _IncompleteError(ValueError):
+    """ An IFD or the image data of a page extends past the end of the file."""
+    pass
+
+
+class PageIndex:
+    """ Location of the image data of every page in a tiff file.
+
+    Attributes:
+        filename: String. Absolute path to the tiff file.
+        offsets: Array of integers. Byte offset of the image data of each page.
+        height: Integer. Height of every page.
+        width: Integer. Width of every page.
+        dtype: Numpy dtype (with byte order) of the pixels stored in the file.
+        is_contiguous: Boolean. Whether every page is uncompressed and stored in a
+            single run of bytes. If False, pages have to be read with tifffile.
+        file_size: Integer. Size of the file (in bytes) when it was indexed.
+        last_ifd_offset: Integer. Offset of the IFD of the last indexed page. Pages
+            appended to the file are chained after it.
+        truncation: String or None. Why indexing stopped before the end of the chain of
+            IFDs (the page that is incomplete or corrupt) or None if it reached the end.
+    """
+    def __init__(self, filename, offsets, height, width, dtype, is_contiguous=True,
+                 file_size=None, last_ifd_offset=None, truncation=None):
+        self.filename = filename
+        self.offsets = offsets
+        self.height = height
+        self.width = width
+        self.dtype = dtype
+        self.is_contiguous = is_contiguous
+        self.file_size = file_size
+        self.last_ifd_offset = last_ifd_offset
+        self.truncation = truncation
+
+    @property
+    def num_pages(self):
+        return len(self.offsets)
+
+    @property
+    def page_nbytes(self):
+        return self.height * self.width * self.dtype.itemsize
+
+    def read_page(self, fh, page, yslice=slice(None)):
+        """ Read one page from disk, only loading the rows in yslice.
+
+        Args:
+            fh: File object opened on self.filename in binary mode.
+            page: Integer. Index of the page in this file.
+            yslice: Slice object. Rows of the page to read.
+
+        Returns:
+            A 2-d array (rows, width) with the file's dtype. Read-only.
+        """
+        start, stop, step = yslice.indices(self.height)
+        if step < 0:  # read the whole band and flip it
+            return self.read_page(fh, page, slice(stop + 1, start + 1))[::step]
+        if stop <= start:
+            return np.empty([0, self.width], dtype=self.dtype)
+
+        row_nbytes = self.width * self.dtype.itemsize
+        offset = int(self.offsets[page]) + start * row_nbytes
+        buffer = read_at(fh, offset, (stop - start) * row_nbytes)
+        rows = np.frombuffer(buffer, dtype=self.dtype).reshape(stop - start, self.width)
+
+        return rows[::step]
+
+
+def index_pages(filename, stop_at_incomplete=False, previous_index=None):
+    """ Walk the IFD chain of a tiff file recording where each page's data starts.
+
+    Only the first page is fully parsed (shape, data type, compression); for the rest we
+    only look at their strip offsets and byte counts.
+
+    Args:
+        filename: String. Tiff filename.
+        stop_at_incomplete: Boolean. If True, the walk stops quietly at the first page
+            whose IFD or image data is not (yet) fully in the file, e.g., the page being
+            written by ScanImage or the last page of a file truncated by a crash (see
+            PageIndex.truncation); files whose tiff header is not complete yet have no
+            pages. If False, that raises an error.
+        previous_index: PageIndex. Index of this same file taken before more pages were
+            appended to it. The walk resumes after its last page, so only new pages are
+            parsed.
+
+    Returns:
+        A PageIndex object.
+    """
+    with open(filename, 'rb') as fh:
+        file_size = os.fstat(fh.fileno()).st_size
+        try:
+            byteorder, is_bigtiff, ifd_offset = _read_tiff_header(fh)
+        except _IncompleteError as error: # e.g., a file ScanImage just created
+            if stop_at_incomplete:
+                return PageIndex(filename, np.empty(0, dtype=np.int64), None, None, None,
+                                 file_size=file_size, truncation=str(error))
+            raise
+
+        offsets = []
+        is_contiguous = True
+        height = width = dtype = last_ifd_offset = None
+        if previous_index is not None and previous_index.num_pages > 0:
+            height, width = previous_index.height, previous_index.width
+            dtype, is_contiguous = previous_index.dtype, previous_index.is_contiguous
+            last_ifd_offset = previous_index.last_ifd_offset
+            # its pointer to the next IFD may have been written since it was indexed
+            ifd_offset = _read_ifd(fh, last_ifd_offset, byteorder, is_bigtiff)[1]
+
+        layout = None # of the last IFD read with _read_ifd
+        truncation = None
+        while ifd_offset != 0:
+            try:
+                strip = layout and _read_single_strip(fh, ifd_offset, byteorder,
+                                                      is_bigtiff, layout)
+                if strip: # same layout as previous page
+                    strip_offsets, strip_bytecounts = [strip[0]], [strip[1]]
+                    next_ifd_offset = strip[2]
+                else:
+                    tags, next_ifd_offset = _read_ifd(fh, ifd_offset, byteorder,
+                                                      is_bigtiff)
+                    strip_offsets = tags.get(273)
+                    strip_bytecounts = tags.get(279)
+                    layout = _ifd_layout(fh, ifd_offset, byteorder, is_bigtiff)
+                if strip_offsets is None or strip_bytecounts is None:
+                    # not stored in strips (e.g., tiled): leave decoding it to tifffile
+                    strip_offsets = strip_bytecounts = None
+                    is_contiguous = False
+                elif max(o + b for o, b in zip(strip_offsets, strip_bytecounts)) > file_size:
+                    raise _IncompleteError('Image data of IFD at {} in {} is '
+                                           'truncated'.format(ifd_offset, filename))
+            except (_IncompleteError, struct.error) as error:
+                if stop_at_incomplete:
+                    truncation = 'page {} (IFD at byte {}): {}'.format(
+                        len(offsets) + (0 if previous_index is None else
+                                        previous_index.num_pages), ifd_offset,
+                        error or type(error).__name__)
+                    break
+                raise
+            last_ifd_offset, ifd_offset = ifd_offset, next_ifd_offset
+
+            if dtype is None:  # first page
+                height, width = tags[257][0], tags[256][0]
+                bits_per_sample = tags.get(258, [1])[0]
+                sample_format = _SAMPLE_FORMATS.get(tags.get(339, [1])[0], 'u')
+                dtype = np.dtype('{}{}{}'.format(byteorder, sample_format,
+                                                 bits_per_sample // 8))
+                is_contiguous = (tags.get(259, [1])[0] == 1 and
+                                 tags.get(277, [1])[0] == 1 and bits_per_sample % 8 == 0
+                                 and strip_offsets is not None)
+
+            if strip_offsets is None:
+                offsets.append(0) # pages are only read through tifffile
+                continue
+            is_contiguous = is_contiguous and all(o1 + b1 == o2 for o1, b1, o2 in
+                                                  zip(strip_offsets, strip_bytecounts,
+                                                      strip_offsets[1:]))
+            offsets.append(strip_offsets[0])
+
+    offsets = np.array(offsets, dtype=np.int64)
+    if previous_index is not None:
+        offsets = np.concatenate([previous_index.offsets, offsets])
+
+    return PageIndex(filename, offsets, height, width, dtype, is_contiguous, file_size,
+                     last_ifd_offset, truncation)
+
+
+def check_pages(filename, num_pages=None):
+    """ Fully parse the IFD of every page looking for pages that differ from the first
+    one in shape, data type, compression or size of their image data (index_pages only
+    parses the first page and assumes the rest are alike).
+
+    Args:
+        filename: String. Tiff filename.
+        num_pages: Integer. Number of pages to check (e.g., the complete pages found by
+            index_pages). None checks every page.
+
+    Returns:
+        A list of (page, description) tuples, one per page that differs from the first
+            one; description says how it differs.
+    """
+    mismatches = []
+    with open(filename, 'rb') as fh:
+        byteorder, is_bigtiff, ifd_offset = _read_tiff_header(fh)
+        first_layout = None
+        page = 0
+        while ifd_offset != 0 and (num_pages is None or page < num_pages):
+            tags, ifd_offset = _read_ifd(fh, ifd_offset, byteorder, is_bigtiff)
+            layout = _page_layout(tags)
+            if first_layout is None:
+                first_layout = layout
+            elif layout != first_layout:
+                mismatches.append((page, ', '.join(
+                    '{} {} (first page: {})'.format(name, value, first_value) for name,
+                    value, first_value in zip(_LAYOUT_NAMES, layout, first_layout)
+                    if value != first_value)))
+            page += 1
+
+    return mismatches
+
+
+def _page_layout(tags):
+    """ Shape, data type, compression and size of the image data of a page (see
+    _LAYOUT_NAMES) from the tags of its IFD."""
+    return ((tags.get(257, [None])[0], tags.get(256, [None])[0]), tags.get(258, [1])[0],
+            tags.get(339, [1])[0], tags.get(259, [1])[0], tags.get(277, [1])[0],
+            sum(tags.get(279, [])))
+
+
+def _read_tiff_header(fh):
+    """ Returns byteorder ('<' or '>'), whether it is a BigTIFF and first IFD offset."""
+    fh.seek(0)
+    header = fh.read(16)
+    byteorder = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if byteorder is None and len(header) >= 2:
+        raise ValueError('{} is not a tiff file'.format(fh.name))
+    version = struct.unpack(byteorder + 'H', header[2:4])[0] if len(header) >= 4 else None
+    if len(header) < (16 if version == 43 else 8):
+        raise _IncompleteError('Tiff header of {} is truncated'.format(fh.name))
+    if version == 43:
+        return byteorder, True, struct.unpack(byteorder + 'Q', header[8:16])[0]
+    else:
+        return byteorder, False, struct.unpack(byteorder + 'I', header[4:8])[0]
+
+
+def _read_ifd(fh, ifd_offset, byteorder, is_bigtiff, codes=_INDEX_TAGS):
+    """ Read the tags we care about in the IFD at ifd_offset.
+
+    Args:
+        codes: Tuple of integers. Tags to read.
+
+    Returns:
+        tags: Dictionary. Tag code to list of values (numeric tags) or to a one-item list
+            with the bytes of ASCII tags.
+        next_ifd_offset: Integer. Offset of the next IFD (0 if this is the last one).
+    """
+    count_fmt, entry_fmt, entry_size, value_size = (('Q', 'HHQ', 20, 8) if is_bigtiff
+                                                    else ('H', 'HHI', 12, 4))
+    count_size = struct.calcsize(count_fmt)
+    offset_fmt = byteorder + ('Q' if is_bigtiff else 'I')
+    entry_struct = struct.Struct(byteorder + entry_fmt)
+
+    fh.seek(ifd_offset)
+    num_entries = struct.unpack(byteorder + count_fmt, fh.read(count_size))[0]
+    ifd = fh.read(num_entries * entry_size + value_size)
+    if len(ifd) < num_entries * entry_size + value_size:
+        raise _IncompleteError('IFD at {} in {} is truncated'.format(ifd_offset, fh.name))
+
+    tags = {}
+    for entry_offset in range(0, num_entries * entry_size, entry_size):
+        code, type_, count = entry_struct.unpack_from(ifd, entry_offset)
+        if code not in codes or type_ not in _TAG_TYPES:
+            continue
+        item_size, item_fmt = _TAG_TYPES[type_]
+        values_fmt = '{}{}{}'.format(byteorder, count, item_fmt)
+        values_start = entry_offset + entry_size - value_size
+        if count * item_size <= value_size:  # values stored inline
+            values = ifd[values_start: values_start + count * item_size]
+        else:
+            values_offset = struct.unpack_from(offset_fmt, ifd, values_start)[0]
+            position = fh.tell()
+            fh.seek(values_offset)
+            values = fh.read(count * item_size)
+            fh.seek(position)
+        tags[code] = list(struct.unpack(values_fmt, values))
+    next_ifd_offset = struct.unpack(offset_fmt, ifd[-value_size:])[0]
+
+    return tags, next_ifd_offset
+
+
+def _ifd_layout(fh, ifd_offset, byteorder, is_bigtiff):
+    """ Number of entries in the IFD at ifd_offset and position of its strip offsets and
+    strip byte counts entries. None if the page is not stored in a single strip."""
+    count_fmt, entry_fmt, entry_size, value_size = (('Q', 'HHQ', 20, 8) if is_bigtiff
+                                                    else ('H', 'HHI', 12, 4))
+    fh.seek(ifd_offset)
+    count_size = struct.calcsize(count_fmt)
+    num_entries = struct.unpack(byteorder + count_fmt, fh.read(count_size))[0]
+    entries = fh.read(num_entries * entry_size)
+    entry_struct = struct.Struct(byteorder + entry_fmt)
+
+    positions = {}
+    for i in range(num_entries):
+        code, type_, count = entry_struct.unpack_from(entries, i * entry_size)
+        if code in (273, 279) and count == 1 and type_ in _TAG_TYPES and type_ != 2:
+            positions[code] = i
+    if len(positions) < 2:
+        return None
+
+    return num_entries, positions[273], positions[279]
+
+
+def _read_single_strip(fh, ifd_offset, byteorder, is_bigtiff, layout):
+    """ Fast path of _read_ifd for IFDs laid out like a previous one (ScanImage writes the
+    same tags in every page): read the strip entries directly where we expect them.
+
+    Args:
+        layout: Tuple. Number of entries in the IFD and position of the strip offsets and
+            strip byte counts entries (see _ifd_layout).
+
+    Returns:
+        (strip_offset, strip_bytecount, next_ifd_offset) or None if the IFD does not
+            have that layout.
+    """
+    count_fmt, entry_fmt, entry_size, value_size = (('Q', 'HHQ', 20, 8) if is_bigtiff
+                                                    else ('H', 'HHI', 12, 4))
+    count_size = struct.calcsize(count_fmt)
+    num_entries, offsets_entry, bytecounts_entry = layout
+
+    fh.seek(ifd_offset)
+    ifd = fh.read(count_size + num_entries * entry_size + value_size)
+    if (len(ifd) < count_size + num_entries * entry_size + value_size or
+            struct.unpack_from(byteorder + count_fmt, ifd)[0] != num_entries):
+        return None
+
+    values = []
+    for code, entry in [(273, offsets_entry), (279, bytecounts_entry)]:
+        entry_offset = count_size + entry * entry_size
+        entry_code, type_, count = struct.unpack_from(byteorder + entry_fmt, ifd,
+                                                      entry_offset)
+        if entry_code != code or count != 1 or type_ not in _TAG_TYPES or type_ == 2:
+            return None
+        values.append(struct.unpack_from(byteorder + _TAG_TYPES[type_][1], ifd,
+                                         entry_offset + entry_size - value_size)[0])
+    next_ifd_offset = struct.unpack_from(byteorder + ('Q' if is_bigtiff else 'I'), ifd,
+                                         count_size + num_entries * entry_size)[0]
+
+    return values[0], values[1], next_ifd_offset
+
+
+def read_scanimage_header(filename):
+    """ Read the ScanImage metadata of a tiff file with a single open and a few raw reads:
+    the ImageDescription and Software tags of the first page and the ROI metadata block
+    that ScanImage (2016 and beyond) writes right after the tiff header.
+
+    Returns:
+        header: String. Description and software tags separated by a newline.
+        roi_metadata: Dictionary with the ROI metadata (e.g., 'RoiGroups') or None if the
+            file has no ROI metadata block.
+    """
+    with open(filename, 'rb') as fh:
+        byteorder, is_bigtiff, ifd_offset = _read_tiff_header(fh)
+        tags, _ = _read_ifd(fh, ifd_offset, byteorder, is_bigtiff, codes=(270, 305))
+        description, software = [tags.get(code, [b''])[0].rstrip(b'\0').strip() for code
+                                 in (270, 305)]
+        header = '{}\n{}'.format(description.decode('cp1252'), software.decode('cp1252'))
+
+        roi_metadata = None
+        fh.seek(16)
+        block_header = fh.read(16)
+        if byteorder == '<' and is_bigtiff and len(block_header) == 16:
+            magic, version, frame_data_size, roi_data_size = struct.unpack('<IIII',
+                                                                           block_header)
+            if magic == _SCANIMAGE_MAGIC and version in (3, 4):
+                fh.seek(32 + frame_data_size)
+                roi_data = fh.read(roi_data_size).rstrip(b'\0')
+                roi_metadata = json.loads(roi_data.decode('utf-8')) if roi_data else {}
+
+    return header, roi_metadata
+
+
+def read_at(fh, offset, nbytes):
+    """ Read nbytes from fh starting at offset. Safe to call from several threads."""
+    if hasattr(os, 'pread'):
+        buffer = os.pread(fh.fileno(), nbytes, offset)
+    else:
+        with _seek_lock:
+            fh.seek(offset)
+            buffer = fh.read(nbytes)
+    if len(buffer) < nbytes:
+        raise EOFError('Could not read {} bytes at offset {} in {}'.format(nbytes, offset,
+                                                                          fh.name))
+    return buffer
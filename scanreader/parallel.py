@@ -0,0 +1,255 @@
+"""
+Helpers to spread work over chunks of a scan across a pool of threads or processes.
+
+Work is expressed as module-level functions with signature func(scan, *args). With a
+process pool the scan is pickled once per worker (see BaseScan.__getstate__) and
+installed there, so tasks only ship their (small) arguments.
+"""
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import collections
+import os
+import numpy as np
+from .progress import Progress, tracking, new_progress
+from .exceptions import MemoryBudgetError
+
+_worker_scan = None # scan used by tasks running in a worker process
+DEFAULT_CHUNK_NBYTES = 64 * 1024 ** 2 # bytes read per chunk if chunk_frames is not given
+
+
+def _install_scan(scan):
+    global _worker_scan
+    _worker_scan = scan
+
+
+def _call_with_worker_scan(func, args, is_tracked=False):
+    if not is_tracked:
+        return func(_worker_scan, *args)
+
+    # count pages read here and send the counts back with the result
+    counter = Progress()
+    with tracking(counter):
+        result = func(_worker_scan, *args)
+    return result, counter.pages_done, counter.bytes_done
+
+
+def _call_tracked(progress, func, scan, args):
+    with tracking(progress):
+        return func(scan, *args)
+
+
+class ChunkPool:
+    """ Runs func(scan, *args) over many args keeping a bounded number of tasks in flight.
+
+    Results of tasks still in flight are the only thing held in memory, so peak memory
+    is roughly max_in_flight times the memory used by a single task.
+
+    Attributes:
+        scan: Scan object passed as first argument to every task.
+        workers: Integer. Number of threads/processes; -1 uses all CPUs. None or 1 runs
+            tasks serially in the calling thread.
+        executor: String. 'thread' or 'process'.
+        max_in_flight: Integer. Maximum number of tasks submitted but not yet consumed.
+            Defaults to twice the number of workers.
+        progress: Progress object (see progress.py) or None. Pages read by the tasks are
+            reported to it and it is checked for cancellation before every task.
+
+    Example:
+        with ChunkPool(scan, workers=8) as pool:
+            for result in pool.imap(func, [(0, slice(0, 100)), (0, slice(100, 200))]):
+                # consume result
+    """
+    def __init__(self, scan, workers=None, executor='thread', max_in_flight=None,
+                 progress=None):
+        if executor not in ['thread', 'process']:
+            raise ValueError("executor should be 'thread' or 'process', received "
+                             "{}".format(executor))
+        self.scan = scan
+        self.workers = os.cpu_count() if workers == -1 else workers
+        self.executor = executor
+        self.max_in_flight = max_in_flight or default_max_in_flight(workers)
+        self.progress = progress
+        self._pool = None
+
+    @property
+    def is_serial(self):
+        return self.workers is None or self.workers <= 1
+
+    def __enter__(self):
+        if self.is_serial:
+            self._pool = None
+        elif self.executor == 'thread':
+            self._pool = ThreadPoolExecutor(self.workers)
+        else:
+            self._pool = ProcessPoolExecutor(self.workers, initializer=_install_scan,
+                                             initargs=(self.scan,))
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def _submit(self, func, args):
+        if self.progress is not None:
+            self.progress.check()
+        if self.executor == 'thread':
+            return self._pool.submit(_call_tracked, self.progress, func, self.scan, args)
+        else:
+            return self._pool.submit(_call_with_worker_scan, func, args,
+                                     self.progress is not None)
+
+    def _result(self, future):
+        if self.executor == 'process' and self.progress is not None:
+            result, num_pages, nbytes = future.result()
+            self.progress.update(num_pages, nbytes)
+            return result
+        return future.result()
+
+    def imap(self, func, args_list, ordered=True):
+        """ Generator with func(scan, *args) for each args in args_list.
+
+        Args:
+            func: Function. Module-level function (picklable if executor is 'process').
+            args_list: Iterable of tuples. Arguments for each task.
+            ordered: Boolean. Yield results in the order of args_list. If False, they are
+                yielded as soon as they are ready.
+        """
+        if self.is_serial:
+            for args in args_list:
+                if self.progress is not None:
+                    self.progress.check()
+                yield _call_tracked(self.progress, func, self.scan, args)
+            return
+
+        args_iter = iter(args_list)
+        in_flight = collections.deque()
+        for args in args_iter: # fill the pipeline
+            in_flight.append(self._submit(func, args))
+            if len(in_flight) >= self.max_in_flight:
+                break
+
+        while in_flight:
+            if ordered:
+                future = in_flight.popleft()
+            else:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                future = next(f for f in in_flight if f in done)
+                in_flight.remove(future)
+            result = self._result(future)
+
+            next_args = next(args_iter, None)
+            if next_args is not None:
+                in_flight.append(self._submit(func, next_args))
+
+            yield result
+
+
+def frame_chunks(num_frames, chunk_frames):
+    """ Split range(num_frames) into consecutive slices of at most chunk_frames frames."""
+    return [slice(start, min(start + chunk_frames, num_frames)) for start in
+            range(0, num_frames, chunk_frames)]
+
+
+def default_chunk_frames(scan, field_list, num_channels, chunk_nbytes=DEFAULT_CHUNK_NBYTES):
+    """ Number of frames such that a chunk with all fields in field_list is ~chunk_nbytes."""
+    frame_nbytes = sum(scan.field_heights[field_id] * scan.field_widths[field_id] for
+                       field_id in field_list) * num_channels * np.dtype(scan.dtype).itemsize
+    return int(max(1, chunk_nbytes // max(frame_nbytes, 1)))
+
+
+def default_max_in_flight(workers):
+    """ Number of tasks a ChunkPool with this many workers keeps in flight."""
+    workers = os.cpu_count() if workers == -1 else workers
+    return 2 * (workers or 1)
+
+
+def fit_chunk_frames(scan, field_list, num_channels, chunk_frames=None, workers=None):
+    """ Number of frames to read per chunk of a chunked operation.
+
+    If chunk_frames is None, chunks are ~DEFAULT_CHUNK_NBYTES. If the scan has a memory
+    budget (scan.max_memory), chunks are made small enough that every chunk in flight
+    (a read buffer plus its output) fits in it.
+
+    Raises:
+        MemoryBudgetError: If chunk_frames (or a single frame) does not fit the budget.
+    """
+    max_memory = scan.max_memory
+    frame_nbytes = sum(scan.field_heights[field_id] * scan.field_widths[field_id] for
+                       field_id in field_list) * num_channels * np.dtype(scan.dtype).itemsize
+    is_serial = workers is None or (workers != -1 and workers <= 1)
+    num_in_flight = 1 if is_serial else default_max_in_flight(workers)
+    chunk_budget = None if max_memory is None else max_memory // (2 * num_in_flight)
+    if chunk_frames is None:
+        chunk_frames = default_chunk_frames(scan, field_list, num_channels)
+        if chunk_budget is not None:
+            chunk_frames = int(max(1, min(chunk_frames, chunk_budget // max(frame_nbytes,
+                                                                            1))))
+
+    if chunk_budget is not None and chunk_frames * frame_nbytes > chunk_budget:
+        raise MemoryBudgetError('{} chunks of {} frames ({} bytes each) do not fit in the '
+                                'memory budget of the scan ({} bytes); use fewer frames '
+                                'per chunk, fewer workers or fewer '
+                                'fields/channels.'.format(num_in_flight, chunk_frames,
+                                                          chunk_frames * frame_nbytes,
+                                                          max_memory))
+    return chunk_frames
+
+
+def as_list(index, dim_size):
+    """ List of indices in index (integer, list or None for all) for a dimension of
+    size dim_size."""
+    return list(range(dim_size)) if index is None else np.atleast_1d(index).tolist()
+
+
+def map_blocks(scan, func, fields=None, channels=None, chunk_frames=None, workers=None,
+               executor='thread', ordered=True, progress=None, cancel=None):
+    """ Apply func to every chunk of frames of every field, spreading chunks over a pool.
+
+    Args:
+        scan: Scan object.
+        func: Function. Called as func(block) with block = scan[field_id, :, :, channels,
+            frames] for each field and chunk of frames. Must be picklable (module-level)
+            if executor is 'process'.
+        fields: Integer, list of integers or None. Fields to process. None for all.
+        channels: Integer, list of integers or None. Channels in each block. None for all.
+            If an integer, blocks have no channel axis (as in scan[...]).
+        chunk_frames: Integer. Number of frames per block. Default reads ~64 MB per chunk
+            (all requested fields) or less to fit scan.max_memory.
+        workers: Integer. Number of threads/processes. None runs serially.
+        executor: String. 'thread' or 'process'.
+        ordered: Boolean. Yield results in (chunk, field) order. If False, chunks are
+            yielded as soon as they are done.
+        progress: Function or None. Called as progress(pages_done, total_pages,
+            bytes_done) as pages are read (see progress.py).
+        cancel: progress.CancelToken or None. Once cancelled, the operation stops with
+            ReadCancelled before reading the next chunk or batch of pages.
+
+    Yields:
+        (field_id, frames, result) tuples. frames is a slice object with the frames in the
+            block; result is the output of func(block).
+    """
+    field_list = as_list(fields, scan.num_fields)
+    channel_list = as_list(channels, scan.num_channels)
+    chunk_frames = fit_chunk_frames(scan, field_list, len(channel_list), chunk_frames,
+                                    workers)
+    drop_channel = np.issubdtype(type(channels), np.signedinteger)
+
+    tasks = [(func, field_list, channel_list, frame_slice, drop_channel) for frame_slice
+             in frame_chunks(scan.num_frames, chunk_frames)]
+    tracker = new_progress(progress, cancel, scan._count_pages(field_list, channel_list,
+                                                               scan.num_frames))
+    with ChunkPool(scan, workers=workers, executor=executor, progress=tracker) as pool:
+        for results in pool.imap(_map_chunk, tasks, ordered=ordered):
+            yield from results
+
+
+def _map_chunk(scan, func, field_list, channel_list, frame_slice, drop_channel):
+    """ Read one chunk of frames for all fields and apply func to each field."""
+    frame_list = list(range(frame_slice.start, frame_slice.stop))
+    blocks = scan._read_fields(field_list, channel_list, frame_list)
+
+    results = []
+    for field_id, block in zip(field_list, blocks):
+        block = block[:, :, 0] if drop_channel else block
+        results.append((field_id, frame_slice, func(block)))
+    return results
@@ -0,0 +1,184 @@
+"""
+Read plans: scan[field, y, x, channel, frames] precomputed for a fixed spatial key.
+
+Code that reads the same pixels over and over for different frame windows (e.g., trace
+extraction) pays for key validation, listifying indices, working out which rows of which
+pages hold each subfield and building the list of pages on every call. A plan does all
+that once; reading a new frame window only computes page numbers (vectorized), reads
+them and copies them into the output (with basic slicing unless the key has irregular
+lists of indices).
+"""
+import numpy as np
+from . import utils
+from . import stats
+from .progress import new_progress, tracking
+from .exceptions import FieldDimensionMismatch
+
+
+class ReadPlan:
+    """ Precomputed read of scan[field, y, x, channel, frames] for any frames.
+
+    Attributes:
+        scan: Scan object.
+        shape: Tuple. Shape of the output (before dropping integer-indexed axes) without
+            the frame dimension: (fields, y, x, channels).
+
+    Example:
+        plan = scan.plan((0, slice(10, 50), slice(20, 60), 0))
+        plan[1000:2000]     same as scan[0, 10:50, 20:60, 0, 1000:2000]
+        plan.read(slice(1000, 2000), progress=callback)     same, reporting progress
+    """
+    def __init__(self, scan, key):
+        self.scan = scan
+
+        # Fill key to size 4 (raises IndexError if more than 4)
+        full_key = utils.fill_key(key, num_dimensions=4)
+
+        # Check index types are valid
+        for i, index in enumerate(full_key):
+            utils.check_index_type(i, index)
+
+        # Check each dimension is in bounds
+        utils.check_index_is_in_bounds(0, full_key[0], scan.num_fields)
+        field_list = utils.listify_index(full_key[0], scan.num_fields)
+        for field_id in field_list:
+            utils.check_index_is_in_bounds(1, full_key[1], scan.field_heights[field_id])
+            utils.check_index_is_in_bounds(2, full_key[2], scan.field_widths[field_id])
+        utils.check_index_is_in_bounds(3, full_key[3], scan.num_channels)
+
+        # Get y, x and channels as lists
+        y_lists = [utils.listify_index(full_key[1], scan.field_heights[field_id]) for
+                   field_id in field_list]
+        x_lists = [utils.listify_index(full_key[2], scan.field_widths[field_id]) for
+                   field_id in field_list]
+        channel_list = utils.listify_index(full_key[3], scan.num_channels)
+        self._is_empty = [] in [field_list, *y_lists, *x_lists, channel_list]
+        if not self._is_empty:
+            if not all(len(y_list) == len(y_lists[0]) for y_list in y_lists):
+                raise FieldDimensionMismatch('Image heights for all fields do not match')
+            if not all(len(x_list) == len(x_lists[0]) for x_list in x_lists):
+                raise FieldDimensionMismatch('Image widths for all fields do not match')
+            self.shape = (len(field_list), len(y_lists[0]), len(x_lists[0]),
+                          len(channel_list))
+        self._squeeze_dims = [i for i, index in enumerate(full_key) if
+                              np.issubdtype(type(index), np.signedinteger)]
+
+        # Precompute what to read (and where to put it) from each subfield
+        slice_step, self._frame_step = scan._page_steps
+        self._reads = []
+        for i, (field_id, y_list, x_list) in enumerate(zip(field_list, y_lists, x_lists)):
+            for slice_id, yslice, xslice, output_yslice, output_xslice in scan._field_regions(
+                    field_id):
+                output_ys, ys = _subfield_indices(y_list, output_yslice)
+                output_xs, xs = _subfield_indices(x_list, output_xslice)
+                if len(ys) == 0 or len(xs) == 0:
+                    continue
+
+                # Only read the rows and columns spanned by the requested pixels
+                page_yslice = slice(yslice.start + ys.min(), yslice.start + ys.max() + 1)
+                page_xslice = slice(xslice.start + xs.min(), xslice.start + xs.max() + 1)
+                page_pattern = slice_id * slice_step + np.array(channel_list)
+                self._reads.append((i, page_pattern, page_yslice, page_xslice,
+                                    _as_index(output_ys, output_xs),
+                                    _as_index(ys - ys.min(), xs - xs.min())))
+
+    def __getitem__(self, frames):
+        return self.read(frames)
+
+    def nbytes(self, frames=slice(None)):
+        """ Size in bytes of read(frames)."""
+        num_frames = len(utils.listify_index(frames, self.scan.num_frames))
+        if self._is_empty or num_frames == 0:
+            return 0
+        return int(np.prod(self.shape)) * num_frames * np.dtype(self.scan.dtype).itemsize
+
+    def num_pages(self, frames=slice(None)):
+        """ Number of pages read(frames) reads (repeated frames or channels are read
+        once)."""
+        num_frames = len(set(utils.listify_index(frames, self.scan.num_frames)))
+        if self._is_empty:
+            return 0
+        return sum(len(set(page_pattern)) for _, page_pattern, *_ in self._reads) * num_frames
+
+    def read(self, frames=slice(None), progress=None, cancel=None, out=None):
+        """ Read the planned pixels in the given frames.
+
+        Args:
+            frames: Integer, slice or list/tuple/array of integers. Frames to read.
+            progress: Function or None. Called as progress(pages_done, total_pages,
+                bytes_done) every few pages (see progress.py).
+            cancel: progress.CancelToken or None. Checked before reading from each file
+                and every few pages; raises ReadCancelled once cancelled.
+            out: Array or None. Array of shape (*self.shape, num_frames) to read into
+                (e.g., part of a larger output) rather than allocating a new one.
+
+        Returns:
+            A numpy array, the same as scan[key + (frames, )] (a view of out if given).
+        """
+        num_frames = self.scan.num_frames
+        utils.check_index_type(4, frames)
+        utils.check_index_is_in_bounds(4, frames, num_frames)
+        frame_list = utils.listify_index(frames, num_frames)
+        if self._is_empty or len(frame_list) == 0:
+            return np.empty(0)
+        if out is not None and out.shape != (*self.shape, len(frame_list)):
+            raise ValueError('out should have shape {}, received {}'.format(
+                (*self.shape, len(frame_list)), out.shape))
+
+        if out is None:
+            self.scan._check_memory(self.nbytes(frames))
+        tracker = new_progress(progress, cancel, self.num_pages(frames))
+        if tracker is not None:
+            tracker.check()
+            with tracking(tracker):
+                return self.read(frames, out=out)
+
+        read_stats = self.scan._stats
+        with stats.read(read_stats, 'plan'):
+            item = (np.empty([*self.shape, len(frame_list)], dtype=self.scan.dtype) if
+                    out is None else out)
+            frame_offsets = np.array(frame_list) * self._frame_step
+            for i, page_pattern, page_yslice, page_xslice, output_index, index in self._reads:
+                pages_to_read = (frame_offsets[:, None] + page_pattern).ravel().tolist()
+                pages = self.scan._read_page_list(pages_to_read, page_yslice, page_xslice)
+                pages = pages.reshape(len(frame_list), len(page_pattern), *pages.shape[1:])
+                with stats.stage(read_stats, 'scatter'):
+                    item[i][output_index] = pages.transpose([2, 3, 1, 0])[index]
+            if read_stats is not None and out is None:
+                read_stats.add(bytes_allocated=item.nbytes)
+
+        # If original index was an integer, delete that axis (as in numpy indexing)
+        squeeze_dims = self._squeeze_dims + ([4] if np.issubdtype(type(frames),
+                                                                  np.signedinteger) else [])
+        item = np.squeeze(item, axis=tuple(squeeze_dims))
+
+        return item
+
+
+def _subfield_indices(index_list, output_slice):
+    """ Positions in the output and in the subfield of the indices in index_list that fall
+    inside output_slice (the part of the field covered by the subfield)."""
+    indices = np.array(index_list)
+    is_in_subfield = (indices >= output_slice.start) & (indices < output_slice.stop)
+    return np.flatnonzero(is_in_subfield), indices[is_in_subfield] - output_slice.start
+
+
+def _as_index(ys, xs):
+    """ Index selecting rows ys and columns xs (the submatrix): basic slices where the
+    indices are evenly spaced (the usual case) so numpy copies whole blocks; index arrays
+    only for irregular lists."""
+    ys, xs = _as_slice(ys), _as_slice(xs)
+    if isinstance(ys, slice) or isinstance(xs, slice):
+        return ys, xs
+    return np.ix_(ys, xs)
+
+
+def _as_slice(indices):
+    """ Slice equivalent to an array of indices, or the array if there is none."""
+    if len(indices) == 1:
+        return slice(indices[0], indices[0] + 1)
+    step = indices[1] - indices[0]
+    if step == 0 or np.any(np.diff(indices) != step):
+        return indices
+    stop = indices[-1] + step
+    return slice(indices[0], stop if stop >= 0 else None, step)
@@ -0,0 +1,100 @@
+"""
+Progress reports and cancellation of long reads.
+
+Reads that accept progress/cancel arguments (scan.read, plan.read and the chunked
+operations: reduce, map_blocks, exports and pyramids) report how many pages (and bytes)
+they have read out of the total as they go and stop with ReadCancelled soon after their
+CancelToken is cancelled: the token is checked before reading from each file and after
+every batch of pages (and before every chunk in chunked operations).
+
+The Progress object of the read in progress is found through a context variable so it
+reaches _read_page_list without threading it through every layer in between. Chunk
+pools set it in their worker threads; worker processes count their pages locally and
+send the counts back with their results.
+"""
+import contextvars
+from contextlib import contextmanager
+import threading
+from .exceptions import ReadCancelled
+
+PAGES_PER_UPDATE = 64 # pages read between progress reports (and cancellation checks)
+
+_current = contextvars.ContextVar('progress', default=None)
+
+
+class CancelToken:
+    """ Flag to cancel reads from another thread (e.g., a GUI or a scheduler).
+
+    Example:
+        token = CancelToken()
+        # in another thread: token.cancel()
+        scan.read(0, cancel=token)    raises ReadCancelled once cancelled
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    @property
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+
+
+class Progress:
+    """ Pages and bytes read so far by a (possibly multithreaded) read.
+
+    Attributes:
+        callback: Function or None. Called as callback(pages_done, total_pages,
+            bytes_done) after every batch of pages.
+        total_pages: Integer. Pages the read will read.
+        cancel: CancelToken or None.
+        pages_done: Integer. Pages read so far.
+        bytes_done: Integer. Bytes of page data read so far.
+    """
+    def __init__(self, callback=None, total_pages=0, cancel=None):
+        self.callback = callback
+        self.total_pages = total_pages
+        self.cancel = cancel
+        self.pages_done = 0
+        self.bytes_done = 0
+        self._lock = threading.Lock()
+
+    def update(self, num_pages, nbytes):
+        """ Record num_pages more pages (nbytes bytes) read, report it and raise
+        ReadCancelled if the read was cancelled."""
+        with self._lock:
+            self.pages_done += num_pages
+            self.bytes_done += nbytes
+            pages_done, bytes_done = self.pages_done, self.bytes_done
+        if self.callback is not None:
+            self.callback(pages_done, self.total_pages, bytes_done)
+        self.check()
+
+    def check(self):
+        """ Raise ReadCancelled if the read was cancelled."""
+        if self.cancel is not None and self.cancel.is_cancelled:
+            raise ReadCancelled('Read cancelled after {} of {} pages'.format(
+                self.pages_done, self.total_pages))
+
+
+def current():
+    """ Progress of the read in progress in this context (None if not tracked)."""
+    return _current.get()
+
+
+@contextmanager
+def tracking(progress):
+    """ Make progress the current Progress (see current) inside the with block."""
+    token = _current.set(progress)
+    try:
+        yield progress
+    finally:
+        _current.reset(token)
+
+
+def new_progress(callback=None, cancel=None, total_pages=0):
+    """ Progress for a read or None if it is not tracked (no callback or token)."""
+    if callback is None and cancel is None:
+        return None
+    return Progress(callback, total_pages, cancel)
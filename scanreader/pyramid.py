@@ -0,0 +1,281 @@
+"""
+Multi-resolution pyramids of a scan for fast browsing.
+
+A pyramid stores every field at several levels, each one downsampled (by averaging) a
+given factor in y, x and another factor in time. Levels are built in a single streaming
+pass over the scan and saved as zarr (v2) arrays, so a viewer can serve any zoom level
+reading only a few small chunks.
+
+Layout of the store:
+    path/.zattrs                          scan metadata and description of the levels
+    path/field{i}/level{k}/.zarray        [y, x, channels, frames] array of level k
+
+Example:
+    scan.build_pyramid('/data/my_scan_pyramid', workers=8)
+    pyramid = scanreader.Pyramid('/data/my_scan_pyramid')
+    frames = pyramid.read(0, channel=0, out_shape=(128, 128, 100))  # coarsest level that
+                                                                    # gives >= 128x128x100
+"""
+import json
+import os
+import zlib
+import numpy as np
+from .exports import (scan_metadata, field_metadata, write_zarr_metadata,
+                      write_zarr_chunks, _write_json)
+from .parallel import ChunkPool, frame_chunks, fit_chunk_frames, as_list
+from .progress import new_progress
+
+DEFAULT_LEVELS = [(1, 1), (2, 2), (4, 4), (8, 8)] # (spatial factor, temporal factor)
+TILE_SIZE = 256 # chunk size in y and x
+
+
+def build_pyramid(scan, path, levels=DEFAULT_LEVELS, fields=None, chunk_frames=None,
+                  compression=None, compression_level=1, workers=None, executor='thread',
+                  progress=None, cancel=None):
+    """ Build a multi-resolution pyramid of every field in a single pass over the scan.
+
+    Args:
+        scan: Scan object.
+        path: String. Directory of the (zarr) store.
+        levels: List of integers or (spatial, temporal) tuples. Downsampling factors of
+            each level; an integer uses the same factor in space and time.
+        fields: Integer, list of integers or None. Fields to process. None for all.
+        chunk_frames: Integer. Number of frames read at a time (rounded up to a multiple
+            of every temporal factor). Default reads ~64 MB per chunk.
+        compression: String. None or 'zlib'.
+        compression_level: Integer. Compression level for zlib.
+        workers: Integer. Number of threads/processes. None runs serially.
+        executor: String. 'thread' or 'process'.
+        progress: Function or None. Called as progress(pages_done, total_pages,
+            bytes_done) as pages are read (see progress.py).
+        cancel: progress.CancelToken or None. Once cancelled, the operation stops with
+            ReadCancelled before reading the next chunk or batch of pages.
+
+    Returns:
+        A Pyramid object reading from path.
+    """
+    levels = [(level, level) if np.issubdtype(type(level), np.integer) else tuple(level)
+              for level in levels]
+    field_list = list(dict.fromkeys(as_list(fields, scan.num_fields)))
+    chunk_frames = fit_chunk_frames(scan, field_list, scan.num_channels, chunk_frames,
+                                    workers)
+    temporal_lcm = int(np.lcm.reduce([temporal for _, temporal in levels]))
+    chunk_frames = int(np.ceil(chunk_frames / temporal_lcm)) * temporal_lcm
+    fit_chunk_frames(scan, field_list, scan.num_channels, chunk_frames, workers)
+    compressor = None if compression is None else {'id': 'zlib', 'level':
+                                                   compression_level}
+
+    # Write metadata
+    os.makedirs(path, exist_ok=True)
+    _write_json(os.path.join(path, '.zgroup'), {'zarr_format': 2})
+    metadata = scan_metadata(scan)
+    metadata['levels'] = [{'spatial_factor': spatial, 'temporal_factor': temporal} for
+                          spatial, temporal in levels]
+    metadata['fields'] = field_list
+    _write_json(os.path.join(path, '.zattrs'), metadata)
+    chunks = {}
+    for field_id in field_list:
+        field_path = os.path.join(path, 'field{}'.format(field_id))
+        os.makedirs(field_path, exist_ok=True)
+        _write_json(os.path.join(field_path, '.zgroup'), {'zarr_format': 2})
+        _write_json(os.path.join(field_path, '.zattrs'), field_metadata(scan, field_id))
+        for level_id, (spatial, temporal) in enumerate(levels):
+            shape = _level_shape((scan.field_heights[field_id], scan.field_widths[field_id],
+                                  scan.num_channels, scan.num_frames), spatial, temporal)
+            chunks[(field_id, level_id)] = (min(TILE_SIZE, shape[0]),
+                                            min(TILE_SIZE, shape[1]), 1,
+                                            chunk_frames // temporal)
+            attrs = {'spatial_factor': spatial, 'temporal_factor': temporal,
+                     'axes': ['y', 'x', 'channel', 'frame']}
+            write_zarr_metadata(os.path.join(field_path, 'level{}'.format(level_id)), shape,
+                                chunks[(field_id, level_id)], scan.dtype, compressor, attrs)
+
+    # Stream chunks of frames, downsampling each into every level
+    tasks = [(path, field_list, levels, chunks, frame_slice, compressor) for frame_slice
+             in frame_chunks(scan.num_frames, chunk_frames)]
+    tracker = new_progress(progress, cancel, scan._count_pages(
+        field_list, range(scan.num_channels), scan.num_frames))
+    with ChunkPool(scan, workers=workers, executor=executor, progress=tracker) as pool:
+        for _ in pool.imap(_write_pyramid_chunks, tasks, ordered=False):
+            pass
+
+    return Pyramid(path)
+
+
+def _level_shape(shape, spatial, temporal):
+    height, width, num_channels, num_frames = shape
+    return (-(-height // spatial), -(-width // spatial), num_channels,
+            -(-num_frames // temporal))
+
+
+def _write_pyramid_chunks(scan, path, field_list, levels, chunks, frame_slice, compressor):
+    """ Read a chunk of frames of every field and write it at every level."""
+    frame_list = list(range(frame_slice.start, frame_slice.stop))
+    blocks = scan._read_fields(field_list, list(range(scan.num_channels)), frame_list)
+
+    for field_id, block in zip(field_list, blocks):
+        for level_id, (spatial, temporal) in enumerate(levels):
+            level_block = downsample(block, spatial, temporal).astype(scan.dtype,
+                                                                      copy=False)
+            chunk_shape = chunks[(field_id, level_id)]
+            array_path = os.path.join(path, 'field{}'.format(field_id),
+                                      'level{}'.format(level_id))
+            write_zarr_chunks(array_path, level_block, chunk_shape,
+                              (frame_slice.start // temporal) // chunk_shape[-1], compressor)
+
+
+def downsample(block, spatial, temporal):
+    """ Average a [y, x, channels, frames] block in bins of spatial x spatial pixels and
+    temporal frames. Bins at the edges average whatever pixels/frames are left. Integer
+    results are rounded."""
+    result = block
+    for axis, factor in [(0, spatial), (1, spatial), (3, temporal)]:
+        if factor > 1:
+            starts = np.arange(0, result.shape[axis], factor)
+            counts = np.diff(np.append(starts, result.shape[axis]))
+            counts_shape = [1] * result.ndim
+            counts_shape[axis] = -1
+            result = (np.add.reduceat(result, starts, axis=axis, dtype=np.float64) /
+                      counts.reshape(counts_shape))
+    if result is not block and np.issubdtype(block.dtype, np.integer):
+        result = np.round(result)
+    return result
+
+
+class Pyramid:
+    """ Reads a pyramid built with build_pyramid.
+
+    Attributes:
+        path: String. Directory of the pyramid.
+        metadata: Dictionary. Scan metadata and levels (as stored in .zattrs).
+        levels: List of (spatial factor, temporal factor) tuples.
+        fields: List of integers. Fields in the pyramid.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, '.zattrs')) as f:
+            self.metadata = json.load(f)
+        self.levels = [(level['spatial_factor'], level['temporal_factor']) for level in
+                       self.metadata['levels']]
+        self.fields = self.metadata['fields']
+        self._array_infos = {}
+
+    def field_shape(self, field_id):
+        """ Full resolution shape ([y, x, channels, frames]) of a field."""
+        with open(os.path.join(self.path, 'field{}'.format(field_id), '.zattrs')) as f:
+            field = json.load(f)
+        return (field['height'], field['width'], self.metadata['num_channels'],
+                self.metadata['num_frames'])
+
+    def level_shape(self, field_id, level_id):
+        """ Shape ([y, x, channels, frames]) of a field at a given level."""
+        return tuple(self._array_info(field_id, level_id)['shape'])
+
+    def select_level(self, field_id, out_shape=None, yslice=slice(None),
+                     xslice=slice(None), frames=slice(None)):
+        """ Coarsest level that gives at least out_shape pixels/frames for the region.
+
+        Args:
+            field_id: Integer. Field to read.
+            out_shape: Tuple. Minimum (height, width, num_frames) wanted; None entries (or
+                out_shape=None) ask for the full resolution in that dimension.
+            yslice, xslice, frames: Slice objects. Region (in full resolution coordinates).
+
+        Returns:
+            Integer. Index of the level.
+        """
+        full_shape = self.field_shape(field_id)
+        region = [len(range(*index.indices(size))) for index, size in
+                  zip([yslice, xslice, frames], [full_shape[0], full_shape[1],
+                                                 full_shape[3]])]
+        out_shape = out_shape or (None, None, None)
+        wanted = [region_size if out_size is None else min(out_size, region_size) for
+                  region_size, out_size in zip(region, out_shape)]
+
+        best_level, best_factor = None, None
+        for level_id, (spatial, temporal) in enumerate(self.levels):
+            level_size = [-(-region[0] // spatial), -(-region[1] // spatial),
+                          -(-region[2] // temporal)]
+            if all(size >= want for size, want in zip(level_size, wanted)):
+                if best_factor is None or spatial * spatial * temporal > best_factor:
+                    best_level, best_factor = level_id, spatial * spatial * temporal
+        if best_level is None: # nothing meets it, use the finest level
+            best_level = self.levels.index(min(self.levels))
+        return best_level
+
+    def read(self, field_id, yslice=slice(None), xslice=slice(None), channel=None,
+             frames=slice(None), out_shape=None, level=None):
+        """ Read a region of a field from the coarsest level meeting out_shape.
+
+        Args:
+            field_id: Integer. Field to read.
+            yslice, xslice, frames: Slice objects (step 1). Region to read, in full
+                resolution coordinates.
+            channel: Integer or None. Channel to read (None for all).
+            out_shape: Tuple. Minimum (height, width, num_frames) wanted. See
+                select_level.
+            level: Integer. Read from this level instead of selecting one.
+
+        Returns:
+            Array [y, x, channels, frames] (channel axis dropped if channel is an integer)
+                and the index of the level it was read from.
+        """
+        if level is None:
+            level = self.select_level(field_id, out_shape, yslice, xslice, frames)
+        spatial, temporal = self.levels[level]
+        info = self._array_info(field_id, level)
+        shape, chunks = info['shape'], info['chunks']
+
+        # Region in level coordinates
+        full_shape = self.field_shape(field_id)
+        full_sizes = [full_shape[0], full_shape[1], full_shape[3]]
+        region = []
+        for index, size, factor, level_size in zip([yslice, xslice, frames], full_sizes,
+                                                   [spatial, spatial, temporal],
+                                                   [shape[0], shape[1], shape[3]]):
+            start, stop, _ = index.indices(size)
+            region.append(slice(start // factor, min(-(-stop // factor), level_size)))
+        channel_slice = (slice(None) if channel is None else slice(channel, channel + 1))
+        region.insert(2, slice(*channel_slice.indices(shape[2])[:2]))
+
+        # Read every chunk that intersects the region
+        out = np.zeros([r.stop - r.start for r in region], dtype=info['dtype'])
+        chunk_ranges = [range(r.start // c, -(-r.stop // c)) for r, c in zip(region, chunks)]
+        for chunk_index in np.ndindex(*[len(cr) for cr in chunk_ranges]):
+            chunk_ids = [cr[i] for cr, i in zip(chunk_ranges, chunk_index)]
+            chunk = self._read_chunk(field_id, level, chunk_ids, info)
+            if chunk is None:
+                continue
+            src, dst = [], []
+            for chunk_id, c, r in zip(chunk_ids, chunks, region):
+                start = max(r.start, chunk_id * c)
+                stop = min(r.stop, (chunk_id + 1) * c)
+                src.append(slice(start - chunk_id * c, stop - chunk_id * c))
+                dst.append(slice(start - r.start, stop - r.start))
+            out[tuple(dst)] = chunk[tuple(src)]
+
+        if channel is not None:
+            out = out[:, :, 0]
+        return out, level
+
+    def _array_path(self, field_id, level_id):
+        return os.path.join(self.path, 'field{}'.format(field_id), 'level{}'.format(level_id))
+
+    def _array_info(self, field_id, level_id):
+        if (field_id, level_id) not in self._array_infos:
+            with open(os.path.join(self._array_path(field_id, level_id), '.zarray')) as f:
+                info = json.load(f)
+            info['dtype'] = np.dtype(info['dtype'])
+            self._array_infos[(field_id, level_id)] = info
+        return self._array_infos[(field_id, level_id)]
+
+    def _read_chunk(self, field_id, level_id, chunk_ids, info):
+        filename = os.path.join(self._array_path(field_id, level_id),
+                                '.'.join(str(i) for i in chunk_ids))
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if info['compressor'] is not None:
+            data = zlib.decompress(data)
+        return np.frombuffer(data, dtype=info['dtype']).reshape(info['chunks'])
@@ -0,0 +1,191 @@
+"""
+Reductions (mean, variance, max, percentiles...) over the frames or pixels of a scan.
+
+Fields are read in chunks of frames and each chunk is reduced to a partial result that
+is then merged with the others (variances are merged with Welford/Chan's formula), so
+memory use stays bounded regardless of the length of the scan. Chunks can be spread over
+a pool of threads or processes (see parallel.py).
+"""
+import numpy as np
+from .parallel import ChunkPool, frame_chunks, fit_chunk_frames, as_list
+from .progress import new_progress
+
+OPS = ['sum', 'mean', 'var', 'std', 'min', 'max', 'median', 'percentile']
+AXES = ['frames', 'pixels']
+
+
+def reduce(scan, op, axis='frames', fields=None, channels=None, chunk_frames=None,
+           q=None, workers=None, executor='thread', progress=None, cancel=None):
+    """ Reduce each field of the scan over frames (e.g., a mean image) or over pixels
+    (e.g., a mean trace) streaming chunks of frames from disk.
+
+    Args:
+        scan: Scan object.
+        op: String. One of 'sum', 'mean', 'var', 'std', 'min', 'max', 'median' or
+            'percentile'.
+        axis: String. 'frames' reduces over time producing [y, x, channels] images;
+            'pixels' reduces over y, x producing [channels, frames] traces.
+        fields: Integer, list of integers or None. Fields to reduce. None for all.
+        channels: Integer, list of integers or None. Channels to reduce. None for all.
+        chunk_frames: Integer. Number of frames read at a time. Default reads ~64 MB per
+            chunk (all requested fields) or less to fit scan.max_memory.
+        q: Float or list of floats. Percentile(s) in [0, 100] for op='percentile'.
+        workers: Integer. Number of threads/processes. None reads serially.
+        executor: String. 'thread' or 'process'.
+        progress: Function or None. Called as progress(pages_done, total_pages,
+            bytes_done) as pages are read (see progress.py).
+        cancel: progress.CancelToken or None. Once cancelled, the operation stops with
+            ReadCancelled before reading the next chunk or batch of pages.
+
+    Returns:
+        A list of arrays, one per field, or a single array if fields is an integer. Each
+            array is [y, x, channels] (axis='frames') or [channels, frames]
+            (axis='pixels'); a leading axis is added per percentile if q is a list. If
+            channels is an integer, that axis is dropped.
+
+    Raises:
+        ValueError: If the scan has no frames (e.g., a live scan before its first frame
+            is written).
+
+    Note:
+        Percentiles (and median) over frames need every frame of a pixel at once, so
+            instead of chunks of frames we read bands of rows over all frames; the
+            band height is chosen to read roughly chunk_frames full frames at a time.
+    """
+    if op not in OPS:
+        raise ValueError('op should be one of {}, received {}'.format(OPS, op))
+    if axis not in AXES:
+        raise ValueError('axis should be one of {}, received {}'.format(AXES, axis))
+    if op == 'percentile' and q is None:
+        raise ValueError("op='percentile' requires q")
+    if scan.num_frames == 0:
+        raise ValueError('Cannot reduce a scan with no frames')
+
+    field_list = as_list(fields, scan.num_fields)
+    channel_list = as_list(channels, scan.num_channels)
+    chunk_frames = fit_chunk_frames(scan, field_list, len(channel_list), chunk_frames,
+                                    workers)
+
+    # Generate tasks
+    unique_fields = list(dict.fromkeys(field_list)) # reduce repeated fields only once
+    is_over_rows = axis == 'frames' and op in ['median', 'percentile']
+    if is_over_rows: # a band of rows (over all frames) of a single field
+        tasks = []
+        for field_id in unique_fields:
+            height = scan.field_heights[field_id]
+            band_height = max(1, (chunk_frames * height) // max(scan.num_frames, 1))
+            tasks += [(_reduce_band, (field_id, channel_list, yslice, op, q)) for yslice
+                      in frame_chunks(height, band_height)]
+    else: # a chunk of frames of all fields (reading each page once)
+        tasks = [(_reduce_chunk, (unique_fields, channel_list, frame_slice, op, axis, q))
+                 for frame_slice in frame_chunks(scan.num_frames, chunk_frames)]
+
+    # Reduce chunks and merge them into a result per field
+    if is_over_rows:
+        band_plans = [scan.plan((field_id, yslice, slice(None), channel_list)) for _,
+                      (field_id, _, yslice, *_) in tasks]
+        total_pages = sum(band_plan.num_pages() for band_plan in band_plans)
+    else:
+        total_pages = scan._count_pages(unique_fields, channel_list, scan.num_frames)
+    tracker = new_progress(progress, cancel, total_pages)
+    partials = {field_id: [] for field_id in unique_fields}
+    with ChunkPool(scan, workers=workers, executor=executor, progress=tracker) as pool:
+        for (reduce_func, args), chunk_partials in zip(tasks, pool.imap(_run_task, tasks)):
+            if is_over_rows:
+                chunk_partials = {args[0]: chunk_partials}
+            for field_id, partial in chunk_partials.items():
+                if axis == 'frames' and not is_over_rows and partials[field_id]:
+                    partials[field_id] = [_merge(partials[field_id][0], partial, op)]
+                else: # each chunk fills a different part of the output
+                    partials[field_id].append(partial)
+
+    results = []
+    for field_id in field_list:
+        if is_over_rows: # bands of rows
+            result = np.concatenate(partials[field_id], axis=-3)
+        elif axis == 'pixels': # chunks of frames
+            result = np.concatenate(partials[field_id], axis=-1)
+        else:
+            result = _finalize(partials[field_id][0], op)
+        if np.issubdtype(type(channels), np.signedinteger):
+            result = result[..., 0, :] if axis == 'pixels' else result[..., 0]
+        results.append(result)
+
+    return results[0] if np.issubdtype(type(fields), np.signedinteger) else results
+
+
+def _run_task(scan, reduce_func, args):
+    return reduce_func(scan, *args)
+
+
+def _reduce_band(scan, field_id, channel_list, yslice, op, q):
+    """ Read a band of rows over all frames ([y, x, channels, frames]) and reduce it."""
+    band = scan[field_id, yslice, :, channel_list, :]
+    return _apply(band, op, axis=-1, q=q)
+
+
+def _reduce_chunk(scan, field_list, channel_list, frame_slice, op, axis, q):
+    """ Read one chunk of frames of every field and reduce each to a partial result.
+
+    Returns:
+        A dictionary with the partial result of each field.
+    """
+    frame_list = list(range(frame_slice.start, frame_slice.stop))
+    chunks = scan._read_fields(field_list, channel_list, frame_list)
+
+    partials = {}
+    for field_id, chunk in zip(field_list, chunks):
+        if axis == 'pixels': # complete result for these frames
+            pixels = chunk.reshape(-1, *chunk.shape[2:])
+            partials[field_id] = _apply(pixels, op, axis=0, q=q)
+        elif op in ['min', 'max']:
+            partials[field_id] = _apply(chunk, op, axis=-1)
+        elif op in ['sum', 'mean']:
+            partials[field_id] = chunk.shape[-1], chunk.sum(axis=-1, dtype=np.float64)
+        else: # var, std
+            mean = chunk.mean(axis=-1, dtype=np.float64)
+            m2 = ((chunk - mean[..., None]) ** 2).sum(axis=-1)
+            partials[field_id] = chunk.shape[-1], mean, m2
+    return partials
+
+
+def _apply(array, op, axis, q=None):
+    if op == 'percentile':
+        return np.percentile(array, q, axis=axis)
+    elif op in ['mean', 'var', 'std']:
+        return getattr(np, op)(array, axis=axis, dtype=np.float64)
+    elif op == 'sum':
+        return np.sum(array, axis=axis, dtype=np.float64)
+    else:
+        return getattr(np, op)(array, axis=axis)
+
+
+def _merge(partial1, partial2, op):
+    """ Merge two partial results of chunks of frames."""
+    if op == 'min':
+        return np.minimum(partial1, partial2)
+    elif op == 'max':
+        return np.maximum(partial1, partial2)
+    elif op in ['sum', 'mean']:
+        return partial1[0] + partial2[0], partial1[1] + partial2[1]
+    else: # Chan et al. parallel version of Welford's algorithm
+        n1, mean1, m2_1 = partial1
+        n2, mean2, m2_2 = partial2
+        n = n1 + n2
+        delta = mean2 - mean1
+        mean = mean1 + delta * (n2 / n)
+        m2 = m2_1 + m2_2 + delta ** 2 * (n1 * n2 / n)
+        return n, mean, m2
+
+
+def _finalize(partial, op):
+    if op in ['min', 'max']:
+        return partial
+    elif op == 'sum':
+        return partial[1]
+    elif op == 'mean':
+        return partial[1] / partial[0]
+    elif op == 'var':
+        return partial[2] / partial[0]
+    else: # std
+        return np.sqrt(partial[2] / partial[0])
@@ -0,0 +1,246 @@
+"""
+Batches of small crops of random (or strided) frames, e.g., to train denoising models.
+
+read_crops reads many (field, frame, channel, y, x) crops of a scan in one pass: reads
+are sorted by page so each file is opened once and read in order, and only the rows of
+each page covered by a crop are read from disk. CropSampler draws random crops from one
+or more scans in reproducible batches that can be split among data loader workers.
+"""
+import itertools
+import time
+import numpy as np
+from . import parallel
+from . import stats
+from . import utils
+from .progress import current
+
+SAMPLE_COLUMNS = ('scan', 'field', 'frame', 'channel', 'y', 'x')
+
+
+def read_crops(scan, samples, crop_shape):
+    """ Read a crop of crop_shape for each sample.
+
+    Args:
+        scan: Scan object.
+        samples: Array-like (num_samples, 5) of integers. Field, frame, channel and top
+            left corner (y, x) of each crop.
+        crop_shape: Pair of integers. Height and width of every crop.
+
+    Returns:
+        A 3-d array (num_samples, height, width); crops[i] is
+            scan[field, y: y + height, x: x + width, channel, frame] for sample i.
+
+    Raises:
+        IndexError: If a sample is out of bounds or its crop does not fit in its field.
+    """
+    samples = np.array(samples, dtype=np.int64).reshape(-1, 5)
+    height, width = crop_shape
+    _check_samples(scan, samples, height, width)
+    scan._check_memory(len(samples) * height * width * np.dtype(scan.dtype).itemsize)
+
+    read_stats = scan._stats
+    with stats.read(read_stats, 'crops'):
+        crops = np.empty([len(samples), height, width], dtype=scan.dtype)
+
+        # Rows and columns of each page covered by each crop (crops may span subfields)
+        slice_step, frame_step = scan._page_steps
+        regions = {field_id: scan._field_regions(field_id) for field_id in
+                   set(samples[:, 0].tolist())}
+        reads = [] # (page, page_yslice, page_xslice, sample, crop_yslice, crop_xslice)
+        for i, (field_id, frame, channel, y, x) in enumerate(samples.tolist()):
+            for slice_id, page_ys, page_xs, output_ys, output_xs in regions[field_id]:
+                y_start, y_stop = max(y, output_ys.start), min(y + height, output_ys.stop)
+                x_start, x_stop = max(x, output_xs.start), min(x + width, output_xs.stop)
+                if y_start < y_stop and x_start < x_stop:
+                    page = frame * frame_step + slice_id * slice_step + channel
+                    page_y = page_ys.start - output_ys.start
+                    page_x = page_xs.start - output_xs.start
+                    reads.append((page, slice(y_start + page_y, y_stop + page_y),
+                                  slice(x_start + page_x, x_stop + page_x), i,
+                                  slice(y_start - y, y_stop - y),
+                                  slice(x_start - x, x_stop - x)))
+        reads.sort(key=lambda read: read[0]) # file order
+
+        # Read them file by file
+        tracker = current()
+        calibration = scan._calibration
+        num_channels = scan.num_channels
+        file_starts = np.cumsum([0] + [page_index.num_pages for page_index in
+                                       scan.page_indices])
+        read_pages = [read[0] for read in reads]
+        file_bounds = np.searchsorted(read_pages, file_starts)
+        start = time.perf_counter()
+        bytes_read = 0
+        for file_id, page_index in enumerate(scan.page_indices):
+            file_reads = reads[file_bounds[file_id]: file_bounds[file_id + 1]]
+            if len(file_reads) == 0:
+                continue
+            if tracker is not None:
+                tracker.check()
+            first_page = file_starts[file_id]
+            if page_index.is_contiguous:
+                with scan.file_handles.open(file_id) as file_handle:
+                    for page, page_ys, page_xs, i, crop_ys, crop_xs in file_reads:
+                        rows = page_index.read_page(file_handle, page - first_page,
+                                                    page_ys)
+                        if calibration is None:
+                            crops[i, crop_ys, crop_xs] = rows[:, page_xs]
+                        else:
+                            calibration.apply(rows[:, page_xs], page % num_channels,
+                                              out=crops[i, crop_ys, crop_xs])
+                        bytes_read += rows.nbytes
+            else:
+                with scan.tiff_files.open(file_id) as tiff_file:
+                    for page, page_ys, page_xs, i, crop_ys, crop_xs in file_reads:
+                        page_data = tiff_file.asarray(key=int(page - first_page))
+                        if calibration is None:
+                            crops[i, crop_ys, crop_xs] = page_data[page_ys, page_xs]
+                        else:
+                            calibration.apply(page_data[page_ys, page_xs],
+                                              page % num_channels,
+                                              out=crops[i, crop_ys, crop_xs])
+                        bytes_read += page_index.page_nbytes
+            if tracker is not None:
+                tracker.update(len(file_reads), 0)
+
+        if read_stats is not None:
+            read_stats.add_seconds('io', time.perf_counter() - start)
+            read_stats.add(pages_read=len(reads), bytes_read=bytes_read,
+                           bytes_allocated=crops.nbytes)
+
+    return crops
+
+
+def _check_samples(scan, samples, height, width):
+    """ Raise IndexError if any sample is out of bounds or its crop does not fit."""
+    for axis, column, dim_size in [(0, 0, scan.num_fields), (4, 1, scan.num_frames),
+                                   (3, 2, scan.num_channels)]:
+        utils.check_index_is_in_bounds(axis, samples[:, column].tolist(), dim_size)
+    samples[:, :3] %= [scan.num_fields, scan.num_frames, scan.num_channels]
+
+    field_heights = np.array(scan.field_heights)[samples[:, 0]]
+    field_widths = np.array(scan.field_widths)[samples[:, 0]]
+    does_not_fit = ((samples[:, 3] < 0) | (samples[:, 3] + height > field_heights) |
+                    (samples[:, 4] < 0) | (samples[:, 4] + width > field_widths))
+    if np.any(does_not_fit):
+        i = np.flatnonzero(does_not_fit)[0]
+        raise IndexError('crop of shape {} at (y, x) = {} does not fit in field {} of shape '
+                         '{}'.format((height, width), tuple(samples[i, 3:]), samples[i, 0],
+                                     (field_heights[i], field_widths[i])))
+
+
+class CropSampler:
+    """ Random crops of random frames of one or more scans, in batches.
+
+    Batch i is drawn with a random generator seeded with (seed, i), so a seed gives the
+    same batches whatever the number of workers reading them: with num_shards workers,
+    worker k reads batches k, k + num_shards, k + 2 * num_shards...
+
+    Attributes:
+        scans: List of Scan objects.
+        crop_shape: Pair of integers. Height and width of the crops.
+        fields: Integer, list of integers or None. Fields to sample from (in every scan).
+            None for all fields. Fields smaller than the crop are skipped.
+        channels: Integer, list of integers or None. Channels to sample from. None for
+            all.
+        frames: Slice object. Frames to sample from, e.g., slice(0, None, 10) for every
+            tenth frame.
+        seed: Integer. Seed of the random generators.
+
+    Example:
+        sampler = CropSampler([scan1, scan2], (64, 64), channels=0, seed=1)
+        for crops, samples in sampler.batches(32, num_batches=1000):
+            # crops: [32, 64, 64] array; samples: [32, 6] array (see SAMPLE_COLUMNS)
+    """
+    def __init__(self, scans, crop_shape, fields=None, channels=None, frames=slice(None),
+                 seed=0):
+        self.scans = list(scans) if isinstance(scans, (list, tuple)) else [scans]
+        self.crop_shape = tuple(crop_shape)
+        self.fields = fields
+        self.channels = channels
+        self.frames = frames
+        self.seed = seed
+
+        # Fields, frames and channels each scan can be sampled from
+        height, width = self.crop_shape
+        self._choices = []
+        for scan in self.scans:
+            field_list = [field_id for field_id in parallel.as_list(fields, scan.num_fields)
+                          if scan.field_heights[field_id] >= height and
+                          scan.field_widths[field_id] >= width]
+            self._choices.append((np.array(field_list, dtype=np.int64),
+                                  np.array(utils.listify_index(frames, scan.num_frames),
+                                           dtype=np.int64),
+                                  np.array(parallel.as_list(channels, scan.num_channels),
+                                           dtype=np.int64)))
+        num_choices = [len(field_list) * len(frame_list) * len(channel_list) for
+                       field_list, frame_list, channel_list in self._choices]
+        self._scan_starts = np.cumsum([0] + num_choices)
+        if self._scan_starts[-1] == 0:
+            raise ValueError('No fields, frames and channels to sample crops of shape {} '
+                             'from'.format(self.crop_shape))
+
+    @property
+    def dtype(self):
+        return np.result_type(*[scan.dtype for scan in self.scans])
+
+    def sample(self, batch_size, rng):
+        """ Draw random crops: every (scan, field, frame, channel) is equally likely and
+        so is every position of the crop in the field.
+
+        Args:
+            batch_size: Integer. Number of crops.
+            rng: numpy.random.Generator.
+
+        Returns:
+            A (batch_size, 6) array of integers (see SAMPLE_COLUMNS).
+        """
+        choices = rng.integers(self._scan_starts[-1], size=batch_size)
+        samples = np.empty([batch_size, 6], dtype=np.int64)
+        samples[:, 0] = np.searchsorted(self._scan_starts, choices, side='right') - 1
+        for scan_id in np.unique(samples[:, 0]):
+            in_scan = samples[:, 0] == scan_id
+            field_list, frame_list, channel_list = self._choices[scan_id]
+            choice = choices[in_scan] - self._scan_starts[scan_id]
+            field_ids, frame_ids, channel_ids = np.unravel_index(
+                choice, (len(field_list), len(frame_list), len(channel_list)))
+            samples[in_scan, 1] = field_list[field_ids]
+            samples[in_scan, 2] = frame_list[frame_ids]
+            samples[in_scan, 3] = channel_list[channel_ids]
+
+            scan = self.scans[scan_id]
+            max_y = np.array(scan.field_heights)[samples[in_scan, 1]] - self.crop_shape[0]
+            max_x = np.array(scan.field_widths)[samples[in_scan, 1]] - self.crop_shape[1]
+            samples[in_scan, 4] = rng.integers(max_y + 1)
+            samples[in_scan, 5] = rng.integers(max_x + 1)
+        return samples
+
+    def read(self, samples):
+        """ Read the crops of samples (as returned by sample) as a (num_samples, height,
+        width) array, reading the crops of each scan in a single pass."""
+        samples = np.asarray(samples, dtype=np.int64).reshape(-1, 6)
+        crops = np.empty([len(samples), *self.crop_shape], dtype=self.dtype)
+        for scan_id in np.unique(samples[:, 0]):
+            in_scan = samples[:, 0] == scan_id
+            crops[in_scan] = read_crops(self.scans[scan_id], samples[in_scan, 1:],
+                                        self.crop_shape)
+        return crops
+
+    def batch(self, index, batch_size):
+        """ The index-th batch: a (crops, samples) tuple (see sample and read)."""
+        samples = self.sample(batch_size, np.random.default_rng([self.seed, index]))
+        return self.read(samples), samples
+
+    def batches(self, batch_size, num_batches=None, shard=0, num_shards=1):
+        """ Generator with (crops, samples) batches.
+
+        Args:
+            batch_size: Integer. Number of crops per batch.
+            num_batches: Integer or None. Number of batches (over all shards). None for
+                an endless stream.
+            shard: Integer. Index of this worker.
+            num_shards: Integer. Number of workers splitting the batches.
+        """
+        batch_ids = range(num_batches) if num_batches is not None else itertools.count()
+        for index in itertools.islice(batch_ids, shard, None, num_shards):
+            yield self.batch(index, batch_size)
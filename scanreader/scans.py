@@ -28,9 +28,30 @@ from tifffile.tifffile import matlabstr2py
 import numpy as np
 import re
 import itertools
+import functools
+import os
+import time
 from . import utils
+from . import pages
+from . import filepool
+from . import plans
+from . import reductions
+from . import parallel
+from . import exports
+from . import pyramid
+from . import stats
+from . import aio
+from . import sampling
+from . import calibration
+from .progress import new_progress, tracking, current, PAGES_PER_UPDATE
 from .multiroi import ROI
-from .exceptions import FieldDimensionMismatch
+from .exceptions import PathnameError, PageLayoutError, MemoryBudgetError
+
+
+def _no_clock():
+    """ Stand-in for time.perf_counter when reads are not being timed."""
+    return 0
+
 
 class BaseScan():
     """ Properties and methods shared among all scan versions.
@@ -65,23 +86,111 @@ class BaseScan():
     """
     def __init__(self):
         self.filenames = None
+        self.pathnames = None
+        self.is_live = False
+        self.allow_truncated = False
+        self.max_memory = None
         self.dtype = None
         self._tiff_files = None
+        self._page_indices = None
+        self._first_index = None
+        self._file_handles = None
+        self._roi_metadata = None
+        self._max_open_files = filepool.DEFAULT_MAX_OPEN_FILES
+        self._stats = None
+        self._async_reader = None
+        self._calibration = None
         self.header = ''
 
+    @property
+    def max_open_files(self):
+        """ Maximum number of tiff files kept open at once."""
+        return self._max_open_files
+
+    @max_open_files.setter
+    def max_open_files(self, max_open_files):
+        self._max_open_files = max_open_files
+        for pool in [self._tiff_files, self._file_handles]:
+            if pool is not None:
+                pool.max_open = max_open_files
+
     @property
     def tiff_files(self):
+        """ TiffFile per tiff file (a FilePool, see filepool.py): opened on demand, only
+        the max_open_files most recently used are kept open."""
         if self._tiff_files is None:
-            self._tiff_files = [TiffFile(filename) for filename in self.filenames]
+            self._tiff_files = filepool.FilePool(self.filenames, TiffFile,
+                                                 max_open=self.max_open_files)
         return self._tiff_files
 
     @tiff_files.deleter
     def tiff_files(self):
         if self._tiff_files is not None:
-            for tiff_file in self._tiff_files:
-                tiff_file.close()
+            self._tiff_files.close()
             self._tiff_files = None
 
+    @property
+    def page_indices(self):
+        """ One PageIndex (see pages.py) per tiff file: where each page lives on disk."""
+        if self._page_indices is None:
+            with stats.stage(self._stats, 'index'):
+                first_index = self._first_index
+                if first_index is None or self.is_live: # live files may have grown since
+                    first_index = self._index_file(0, previous_index=first_index)
+                self._page_indices = [first_index] + [self._index_file(i) for i in
+                                                      range(1, len(self.filenames))]
+        return self._page_indices
+
+    def _index_file(self, i, previous_index=None):
+        """ Index the pages of the i-th file (see pages.index_pages)."""
+        stop_at_incomplete = self.is_live or (self.allow_truncated and
+                                              i == len(self.filenames) - 1)
+        return pages.index_pages(self.filenames[i], stop_at_incomplete=stop_at_incomplete,
+                                 previous_index=previous_index)
+
+    @property
+    def _first_page_index(self):
+        """ PageIndex of the first file. Only that file is indexed if the rest of the
+        page indices are not needed yet, e.g., to find the page size when the scan is
+        created."""
+        if self._page_indices is not None:
+            return self._page_indices[0]
+        if self._first_index is None:
+            with stats.stage(self._stats, 'index'):
+                self._first_index = self._index_file(0)
+        return self._first_index
+
+    @property
+    def file_handles(self):
+        """ Plain binary file handles used to read page data (a FilePool, see
+        filepool.py): opened on demand, only the max_open_files most recently used are
+        kept open."""
+        if self._file_handles is None:
+            self._file_handles = filepool.FilePool(self.filenames,
+                                                   functools.partial(open, mode='rb'),
+                                                   max_open=self.max_open_files)
+        return self._file_handles
+
+    @file_handles.deleter
+    def file_handles(self):
+        if self._file_handles is not None:
+            self._file_handles.close()
+            self._file_handles = None
+
+    @property
+    def async_reader(self):
+        """ AsyncReader (see aio.py) serving aread and aiter_chunks from a pool of I/O
+        threads (created on first use)."""
+        if self._async_reader is None:
+            self._async_reader = aio.AsyncReader(self)
+        return self._async_reader
+
+    @async_reader.deleter
+    def async_reader(self):
+        if self._async_reader is not None:
+            self._async_reader.close()
+            self._async_reader = None
+
     @property
     def version(self):
         match = re.search(r"SI.?\.VERSION_MAJOR = '?(?P<version>[^\s']*)'?", self.header)
@@ -113,6 +222,22 @@ class BaseScan():
             num_channels = None
         return num_channels
 
+    @property
+    def channel_offsets(self):
+        """ Offsets ScanImage recorded for each saved channel (hChannels.channelOffset)
+        or None if the header has none."""
+        match = re.search(r'hChannels\.channelOffset = (?P<offsets>.*)', self.header)
+        if not match:
+            return None
+        offsets = matlabstr2py(match.group('offsets'))
+        offsets = offsets if isinstance(offsets, list) else [offsets]
+        channels = matlabstr2py(re.search(r'hChannels\.channelSave = (?P<channels>.*)',
+                                          self.header).group('channels'))
+        channels = channels if isinstance(channels, list) else [channels]
+        channels = [channel[0] if isinstance(channel, list) else channel for channel in
+                    channels] # channelSave can be a column vector
+        return [offsets[channel - 1] for channel in channels]
+
     @property
     def requested_scanning_depths(self):
         match = re.search(r'hStackManager\.zs = (?P<zs>.*)', self.header)
@@ -151,11 +276,15 @@ class BaseScan():
     @property
     def num_frames(self):
         """ Each tiff page is an image at a given channel, scanning depth combination."""
+        return self._count_frames(self._num_pages)
+
+    def _count_frames(self, num_pages):
+        """ Number of complete frames in the first num_pages pages of the scan."""
         if self.is_slow_stack:
             num_frames = min(self.num_requested_frames / self._num_averaged_frames,
-                             self._num_pages / self.num_channels) # finished in the first slice
+                             num_pages / self.num_channels) # finished in the first slice
         else:
-            num_frames = self._num_pages / (self.num_channels * self.num_scanning_depths)
+            num_frames = num_pages / (self.num_channels * self.num_scanning_depths)
         num_frames = int(num_frames) # discard last frame if incomplete
         return num_frames
 
@@ -183,16 +312,16 @@ class BaseScan():
 
     @property
     def _num_pages(self):
-        num_pages = sum([len(tiff_file.pages) for tiff_file in self.tiff_files])
+        num_pages = sum([page_index.num_pages for page_index in self.page_indices])
         return num_pages
 
     @property
     def _page_height(self):
-        return self.tiff_files[0].pages[0].imagelength
+        return self._first_page_index.height
 
     @property
     def _page_width(self):
-        return self.tiff_files[0].pages[0].imagewidth
+        return self._first_page_index.width
 
     @property
     def _num_averaged_frames(self):
@@ -290,20 +419,41 @@ class BaseScan():
     def field_offsets(self):
         raise NotImplementedError('Subclasses of BaseScan must implement this property')
 
-    def read_data(self, filenames, dtype):
+    def read_data(self, filenames, dtype, header=None, roi_metadata=None):
         """ Set self.header, self.filenames and self.dtype. Data is read lazily when needed.
 
         Args:
             filenames: List of strings. Tiff filenames.
             dtype: Data type of the output array.
+            header: String. ScanImage metadata of the first file if already read (see
+                pages.read_scanimage_header). Read from disk if None.
+            roi_metadata: Dictionary. ScanImage ROI metadata of the first file if already
+                read along with the header.
         """
         self.filenames = filenames # set filenames
         self.dtype=dtype # set dtype of read data
-        self.header = '{}\n{}'.format(self.tiff_files[0].pages[0].description,
-                                      self.tiff_files[0].pages[0].software) # set header (ScanImage metadata)
-
-    def __array__(self):
-        return self[:]
+        if header is None:
+            header, roi_metadata = pages.read_scanimage_header(filenames[0])
+        self.header = header # set header (ScanImage metadata)
+        self._roi_metadata = roi_metadata
+
+    def __getstate__(self):
+        """ Pickle scans as a compact description: filenames, header, fields and page
+        index. Open file handles are dropped and reopened lazily when first needed, so
+        sending a scan to a pool of worker processes does not redo the glob, header
+        parsing or IFD walk in each of them."""
+        self.page_indices  # index pages once here rather than once per worker
+        state = self.__dict__.copy()
+        state['_tiff_files'] = None
+        state['_file_handles'] = None
+        state['_stats'] = None
+        state['_async_reader'] = None
+        return state
+
+    def __array__(self, dtype=None, copy=None):
+        # data is read into a new array, never shared with the scan, so copy is moot
+        array = self[:]
+        return array if dtype is None else array.astype(dtype, copy=False)
 
     def __str__(self):
         msg = '{}\n{}\n{}'.format(type(self), '*' * 80, self.header, '*' * 80)
@@ -334,6 +484,503 @@ class BaseScan():
 
         return ScanIterator(self)
 
+    def refresh(self):
+        """ Pick up pages appended to the scan files and new files matching the pathnames
+        the scan was read with, e.g., while ScanImage is still acquiring it. Indexing
+        resumes after the last known page of each file that grew, so the cost is
+        proportional to the number of new pages.
+
+        Returns:
+            Integer. Number of new complete frames.
+        """
+        from .core import expand_wildcard # core imports this module
+
+        num_frames = self.num_frames
+        filenames = (self.filenames if self.pathnames is None else
+                     expand_wildcard(self.pathnames))
+        if filenames[:len(self.filenames)] != self.filenames:
+            raise PathnameError('Files in the scan were removed or renamed: expected {} '
+                                'received {}'.format(self.filenames, filenames))
+
+        page_indices = list(self.page_indices)
+        is_changed = len(filenames) > len(self.filenames)
+        for i, filename in enumerate(filenames):
+            if i < len(page_indices):
+                file_size = os.path.getsize(filename)
+                if file_size != page_indices[i].file_size:
+                    previous_index = (page_indices[i] if file_size > page_indices[i].file_size
+                                      else None) # only parse the appended pages
+                    page_indices[i] = pages.index_pages(filename, stop_at_incomplete=True,
+                                                        previous_index=previous_index)
+                    is_changed = True
+            else:
+                page_indices.append(pages.index_pages(filename, stop_at_incomplete=True))
+
+        if is_changed:
+            del self.tiff_files # tifffile caches the pages it has seen
+            if len(filenames) > len(self.filenames):
+                del self.file_handles
+            self.filenames = filenames
+            self._page_indices = page_indices
+
+        return self.num_frames - num_frames
+
+    def follow(self, fields=None, channels=None, start_frame=None, chunk_frames=None,
+               poll_interval=0.5, timeout=None):
+        """ Generator with new frames as soon as they are complete on disk (tail mode).
+
+        Polls the scan files (see refresh) and yields every frame once all its slices and
+        channels have been written. Stops when the requested number of frames has been
+        acquired, when no new frames arrive in timeout seconds or when the caller stops
+        iterating.
+
+        Args:
+            fields: Integer, list of integers or None. Fields to read. None for all.
+            channels: Integer, list of integers or None. Channels to read. None for all.
+                If an integer, that axis is dropped from the output (as in scan[...]).
+            start_frame: Integer. First frame to yield. None starts after the frames
+                already on disk.
+            chunk_frames: Integer. Maximum number of frames per yield. Default reads
+                ~64 MB per chunk (all requested fields).
+            poll_interval: Float. Seconds to wait between checks for new pages.
+            timeout: Float. Seconds without new frames before giving up. None waits
+                forever.
+
+        Yields:
+            (frames, blocks) tuples. frames is a slice object with the frames read;
+                blocks is a list with a [y, x, channels, frames] array per field.
+
+        Example:
+            scan = scanreader.read_scan('/data/ongoing_*.tif', live=True)
+            for frames, blocks in scan.follow(timeout=60):
+                # process new frames
+        """
+        if self.is_slow_stack:
+            raise ValueError('follow() needs scans that are saved frame by frame; slow '
+                             'stacks are saved slice by slice')
+        field_list = parallel.as_list(fields, self.num_fields)
+        channel_list = parallel.as_list(channels, self.num_channels)
+        chunk_frames = parallel.fit_chunk_frames(self, field_list, len(channel_list),
+                                                 chunk_frames)
+        drop_channel = np.issubdtype(type(channels), np.signedinteger)
+
+        next_frame = self.num_frames if start_frame is None else start_frame
+        last_new_frame_time = time.monotonic()
+        while True:
+            num_frames = self.num_frames
+            for start in range(next_frame, num_frames, chunk_frames):
+                frame_list = list(range(start, min(start + chunk_frames, num_frames)))
+                blocks = self._read_fields(field_list, channel_list, frame_list)
+                if drop_channel:
+                    blocks = [block[:, :, 0] for block in blocks]
+                yield slice(frame_list[0], frame_list[-1] + 1), blocks
+            if num_frames > next_frame:
+                next_frame = num_frames
+                last_new_frame_time = time.monotonic()
+
+            if (self.num_requested_frames is not None and
+                    next_frame >= self.num_requested_frames):
+                return # acquisition is over
+            if timeout is not None and time.monotonic() - last_new_frame_time > timeout:
+                return
+            time.sleep(poll_interval)
+            self.refresh()
+
+    def verify(self):
+        """ Check the integrity of the scan files without reading any image data.
+
+        Walks the IFDs of every file again (ignoring the current page index) checking
+        that each IFD and the image data of each page lie within the file, that all pages
+        have the same shape, data type and image data size (the IFD of every page is
+        parsed in full, see pages.check_pages) and that page counts are consistent: only
+        the last file may be truncated (a truncated file earlier in the scan shifts every
+        page after it) and all files but the last should have the same number of pages.
+        Scans with a truncated last file can be read with read_scan(...,
+        allow_truncated=True), which stops at its last complete page.
+
+        Returns:
+            A dictionary with:
+                is_ok: Boolean. Whether no problems were found.
+                errors: List of strings. Problems found.
+                files: List of dictionaries (one per file) with the filename, num_pages
+                    (complete pages), file_size and truncation (why the walk stopped
+                    early, None if it did not).
+                num_pages: Integer. Complete pages over all files.
+                num_frames: Integer. Complete frames that can be read.
+                num_requested_frames: Integer. Frames ScanImage was asked to record.
+                num_incomplete_pages: Integer. Pages after the last complete frame (last
+                    complete slice for slow stacks).
+        """
+        page_indices = [pages.index_pages(filename, stop_at_incomplete=True) for filename
+                        in self.filenames]
+        errors = []
+        files = [{'filename': page_index.filename, 'num_pages': page_index.num_pages,
+                  'file_size': page_index.file_size, 'truncation': page_index.truncation}
+                 for page_index in page_indices]
+        for i, page_index in enumerate(page_indices):
+            if page_index.truncation is not None:
+                errors.append('{} is truncated at {}{}'.format(
+                    page_index.filename, page_index.truncation,
+                    '' if i == len(page_indices) - 1 else
+                    '; pages in the files after it are misaligned'))
+            if page_index.num_pages > 0 and (
+                    (page_index.height, page_index.width, page_index.dtype) !=
+                    (page_indices[0].height, page_indices[0].width, page_indices[0].dtype)):
+                errors.append('Pages in {} have shape {} and type {}; pages in {} have '
+                              'shape {} and type {}'.format(
+                                  page_index.filename, (page_index.height, page_index.width),
+                                  page_index.dtype, page_indices[0].filename,
+                                  (page_indices[0].height, page_indices[0].width),
+                                  page_indices[0].dtype))
+            mismatches = (pages.check_pages(page_index.filename, page_index.num_pages) if
+                          page_index.num_pages > 1 else [])
+            if mismatches:
+                errors.append('Pages in {} that differ from its first page: {} (e.g., '
+                              'page {}: {})'.format(page_index.filename, len(mismatches),
+                                                    *mismatches[0]))
+        file_pages = [page_index.num_pages for page_index in page_indices[:-1]]
+        if any(num_pages != file_pages[0] for num_pages in file_pages):
+            errors.append('Files before the last one should have the same number of pages, '
+                          'found {}'.format(file_pages))
+
+        # Complete frames with the verified page counts
+        num_pages = sum(page_index.num_pages for page_index in page_indices)
+        num_frames = self._count_frames(num_pages)
+        pages_per_unit = self.num_channels * (num_frames if self.is_slow_stack else
+                                              self.num_scanning_depths)
+        num_incomplete_pages = num_pages % pages_per_unit if pages_per_unit else num_pages
+        if num_incomplete_pages > 0:
+            errors.append('{} pages after the last complete {}'.format(
+                num_incomplete_pages, 'slice' if self.is_slow_stack else 'frame'))
+
+        return {'is_ok': len(errors) == 0, 'errors': errors, 'files': files,
+                'num_pages': num_pages, 'num_frames': num_frames,
+                'num_requested_frames': self.num_requested_frames,
+                'num_incomplete_pages': num_incomplete_pages}
+
+    def nbytes(self, key=slice(None)):
+        """ Size in bytes of scan[key], computed without reading any data.
+
+        Example:
+            scan.nbytes()                       size of the whole scan (as scan[:])
+            scan.nbytes((0, slice(10, 20)))     size of scan[0, 10:20]
+        """
+        full_key = utils.fill_key(key, num_dimensions=5)
+        return self.plan(full_key[:4]).nbytes(full_key[4])
+
+    def _check_memory(self, nbytes):
+        """ Raise MemoryBudgetError if nbytes do not fit in the memory budget."""
+        if self.max_memory is not None and nbytes > self.max_memory:
+            raise MemoryBudgetError('Reading {} bytes exceeds the memory budget of the '
+                                    'scan ({} bytes). Read fewer frames at a time or use '
+                                    'the chunked methods (reduce, map_blocks, to_zarr, '
+                                    '...), which fit their chunks in the '
+                                    'budget.'.format(nbytes, self.max_memory))
+
+    def plan(self, key=slice(None)):
+        """ Precompute a read of scan[key + (frames, )] to run it for many frame windows.
+
+        Validating the key, working out which rows and columns of which pages hold the
+        requested pixels and where they go in the output is done once here; each read
+        then only computes page numbers, reads them and copies them to the output.
+
+        Args:
+            key: Index or tuple of up to 4 indices (field, y, x, channel) as in scan[...].
+
+        Returns:
+            A ReadPlan object (see plans.py). plan[frames] returns scan[key + (frames, )].
+
+        Example:
+            plan = scan.plan((0, slice(100, 120), slice(50, 70)))
+            for start in range(0, scan.num_frames, 1000):
+                patch = plan[start: start + 1000]
+        """
+        return plans.ReadPlan(self, key)
+
+    def field_view(self, field_id, channel=0):
+        """ Zero-copy, read-only view of a field memory-mapped from disk.
+
+        A (non-joined) field is a fixed band of rows in every page of its slice. If those
+        pages are uncompressed, in a single file and evenly spaced on disk, the field is
+        a strided array over the file and can be indexed at memory-map speed without
+        copying it first.
+
+        Args:
+            field_id: Integer. Field to view.
+            channel: Integer. Channel to view.
+
+        Returns:
+            A read-only [frames, y, x] array with the file's data type (not scan.dtype)
+                and raw values (scan.calibration is not applied).
+
+        Raises:
+            PageLayoutError: If the field is made of several subfields, its pages span
+                several files, are compressed or are not evenly spaced in the file.
+        """
+        regions = self._field_regions(field_id)
+        if len(regions) > 1:
+            raise PageLayoutError('Field {} is made of {} subfields (joined contiguous '
+                                  'fields)'.format(field_id, len(regions)))
+        slice_id, yslice, xslice, _, _ = regions[0]
+
+        # Find the file with the pages of this field and channel
+        slice_step, frame_step = self._page_steps
+        page_numbers = (np.arange(self.num_frames) * frame_step + slice_id * slice_step +
+                        channel)
+        num_pages = np.cumsum([0] + [page_index.num_pages for page_index in
+                                     self.page_indices])
+        file_ids = np.searchsorted(num_pages, page_numbers, side='right') - 1
+        if len(page_numbers) == 0:
+            return np.empty([0, yslice.stop - yslice.start, xslice.stop - xslice.start],
+                            dtype=self.page_indices[0].dtype)
+        if file_ids[0] != file_ids[-1]:
+            raise PageLayoutError('Pages of field {} span several files'.format(field_id))
+        page_index = self.page_indices[file_ids[0]]
+        if not page_index.is_contiguous:
+            raise PageLayoutError('Pages in {} are not stored contiguously'.format(
+                page_index.filename))
+        offsets = page_index.offsets[page_numbers - num_pages[file_ids[0]]]
+        frame_stride = int(offsets[1] - offsets[0]) if len(offsets) > 1 else 0
+        if np.any(np.diff(offsets) != frame_stride):
+            raise PageLayoutError('Pages of field {} are not evenly spaced in '
+                                  '{}'.format(field_id, page_index.filename))
+
+        # Map the bytes spanned by the pages and stride over them
+        file_map = np.memmap(page_index.filename, dtype=np.uint8, mode='r',
+                             offset=int(offsets[0]), shape=int(offsets[-1] - offsets[0] +
+                                                               page_index.page_nbytes))
+        row_nbytes = page_index.width * page_index.dtype.itemsize
+        pages = np.lib.stride_tricks.as_strided(file_map, shape=(len(offsets),
+                                                                 page_index.height,
+                                                                 row_nbytes),
+                                                strides=(frame_stride, row_nbytes, 1),
+                                                writeable=False)
+        pages = pages.view(page_index.dtype) # [frames, height, width]
+
+        return pages[:, yslice, xslice]
+
+    def read(self, key=slice(None), progress=None, cancel=None):
+        """ Same as scan[key], reporting progress and/or stopping when cancelled.
+
+        Args:
+            key: Index or tuple of up to 5 indices (field, y, x, channel, frame) as in
+                scan[...].
+            progress: Function or None. Called as progress(pages_done, total_pages,
+                bytes_done) every few pages (see progress.py).
+            cancel: progress.CancelToken or None. Checked before reading from each file
+                and every few pages.
+
+        Returns:
+            A numpy array, the same as scan[key].
+
+        Raises:
+            ReadCancelled: If cancel was cancelled before the read finished.
+        """
+        tracker = new_progress(progress, cancel)
+        if tracker is not None:
+            full_key = utils.fill_key(key, num_dimensions=5)
+            tracker.total_pages = self.plan(full_key[:4]).num_pages(full_key[4])
+            tracker.check()
+        with tracking(tracker):
+            return self[key]
+
+    def read_crops(self, samples, crop_shape):
+        """ Read many small crops in a single pass over the files, reading only the rows
+        of each page they cover. See sampling.read_crops.
+
+        Example:
+            crops = scan.read_crops([(0, 10, 0, 5, 5), (1, 3, 0, 0, 20)], (32, 32))
+            # crops[0] is scan[0, 5:37, 5:37, 0, 10]
+        """
+        return sampling.read_crops(self, samples, crop_shape)
+
+    async def aread(self, key=slice(None)):
+        """ Awaitable scan[key] for asyncio code: reads in an I/O thread without blocking
+        the event loop, merging concurrent requests for the same region into single reads
+        (see aio.py). Cancelling the awaiting task stops the read.
+
+        Example:
+            frame = await scan.aread((0, slice(None), slice(None), 0, 1000))
+        """
+        return await self.async_reader.read(key)
+
+    def aiter_chunks(self, fields=None, channels=None, chunk_frames=None, prefetch=2):
+        """ Async generator with (frames, blocks) chunks of the scan, reading ahead in
+        I/O threads. See aio.AsyncReader.iter_chunks.
+
+        Example:
+            async for frames, blocks in scan.aiter_chunks(fields=0, chunk_frames=500):
+                # blocks[0] is scan[0, :, :, :, frames]
+        """
+        return self.async_reader.iter_chunks(fields=fields, channels=channels,
+                                             chunk_frames=chunk_frames, prefetch=prefetch)
+
+    def _count_pages(self, field_list, channel_list, num_frames):
+        """ Number of pages _read_fields reads for these fields and channels over
+        num_frames frames (pages shared by several fields are read once)."""
+        slices = {slice_id for field_id in field_list for slice_id, *_ in
+                  self._field_regions(field_id)}
+        return len(slices) * len(set(channel_list)) * num_frames
+
+    @property
+    def stats(self):
+        """ Totals of the reads recorded since enable_stats() (see stats.py) or None if
+        reads are not being recorded."""
+        return None if self._stats is None else self._stats.snapshot()
+
+    def enable_stats(self, callback=None):
+        """ Start recording timings and counters of every read (see stats.py).
+
+        Args:
+            callback: Function. Called with the record (a dictionary) of each read once it
+                finishes. Called from the thread doing the read.
+        """
+        self._stats = stats.ReadStats(callback)
+
+    def disable_stats(self):
+        """ Stop recording reads."""
+        self._stats = None
+
+    @property
+    def calibration(self):
+        """ Calibration applied to every read (see calibration.py) or None if reads
+        return raw values."""
+        return self._calibration
+
+    def enable_calibration(self, offsets=None, scale=None, clip=None):
+        """ Subtract per-channel offsets from every read (and optionally scale and clip
+        the values) as pages are copied into the output (see calibration.py).
+
+        Args:
+            offsets: List of numbers (one per channel) or None. None uses the offsets in
+                the header (channel_offsets).
+            scale: Number, list of numbers (one per channel) or None. Factor values are
+                multiplied by after subtracting the offsets.
+            clip: (low, high) tuple or None. Range of the calibrated values; either bound
+                can be None.
+
+        Example:
+            scan = scanreader.read_scan('/data/my_scan_*.tif', dtype=np.float32)
+            scan.enable_calibration(clip=(0, None))
+            scan[0] # offset-subtracted and non-negative
+        """
+        offsets = self.channel_offsets if offsets is None else offsets
+        if offsets is None:
+            raise ValueError('Header has no channel offsets (hChannels.channelOffset); '
+                             'pass them explicitly')
+        if len(offsets) != self.num_channels:
+            raise ValueError('Expected {} channel offsets, got {}'.format(
+                self.num_channels, len(offsets)))
+        self._calibration = calibration.Calibration(offsets, scale, clip)
+
+    def disable_calibration(self):
+        """ Return raw values in every read."""
+        self._calibration = None
+
+    def reduce(self, op, axis='frames', fields=None, channels=None, chunk_frames=None,
+               q=None, workers=None, executor='thread', progress=None, cancel=None):
+        """ Reduce fields over frames (e.g., mean or max projections) or over pixels
+        (e.g., mean traces) streaming chunks of frames from disk. Peak memory is bounded
+        by the chunk size times the number of chunks in flight.
+
+        Examples:
+            scan.reduce('mean')                        list of mean images per field.
+            scan.reduce('var', fields=0, channels=0)   variance image of first field.
+            scan.reduce('percentile', q=[5, 95], workers=8)
+
+        See reductions.reduce for details on the arguments.
+        """
+        return reductions.reduce(self, op, axis=axis, fields=fields, channels=channels,
+                                 chunk_frames=chunk_frames, q=q, workers=workers,
+                                 executor=executor, progress=progress, cancel=cancel)
+
+    def map_blocks(self, func, fields=None, channels=None, chunk_frames=None,
+                   workers=None, executor='thread', ordered=True, progress=None,
+                   cancel=None):
+        """ Apply func to every chunk of frames of every field, on a pool of workers.
+
+        Each block is exactly scan[field_id, :, :, channels, frames] for a chunk of
+        frames. Pages are read once per chunk even if they hold several fields and only
+        a bounded number of chunks is in flight at any time.
+
+        Example:
+            for field_id, frames, result in scan.map_blocks(func, workers=8):
+                # collect result
+
+        See parallel.map_blocks for details on the arguments.
+        """
+        return parallel.map_blocks(self, func, fields=fields, channels=channels,
+                                   chunk_frames=chunk_frames, workers=workers,
+                                   executor=executor, ordered=ordered, progress=progress,
+                                   cancel=cancel)
+
+    def to_zarr(self, path, chunks=None, fields=None, compression=None,
+                compression_level=1, workers=None, executor='thread', progress=None,
+                cancel=None):
+        """ Export fields as chunked arrays in a zarr directory store (one per field) in a
+        single streaming pass over the scan. See exports.to_zarr for details."""
+        return exports.to_zarr(self, path, chunks=chunks, fields=fields,
+                               compression=compression,
+                               compression_level=compression_level, workers=workers,
+                               executor=executor, progress=progress, cancel=cancel)
+
+    def to_binary(self, path, fields=None, channels=None, chunk_frames=None,
+                  workers=None, executor='thread', progress=None, cancel=None):
+        """ Export fields as flat int16 binary files (suite2p's data.bin, one per field)
+        plus a metadata.json, in a single pass over the pages. See exports.to_binary."""
+        return exports.to_binary(self, path, fields=fields, channels=channels,
+                                 chunk_frames=chunk_frames, workers=workers,
+                                 executor=executor, progress=progress, cancel=cancel)
+
+    def to_hdf5(self, path, compression='gzip', compression_level=4, chunks=None,
+                fields=None, workers=None, executor='thread', resume=True, progress=None,
+                cancel=None):
+        """ Export fields as chunked, compressed datasets in an HDF5 file (needs h5py),
+        compressing chunks in parallel. Interrupted exports can be resumed. See
+        exports.to_hdf5 for details."""
+        return exports.to_hdf5(self, path, compression=compression,
+                               compression_level=compression_level, chunks=chunks,
+                               fields=fields, workers=workers, executor=executor,
+                               resume=resume, progress=progress, cancel=cancel)
+
+    def build_pyramid(self, path, levels=pyramid.DEFAULT_LEVELS, fields=None,
+                      chunk_frames=None, compression=None, compression_level=1,
+                      workers=None, executor='thread', progress=None, cancel=None):
+        """ Build a multi-resolution pyramid (2x/4x/8x downsampled in space and time by
+        default) of every field in one streaming pass. See pyramid.build_pyramid.
+
+        Returns:
+            A Pyramid object to read from it.
+        """
+        return pyramid.build_pyramid(self, path, levels=levels, fields=fields,
+                                     chunk_frames=chunk_frames, compression=compression,
+                                     compression_level=compression_level,
+                                     workers=workers, executor=executor,
+                                     progress=progress, cancel=cancel)
+
+    def _read_fields(self, field_list, channel_list, frame_list):
+        """ Reads entire fields, reading each required page only once.
+
+        Args:
+            field_list: List of integers. Fields to read.
+            channel_list: List of integers. Channels to read.
+            frame_list: List of integers. Frames to read.
+
+        Returns:
+            A list of 4-d arrays ([y, x, channels, frames]), one per field in field_list.
+        """
+        raise NotImplementedError('Subclasses of BaseScan must implement this method')
+
+    def _field_regions(self, field_id):
+        """ Where a field is in the tiff pages.
+
+        Returns:
+            A list of (slice_id, yslice, xslice, output_yslice, output_xslice) tuples, one
+                per subfield: rows yslice and columns xslice of the pages of slice_id go
+                to rows output_yslice and columns output_xslice of the field.
+        """
+        raise NotImplementedError('Subclasses of BaseScan must implement this method')
+
     def _read_pages(self, slice_list, channel_list, frame_list, yslice=slice(None),
                     xslice=slice(None)):
         """ Reads the tiff pages with the content of each slice, channel, frame
@@ -378,12 +1025,7 @@ class BaseScan():
             Slices limit this to 2x (output array and read pages which are sliced in place).
         """
         # Compute pages to load from tiff files
-        if self.is_slow_stack:
-            frame_step = self.num_channels
-            slice_step = self.num_channels * self.num_frames
-        else:
-            slice_step = self.num_channels
-            frame_step = self.num_channels * self.num_scanning_depths
+        slice_step, frame_step = self._page_steps
         pages_to_read = []
         for frame in frame_list:
             for slice_ in slice_list:
@@ -391,31 +1033,139 @@ class BaseScan():
                     new_page = frame * frame_step + slice_ * slice_step + channel
                     pages_to_read.append(new_page)
 
+        # Read pages
+        pages = self._read_page_list(pages_to_read, yslice, xslice)
+
+        # Reshape the pages into (slices, y, x, channels, frames)
+        new_shape = [len(frame_list), len(slice_list), len(channel_list), *pages.shape[1:]]
+        pages = pages.reshape(new_shape).transpose([1, 3, 4, 2, 0])
+
+        return pages
+
+    @property
+    def _page_steps(self):
+        """ Number of pages between consecutive slices and between consecutive frames (see
+        _read_pages for the order of pages in the tiff files)."""
+        if self.is_slow_stack:
+            frame_step = self.num_channels
+            slice_step = self.num_channels * self.num_frames
+        else:
+            slice_step = self.num_channels
+            frame_step = self.num_channels * self.num_scanning_depths
+        return slice_step, frame_step
+
+    def _read_page_list(self, pages_to_read, yslice=slice(None), xslice=slice(None)):
+        """ Reads tiff pages (numbered across all files in the scan) and slices them in the
+        y, x dimension.
+
+        Args:
+            pages_to_read: List of integers. Pages to read.
+            yslice: Slice object. How to slice the pages in the y axis.
+            xslice: Slice object. How to slice the pages in the x axis.
+
+        Returns:
+            A 3-d array (num_pages, output_height, output_width).
+
+        Note:
+            Pages are read once each and in the order they are stored (whatever the order
+            of pages_to_read), then placed where requested; duplicates are copied in
+            memory rather than read again.
+        """
+        read_stats = self._stats
+        clock = time.perf_counter if read_stats is not None else _no_clock
+        io_seconds = decode_seconds = 0
+        tracker = current()
+
         # Compute output dimensions
         out_height = len(utils.listify_index(yslice, self._page_height))
         out_width = len(utils.listify_index(xslice, self._page_width))
 
+        # Read each page once and in file order (sequential access even for reversed or
+        # random frames), into the first position in the output where it is requested
+        pages_to_read = np.asarray(pages_to_read, dtype=np.int64)
+        order = np.argsort(pages_to_read, kind='stable')
+        sorted_pages = pages_to_read[order]
+        is_first = np.ones(len(sorted_pages), dtype=bool)
+        is_first[1:] = sorted_pages[1:] != sorted_pages[:-1]
+        unique_pages = sorted_pages[is_first]
+        first_positions = order[is_first]
+        file_starts = np.cumsum([0] + [page_index.num_pages for page_index in
+                                       self.page_indices])
+        file_bounds = np.searchsorted(unique_pages, file_starts)
+
         # Read pages
         pages = np.empty([len(pages_to_read), out_height, out_width], dtype=self.dtype)
-        start_page = 0
-        for tiff_file in self.tiff_files:
+        calibration = self._calibration
+        if calibration is not None:
+            channels = (unique_pages % self.num_channels).tolist()
+        bytes_read = file_cache_hits = file_cache_misses = 0
+        for file_id, page_index in enumerate(self.page_indices):
 
             # Get indices in this tiff file and in output array
-            final_page_in_file = start_page + len(tiff_file.pages)
-            is_page_in_file = lambda page: page in range(start_page, final_page_in_file)
-            pages_in_file = filter(is_page_in_file, pages_to_read)
-            file_indices = [page - start_page for page in pages_in_file]
-            global_indices = [is_page_in_file(page) for page in pages_to_read]
+            first, last = file_bounds[file_id], file_bounds[file_id + 1]
+            file_indices = (unique_pages[first:last] - file_starts[file_id]).tolist()
+            output_indices = first_positions[first:last]
+
+            if len(file_indices) > 0 and tracker is not None:
+                tracker.check()
 
             # Read from this tiff file (if needed)
-            if len(file_indices) > 0:
+            if len(file_indices) > 0 and page_index.is_contiguous:
+                # read only the needed rows of each page straight from disk
+                is_open = self.file_handles.is_open(file_id)
+                with self.file_handles.open(file_id) as file_handle:
+                    for i, (output_index, file_index) in enumerate(zip(output_indices,
+                                                                       file_indices)):
+                        start = clock()
+                        page = page_index.read_page(file_handle, file_index, yslice)
+                        read_end = clock()
+                        if calibration is None:
+                            pages[output_index] = page[:, xslice]
+                        else:
+                            calibration.apply(page[:, xslice], channels[first + i],
+                                              out=pages[output_index])
+                        io_seconds += read_end - start
+                        decode_seconds += clock() - read_end
+                        bytes_read += page.nbytes
+                        if tracker is not None and (i + 1) % PAGES_PER_UPDATE == 0:
+                            tracker.update(PAGES_PER_UPDATE,
+                                           PAGES_PER_UPDATE * page.nbytes)
+                if tracker is not None and len(file_indices) % PAGES_PER_UPDATE:
+                    num_pages = len(file_indices) % PAGES_PER_UPDATE
+                    tracker.update(num_pages, num_pages * page.nbytes)
+            elif len(file_indices) > 0:
+                is_open = self.tiff_files.is_open(file_id)
+                start = clock()
                 # this line looks a bit ugly but is memory efficient. Do not separate
-                pages[global_indices] = tiff_file.asarray(key=file_indices)[..., yslice, xslice]
-            start_page += len(tiff_file.pages)
+                with self.tiff_files.open(file_id) as tiff_file:
+                    if calibration is None:
+                        pages[output_indices] = tiff_file.asarray(key=file_indices)[..., yslice, xslice]
+                    else:
+                        file_pages = tiff_file.asarray(key=file_indices).reshape(
+                            len(file_indices), page_index.height, page_index.width)
+                        for i, output_index in enumerate(output_indices):
+                            calibration.apply(file_pages[i, yslice, xslice],
+                                              channels[first + i], out=pages[output_index])
+                decode_seconds += clock() - start
+                bytes_read += len(file_indices) * page_index.page_nbytes
+                if tracker is not None:
+                    tracker.update(len(file_indices),
+                                   len(file_indices) * page_index.page_nbytes)
+            if len(file_indices) > 0:
+                file_cache_hits += is_open
+                file_cache_misses += not is_open
 
-        # Reshape the pages into (slices, y, x, channels, frames)
-        new_shape = [len(frame_list), len(slice_list), len(channel_list), out_height, out_width]
-        pages = pages.reshape(new_shape).transpose([1, 3, 4, 2, 0])
+        # Copy pages requested more than once from their first copy
+        if len(unique_pages) < len(pages_to_read):
+            first_copy = first_positions[np.cumsum(is_first) - 1]
+            pages[order[~is_first]] = pages[first_copy[~is_first]]
+
+        if read_stats is not None:
+            read_stats.add_seconds('io', io_seconds)
+            read_stats.add_seconds('decode', decode_seconds)
+            read_stats.add(pages_read=len(unique_pages), bytes_read=bytes_read,
+                           bytes_allocated=pages.nbytes, file_cache_hits=file_cache_hits,
+                           file_cache_misses=file_cache_misses)
 
         return pages
 
@@ -475,6 +1225,14 @@ class BaseScan5(BaseScan):
     def field_depths(self):
         return self.scanning_depths
 
+    @property
+    def field_heights(self):
+        return [self.image_height] * self.num_fields
+
+    @property
+    def field_widths(self):
+        return [self.image_width] * self.num_fields
+
     @property
     def image_height(self):
         return self._page_height
@@ -527,6 +1285,7 @@ class BaseScan5(BaseScan):
         x_angle_scaler = float(match.group('angle_scaler')) if match else None
         return x_angle_scaler
 
+    @stats.recorded('getitem')
     def __getitem__(self, key):
         """ In non-multiROI, all fields have the same x, y dimensions. """
         # Fill key to size 5 (raises IndexError if more than 5)
@@ -551,19 +1310,26 @@ class BaseScan5(BaseScan):
         # Edge case when slice index gives 0 elements or index is empty list, e.g., scan[10:0], scan[[]]
         if [] in [field_list, y_list, x_list, channel_list, frame_list,]:
             return np.empty(0)
+        self._check_memory(len(field_list) * len(y_list) * len(x_list) *
+                           len(channel_list) * len(frame_list) *
+                           np.dtype(self.dtype).itemsize)
 
         # Read the required pages
         pages = self._read_pages(field_list, channel_list, frame_list)
 
         # Index in y, x using the original key (usually slices) for memory efficiency.
-        if isinstance(full_key[1], list) and isinstance(full_key[2], list):
-            # Our behaviour for lists is to take the submatrix defined by those indices.
-            ys = [[y] for y in y_list] # ys as nested lists does the trick
-            item = pages[:, ys, x_list, :, :]
-        else:
-            item = pages[:, full_key[1], full_key[2], :, :]
-            item = item.reshape(len(field_list), len(y_list), len(x_list), len(channel_list),
-                                len(frame_list)) # put back any dropped dimension
+        with stats.stage(self._stats, 'transpose'):
+            if isinstance(full_key[1], list) and isinstance(full_key[2], list):
+                # Our behaviour for lists is to take the submatrix defined by those indices.
+                ys = [[y] for y in y_list] # ys as nested lists does the trick
+                item = pages[:, ys, x_list, :, :]
+            else:
+                item = pages[:, full_key[1], full_key[2], :, :]
+                # put back any dropped dimension
+                item = item.reshape(len(field_list), len(y_list), len(x_list),
+                                    len(channel_list), len(frame_list))
+        if self._stats is not None:
+            self._stats.add(bytes_allocated=item.nbytes)
 
         # If original index was an integer, delete that axis (as in numpy indexing)
         squeeze_dims = [i for i, index in enumerate(full_key) if np.issubdtype(type(index),
@@ -572,6 +1338,17 @@ class BaseScan5(BaseScan):
 
         return item
 
+    @stats.recorded('fields')
+    def _read_fields(self, field_list, channel_list, frame_list):
+        """ Each field is one slice so each page holds a single field."""
+        pages = self._read_pages(field_list, channel_list, frame_list)
+        return list(pages)
+
+    def _field_regions(self, field_id):
+        """ Each field is a whole page."""
+        yslice, xslice = slice(0, self.image_height), slice(0, self.image_width)
+        return [(field_id, yslice, xslice, yslice, xslice)]
+
 
 class Scan5Point1(BaseScan5):
     """ ScanImage 5.1. Basic."""
@@ -752,9 +1529,9 @@ class ScanMultiROI(NewerScan, BaseScan):
         microns = (degrees * float(match.group('deg2um_factor'))) if match else None
         return microns
 
-    def read_data(self, filenames, dtype):
+    def read_data(self, filenames, dtype, header=None, roi_metadata=None):
         """ Set the header, create rois and fields (joining them if necessary)."""
-        super().read_data(filenames, dtype)
+        super().read_data(filenames, dtype, header=header, roi_metadata=roi_metadata)
         self.rois = self._create_rois()
         self.fields = self._create_fields()
         if self.join_contiguous:
@@ -762,7 +1539,10 @@ class ScanMultiROI(NewerScan, BaseScan):
 
     def _create_rois(self):
         """Create scan rois from the configuration file. """
-        roi_infos = self.tiff_files[0].scanimage_metadata['RoiGroups']['imagingRoiGroup']['rois']
+        roi_metadata = self._roi_metadata
+        if roi_metadata is None: # no metadata block after the header, let tifffile look
+            roi_metadata = self.tiff_files[0].scanimage_metadata
+        roi_infos = roi_metadata['RoiGroups']['imagingRoiGroup']['rois']
         roi_infos = roi_infos if isinstance(roi_infos, list) else [roi_infos]
         roi_infos = list(filter(lambda r: isinstance(r['zs'], (int, float, list)),
                                 roi_infos)) # discard empty/malformed ROIs
@@ -799,10 +1579,10 @@ class ScanMultiROI(NewerScan, BaseScan):
                     new_field.slice_id = slice_id
                     new_field.roi_ids = [roi_id]
 
-                    # Set timing offsets
+                    # Set timing offsets (of the page columns the field is cut from)
                     offsets = self._compute_offsets(new_field.height, previous_lines +
                                                                       next_line_in_page)
-                    new_field.offsets = [offsets]
+                    new_field.offsets = [offsets[:, new_field.xslices[0]]]
 
                     # Compute next starting y
                     next_line_in_page += new_field.height + self._num_fly_to_lines
@@ -847,7 +1627,61 @@ class ScanMultiROI(NewerScan, BaseScan):
                         two_fields_were_joined = True
                         break
 
+    @stats.recorded('fields')
+    def _read_fields(self, field_list, channel_list, frame_list):
+        """ Fields in the same slice share pages: read the band of rows spanning all
+        requested fields in that slice once and cut each field from it. Slices whose
+        bands coincide (the usual case) are read together, so pages are read in the order
+        they appear in the file."""
+        # Band of rows needed from each slice
+        bands = {}
+        for field_id in field_list:
+            field = self.fields[field_id]
+            band_start, band_stop = bands.get(field.slice_id, (self._page_height, 0))
+            bands[field.slice_id] = (min([band_start] + [ys.start for ys in field.yslices]),
+                                     max([band_stop] + [ys.stop for ys in field.yslices]))
+
+        fields = {}
+        for band_start, band_stop in sorted(set(bands.values())):
+            slice_list = sorted(slice_id for slice_id, band in bands.items() if band ==
+                                (band_start, band_stop))
+
+            # Read the required pages (only the rows spanned by the fields)
+            pages = self._read_pages(slice_list, channel_list, frame_list,
+                                     slice(band_start, band_stop))
+
+            # Cut each field (and each of its subfields) from the band
+            with stats.stage(self._stats, 'scatter'):
+                for field_id in set(field_list):
+                    field = self.fields[field_id]
+                    if field.slice_id not in slice_list:
+                        continue
+                    slice_pages = pages[slice_list.index(field.slice_id)]
+                    item = np.empty([field.height, field.width, len(channel_list),
+                                     len(frame_list)], dtype=self.dtype)
+                    slices = zip(field.yslices, field.xslices, field.output_yslices,
+                                 field.output_xslices)
+                    for yslice, xslice, output_yslice, output_xslice in slices:
+                        band_yslice = slice(yslice.start - band_start,
+                                            yslice.stop - band_start)
+                        item[output_yslice, output_xslice] = slice_pages[band_yslice, xslice]
+                    fields[field_id] = item
+                    if self._stats is not None:
+                        self._stats.add(bytes_allocated=item.nbytes)
+
+        return [fields[field_id] for field_id in field_list]
+
+    def _field_regions(self, field_id):
+        field = self.fields[field_id]
+        return [(field.slice_id, *slices) for slices in zip(field.yslices, field.xslices,
+                                                              field.output_yslices,
+                                                              field.output_xslices)]
+
+    @stats.recorded('getitem')
     def __getitem__(self, key):
+        """ Fields may have different heights and widths and be made of several
+        subfields; see plans.ReadPlan for how pages are read and sliced. Contiguous
+        selections are copied with basic slicing."""
         # Fill key to size 5 (raises IndexError if more than 5)
         full_key = utils.fill_key(key, num_dimensions=5)
 
@@ -855,62 +1689,4 @@ class ScanMultiROI(NewerScan, BaseScan):
         for i, index in enumerate(full_key):
             utils.check_index_type(i, index)
 
-        # Check each dimension is in bounds
-        utils.check_index_is_in_bounds(0, full_key[0], self.num_fields)
-        for field_id in utils.listify_index(full_key[0], self.num_fields):
-            utils.check_index_is_in_bounds(1, full_key[1], self.field_heights[field_id])
-            utils.check_index_is_in_bounds(2, full_key[2], self.field_widths[field_id])
-        utils.check_index_is_in_bounds(3, full_key[3], self.num_channels)
-        utils.check_index_is_in_bounds(4, full_key[4], self.num_frames)
-
-        # Get fields, channels and frames as lists
-        field_list = utils.listify_index(full_key[0], self.num_fields)
-        y_lists = [utils.listify_index(full_key[1], self.field_heights[field_id]) for
-                   field_id in field_list]
-        x_lists = [utils.listify_index(full_key[2], self.field_widths[field_id]) for
-                   field_id in field_list]
-        channel_list = utils.listify_index(full_key[3], self.num_channels)
-        frame_list = utils.listify_index(full_key[4], self.num_frames)
-
-        # Edge case when slice index gives 0 elements or index is empty list, e.g., scan[10:0], scan[[]]
-        if [] in [field_list, *y_lists, *x_lists, channel_list, frame_list]:
-            return np.empty(0)
-
-        # Check output heights and widths match for all fields
-        if not all(len(y_list) == len(y_lists[0]) for y_list in y_lists):
-            raise FieldDimensionMismatch('Image heights for all fields do not match')
-        if not all(len(x_list) == len(x_lists[0]) for x_list in x_lists):
-            raise FieldDimensionMismatch('Image widths for all fields do not match')
-
-        # Over each field, read required pages and slice
-        item = np.empty([len(field_list), len(y_lists[0]), len(x_lists[0]),
-                        len(channel_list), len(frame_list)], dtype=self.dtype)
-        for i, (field_id, y_list, x_list) in enumerate(zip(field_list, y_lists, x_lists)):
-            field = self.fields[field_id]
-
-            # Over each subfield in field (only one for non-contiguous fields)
-            slices = zip(field.yslices, field.xslices, field.output_yslices, field.output_xslices)
-            for yslice, xslice, output_yslice, output_xslice in slices:
-
-                # Read the required pages (and slice out the subfield)
-                pages = self._read_pages([field.slice_id], channel_list, frame_list,
-                                         yslice, xslice)
-
-                # Get x, y indices that need to be accessed in this subfield
-                y_range = range(output_yslice.start, output_yslice.stop)
-                x_range = range(output_xslice.start, output_xslice.stop)
-                ys = [[y - output_yslice.start] for y in y_list if y in y_range]
-                xs = [x - output_xslice.start for x in x_list if x in x_range]
-                output_ys = [[index] for index, y in enumerate(y_list) if y in y_range]
-                output_xs = [index for index, x in enumerate(x_list) if x in x_range]
-                # ys as nested lists are needed for numpy to slice them correctly
-
-                # Index pages in y, x
-                item[i, output_ys, output_xs] = pages[0, ys, xs]
-
-        # If original index was an integer, delete that axis (as in numpy indexing)
-        squeeze_dims = [i for i, index in enumerate(full_key) if np.issubdtype(type(index),
-                                                                               np.signedinteger)]
-        item = np.squeeze(item, axis=tuple(squeeze_dims))
-
-        return item
\ No newline at end of file
+        return self.plan(full_key[:4]).read(full_key[4])
\ No newline at end of file
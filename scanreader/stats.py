@@ -0,0 +1,144 @@
+"""
+Opt-in instrumentation of reads.
+
+After scan.enable_stats(), every read of the scan (scan[...], plan reads and the chunks
+read by reductions, exports and other chunked operations) records how long it spent in
+each stage, how many pages and bytes it read from disk, how much memory it allocated and
+whether the files it needed were already open. scan.stats has the totals so far and an
+optional callback receives the record of each read as it finishes (e.g., to send it to a
+metrics system). Reads done in worker processes are not recorded.
+
+Stages:
+    index: Walking the IFDs of the tiff files (only in the first read that needs it).
+    io: Reading page data from disk.
+    decode: Copying (and casting to the scan dtype and calibrating) raw pages into the
+        read buffer, or decoding them with tifffile for files not stored contiguously.
+    transpose: Reordering pages into the (fields, y, x, channels, frames) output.
+    scatter: Copying fields (and their subfields) into the output of multiROI scans.
+"""
+from contextlib import contextmanager
+import copy
+import functools
+import threading
+import time
+
+STAGES = ('index', 'io', 'decode', 'transpose', 'scatter')
+COUNTERS = ('pages_read', 'bytes_read', 'bytes_allocated', 'file_cache_hits',
+            'file_cache_misses')
+
+
+def _new_record():
+    record = {'num_reads': 0, 'seconds': 0.0}
+    record.update({counter: 0 for counter in COUNTERS})
+    record['stage_seconds'] = {stage: 0.0 for stage in STAGES}
+    return record
+
+
+class ReadStats:
+    """ Counters and timings of the reads of a scan. Safe to use from several threads:
+    each thread records its own reads.
+
+    Attributes:
+        callback: Function or None. Called with the record (a dictionary like
+            snapshot() for a single read, plus the 'kind' of read) of every read once it
+            finishes.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._totals = _new_record()
+        self._lock = threading.Lock()
+        self._local = threading.local() # record of the read in progress in each thread
+
+    def snapshot(self):
+        """ Totals over all reads recorded so far (a copy)."""
+        with self._lock:
+            return copy.deepcopy(self._totals)
+
+    def reset(self):
+        """ Set all totals back to zero."""
+        with self._lock:
+            self._totals = _new_record()
+
+    @contextmanager
+    def read(self, kind):
+        """ Record a read. Reads started inside another read (in the same thread) are
+        part of it."""
+        if getattr(self._local, 'record', None) is not None:
+            yield
+            return
+
+        record = _new_record()
+        record.update({'kind': kind, 'num_reads': 1})
+        self._local.record = record
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self._local.record = None
+            with self._lock:
+                self._totals['num_reads'] += 1
+                self._totals['seconds'] += record['seconds']
+                for counter in COUNTERS:
+                    self._totals[counter] += record[counter]
+                for stage in STAGES:
+                    self._totals['stage_seconds'][stage] += record['stage_seconds'][stage]
+            if self.callback is not None:
+                self.callback(record)
+
+    @contextmanager
+    def stage(self, stage):
+        """ Time a stage of the current read."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_seconds(stage, time.perf_counter() - start)
+
+    def add_seconds(self, stage, seconds):
+        """ Add time spent in a stage to the current read (or to the totals if there is
+        none, e.g., indexing pages to get scan.shape)."""
+        record = getattr(self._local, 'record', None)
+        if record is None:
+            with self._lock:
+                self._totals['stage_seconds'][stage] += seconds
+        else:
+            record['stage_seconds'][stage] += seconds
+
+    def add(self, **counts):
+        """ Add to the counters (see COUNTERS) of the current read."""
+        record = getattr(self._local, 'record', None)
+        if record is None:
+            with self._lock:
+                for counter, count in counts.items():
+                    self._totals[counter] += count
+        else:
+            for counter, count in counts.items():
+                record[counter] += count
+
+
+@contextmanager
+def _no_stats():
+    yield
+
+
+def read(stats, kind):
+    """ stats.read(kind), or a context manager that does nothing if stats is None."""
+    return _no_stats() if stats is None else stats.read(kind)
+
+
+def stage(stats, stage_name):
+    """ stats.stage(stage_name), or a context manager that does nothing if stats is None."""
+    return _no_stats() if stats is None else stats.stage(stage_name)
+
+
+def recorded(kind):
+    """ Decorator for Scan methods that read data: records each call as a read of the
+    given kind if the scan is recording reads."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(scan, *args, **kwargs):
+            with read(scan._stats, kind):
+                return method(scan, *args, **kwargs)
+        return wrapper
+    return decorator
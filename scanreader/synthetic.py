@@ -0,0 +1,267 @@
+"""
+Synthetic ScanImage tiff files.
+
+Real scans are too big to ship with the repo, so tests and benchmarks can write their own
+with write_scan(). Files are laid out the way ScanImage writes them: one uncompressed
+int16 page per channel and slice (in ScanImage's page order), the frame metadata in the
+ImageDescription tag of every page and the acquisition header in the ImageDescription
+(5.x) or in the Software tag and the ScanImage metadata block after the tiff header
+(2016b and beyond, where the ROI group of multiROI scans is also stored). Image data is
+a smooth background plus noise, deterministic for a given seed.
+"""
+import json
+import struct
+import numpy as np
+
+_SCANNER_FREQUENCY = 12000 # Hz, bidirectional resonant scanner
+_FLY_TO_SECONDS = 0.0002 # time to fly between ROIs
+_ROI_CENTER_SPACING = 2 # distance between default ROI centers (in ROI widths)
+
+
+def write_scan(prefix, version='2016b', num_channels=2, depths=(0, 10, 20), num_frames=10,
+               height=64, width=64, rois=None, slow_stack=False, num_files=1, fps=5.0,
+               channel_offsets=(0, 0, 0, 0), seed=0):
+    """ Write a synthetic ScanImage scan.
+
+    Args:
+        prefix: String. Path (without extension) of the files to write; files are named
+            prefix_00001.tif, prefix_00002.tif, ...
+        version: String. ScanImage version ('5.1', '5.2', ..., '2016b', ..., '2020').
+        num_channels: Integer. Number of channels saved.
+        depths: List of numbers. Scanning depths (one slice per depth).
+        num_frames: Integer. Number of frames (volumes) recorded. For slow stacks, number
+            of frames recorded at each depth.
+        height, width: Integers. Size of the images (ignored for multiROI scans).
+        rois: List of dictionaries or None. If given, write a multiROI scan (needs version
+            2016b or newer) with one ROI per dictionary, with keys 'height' and 'width'
+            (in pixels) and optionally 'depths' (list of depths the ROI is imaged at;
+            default: all), 'center' and 'size' ([x, y] in degrees). ROIs imaged at the
+            same depth are stacked (in order) in the same page, separated by fly-to lines.
+            Pages are as wide as the widest ROI; narrower ROIs fill the left of the page.
+        slow_stack: Boolean. Write a slow stack (all frames at a depth before moving to
+            the next one) rather than a volumetric (fastZ) scan.
+        num_files: Integer. Number of files to split the pages into.
+        fps: Float. Volume rate saved in the header.
+        channel_offsets: List of numbers. Offset of each of the (four) acquisition
+            channels saved in the header (hChannels.channelOffset). Image data is not
+            shifted by them.
+        seed: Integer. Seed for the image data.
+
+    Returns:
+        List of strings. Filenames of the written files.
+    """
+    is_old = version.startswith('5')
+    if rois is not None and is_old:
+        raise ValueError('MultiROI scans need ScanImage 2016b or newer')
+    depths = list(depths)
+    header = _header(version, num_channels, depths, num_frames, slow_stack,
+                     rois is not None, fps, channel_offsets)
+    seconds_per_line = 1 / _SCANNER_FREQUENCY / 2 # bidirectional
+    num_fly_to_lines = int(np.ceil(_FLY_TO_SECONDS / seconds_per_line))
+    num_fly_to_lines += num_fly_to_lines % 2
+
+    # Page size and ROI group
+    if rois is None:
+        roi_infos = [{'zs': 0, 'discretePlaneMode': 0, 'scanfields': {
+            'pixelResolutionXY': [width, height], 'centerXY': [0, 0],
+            'sizeXY': [1, 1]}}]
+    else:
+        roi_infos = [_roi_info(roi, i) for i, roi in enumerate(rois)]
+        rois_per_depth = [[roi for roi in rois if depth in roi.get('depths', depths)] for
+                          depth in depths]
+        height = max(sum(roi['height'] for roi in depth_rois) + num_fly_to_lines *
+                     (len(depth_rois) - 1) for depth_rois in rois_per_depth)
+        width = max(roi['width'] for roi in rois)
+    roi_group = {'RoiGroups': {'imagingRoiGroup': {'rois': roi_infos}}}
+
+    # Split pages into files (ScanImage splits them by frames)
+    num_pages = num_channels * len(depths) * num_frames
+    pages_per_file = int(np.ceil(num_pages / num_files))
+    background = _background(height, width, num_channels)
+    rng = np.random.default_rng(seed)
+    filenames = []
+    for file_id in range(num_files):
+        filename = '{}_{:05d}.tif'.format(prefix, file_id + 1)
+        page_ids = range(file_id * pages_per_file, min((file_id + 1) * pages_per_file,
+                                                       num_pages))
+        pages = (_page(background, page_id % num_channels, rng) for page_id in page_ids)
+        descriptions = [_frame_description(page_id, num_channels, len(depths), num_frames,
+                                           slow_stack, fps) for page_id in page_ids]
+        if is_old:
+            descriptions = [description + header for description in descriptions]
+            _write_tiff(filename, pages, (height, width), descriptions, software='',
+                        bigtiff=False)
+        else:
+            _write_tiff(filename, pages, (height, width), descriptions, software=header,
+                        bigtiff=True, scanimage_block=_scanimage_block(header, roi_group))
+        filenames.append(filename)
+
+    return filenames
+
+
+def _header(version, num_channels, depths, num_frames, slow_stack, is_multiROI, fps,
+            channel_offsets):
+    """ ScanImage acquisition header (one 'key = value' per line)."""
+    prefix = 'scanimage.SI5.' if version == '5.1' else ('scanimage.SI.' if
+                                                         version.startswith('5') else 'SI.')
+    channels = list(range(1, num_channels + 1))
+    values = [
+        ('VERSION_MAJOR', "'{}'".format(version)),
+        ('hChannels.channelSave', _matlab_str(channels)),
+        ('hChannels.channelOffset', _matlab_str(list(channel_offsets))),
+        ('hStackManager.zs', _matlab_str(depths)),
+        ('hStackManager.framesPerSlice', num_frames if slow_stack else 1),
+        ('hStackManager.slowStackWithFastZ', 'false'),
+        ('hFastZ.enable', 'false' if slow_stack else 'true'),
+        ('hFastZ.numVolumes', 1 if slow_stack else num_frames),
+        ('hMotors.motorSecondMotorZEnable', 'false'),
+        ('hMotors.motorPosition', _matlab_str([0, 0, 0])),
+        ('hScan2D.logAverageFactor', 1),
+        ('hScan2D.bidirectional', 'true'),
+        ('hScan2D.scannerFrequency', _SCANNER_FREQUENCY),
+        ('hScan2D.flybackTimePerFrame', 0.001),
+        ('hScan2D.flytoTimePerScanfield', _FLY_TO_SECONDS),
+        ('hScan2D.fillFractionSpatial', 0.9),
+        ('hScan2D.fillFractionTemporal', 0.712867),
+        ('hScan2D.scannerType', "'Resonant'"),
+        ('hRoiManager.mroiEnable', int(is_multiROI)),
+        ('hRoiManager.scanVolumeRate', fps),
+        ('hRoiManager.scanZoomFactor', 1),
+        ('hRoiManager.linePeriod', 4.15e-05),
+        ('hRoiManager.scanAngleMultiplierSlow', 1),
+        ('hRoiManager.scanAngleMultiplierFast', 1),
+        ('hRoiManager.imagingFovUm', '[-250 -250;250 -250;250 250;-250 250]'),
+    ]
+    lines = ['{}{} = {}'.format(prefix, key, value) for key, value in values]
+    lines.append('{}objectiveResolution = 15'.format(prefix))
+    return '\n'.join(lines) + '\n'
+
+
+def _matlab_str(values):
+    """ Matlab string for a list of numbers (a scalar if there is only one)."""
+    return str(values[0]) if len(values) == 1 else '[{}]'.format(' '.join(str(v) for v
+                                                                          in values))
+
+
+def _roi_info(roi, roi_id):
+    """ ScanImage definition of a ROI: a single scanfield (imaged at every depth) or one
+    scanfield per depth in discrete plane mode."""
+    size = roi.get('size', [roi['width'] / 100, roi['height'] / 100])
+    center = roi.get('center', [roi_id * _ROI_CENTER_SPACING * size[0], 0])
+    scanfield = {'pixelResolutionXY': [roi['width'], roi['height']], 'centerXY': center,
+                 'sizeXY': size}
+    if 'depths' not in roi:
+        return {'zs': 0, 'discretePlaneMode': 0, 'scanfields': scanfield}
+    return {'zs': list(roi['depths']), 'discretePlaneMode': 1,
+            'scanfields': [scanfield] * len(roi['depths'])}
+
+
+def _scanimage_block(header, roi_group):
+    """ ScanImage metadata block (written right after the tiff header): magic number,
+    version, sizes of the header and ROI group and both null-terminated strings."""
+    header_bytes = header.encode('ascii') + b'\0'
+    roi_bytes = json.dumps(roi_group).encode('ascii') + b'\0'
+    return (struct.pack('<IIII', 0x07030301, 3, len(header_bytes), len(roi_bytes)) +
+            header_bytes + roi_bytes)
+
+
+def _frame_description(page_id, num_channels, num_depths, num_frames, slow_stack, fps):
+    """ Frame metadata ScanImage writes in the ImageDescription of every page."""
+    if slow_stack: # pages ordered by channel, frame and slice
+        frame_id = page_id // num_channels
+    else: # pages ordered by channel, slice and frame
+        frame_id = page_id // (num_channels * num_depths)
+    return ('frameNumbers = {}\nacquisitionNumbers = 1\nframeTimestamps_sec = {:.6f}\n'
+            'acqTriggerTimestamps_sec = \nnextFileMarkerTimestamps_sec = \n'
+            'endOfAcquisition = {}\n').format(page_id // num_channels + 1, frame_id / fps,
+                                              int(page_id // num_channels == num_frames *
+                                                  num_depths - 1))
+
+
+def _background(height, width, num_channels):
+    """ Smooth background (different for each channel) for the synthetic images."""
+    ys, xs = np.meshgrid(np.linspace(0, np.pi, height), np.linspace(0, np.pi, width),
+                         indexing='ij')
+    return [(500 * (channel + 1) * np.sin(ys) * np.sin(xs)).astype(np.int16) for channel
+            in range(num_channels)]
+
+
+def _page(background, channel, rng):
+    """ Image for one page: background plus noise."""
+    noise = rng.integers(-100, 100, size=background[channel].shape, dtype=np.int16)
+    return background[channel] + noise
+
+
+def _write_tiff(filename, pages, page_shape, descriptions, software='', bigtiff=True,
+                scanimage_block=b''):
+    """ Write int16 pages as a little-endian (Big)TIFF: every page is one uncompressed
+    strip stored right after its IFD and tag values. tifffile expects pages of ScanImage
+    files to be evenly spaced."""
+    height, width = page_shape
+    page_nbytes = height * width * 2
+    if bigtiff:
+        file_header = b'II' + struct.pack('<HHHQ', 43, 8, 0, 0)
+        count_fmt, entry_fmt, offset_fmt, inline_size = '<Q', '<HHQ', '<Q', 8
+    else:
+        file_header = b'II' + struct.pack('<HI', 42, 0)
+        count_fmt, entry_fmt, offset_fmt, inline_size = '<H', '<HHI', '<I', 4
+    offset_type = 16 if bigtiff else 4
+    software = software.encode('ascii') + b'\0'
+
+    # Descriptions are padded to the same (even) size so every IFD has the same layout
+    descriptions = [description.encode('ascii') for description in descriptions]
+    description_size = max([len(d) for d in descriptions], default=0) + 1
+    description_size += description_size % 2
+
+    with open(filename, 'wb') as f:
+        f.write(file_header)
+        f.write(scanimage_block)
+        next_ifd_pointer = len(file_header) - struct.calcsize(offset_fmt)
+        for page, description in zip(pages, descriptions):
+            description = description.ljust(description_size, b'\0')
+            ifd_offset = f.tell() + f.tell() % 2 # IFDs start on a word boundary
+
+            # Tags (sorted by code) as (code, type, count, value or bytes)
+            tags = [(256, 4, 1, width), (257, 4, 1, height), (258, 3, 1, 16),
+                    (259, 3, 1, 1), (262, 3, 1, 1), (270, 2, len(description), description),
+                    (273, offset_type, 1, None), (277, 3, 1, 1), (278, 4, 1, height),
+                    (279, offset_type, 1, page_nbytes), (305, 2, len(software), software),
+                    (339, 3, 1, 2)]
+            entry_size = struct.calcsize(entry_fmt) + inline_size
+            ifd_nbytes = (struct.calcsize(count_fmt) + entry_size * len(tags) +
+                          struct.calcsize(offset_fmt))
+            values_offset = ifd_offset + ifd_nbytes
+            data_offset = values_offset + sum(len(value) for *_, value in tags if
+                                              isinstance(value, bytes) and
+                                              len(value) > inline_size)
+
+            ifd = struct.pack(count_fmt, len(tags))
+            values = b''
+            for code, dtype, count, value in tags:
+                if value is None: # strip offset
+                    value = data_offset
+                if isinstance(value, bytes):
+                    if len(value) > inline_size:
+                        field = struct.pack(offset_fmt, values_offset + len(values))
+                        values += value
+                    else:
+                        field = value.ljust(inline_size, b'\0')
+                else:
+                    field = struct.pack({3: '<H', 4: '<I', 16: '<Q'}[dtype], value)
+                    field = field.ljust(inline_size, b'\0')
+                ifd += struct.pack(entry_fmt, code, dtype, count) + field
+            ifd += struct.pack(offset_fmt, 0) # next IFD (patched when writing the next)
+
+            # Link from the previous IFD, then write this page
+            f.seek(next_ifd_pointer)
+            f.write(struct.pack(offset_fmt, ifd_offset))
+            f.seek(ifd_offset)
+            f.write(ifd + values)
+            f.write(np.ascontiguousarray(page, dtype='<i2').tobytes())
+            next_ifd_pointer = ifd_offset + ifd_nbytes - struct.calcsize(offset_fmt)
+
+        # tifffile finds the pages of classic (5.x) ScanImage files by stepping from the
+        # second page while more than a page is left in the file, so it would miss the
+        # last page if it ended the file
+        if not bigtiff:
+            f.write(b'\0' * 8)
@@ -14,7 +14,9 @@ setup(
     url='https://github.com/atlab/scanreader',
     keywords='ScanImage scanreader multiROI 2016b tiff',
     packages=['scanreader'],
-    install_requires=['numpy>=1.12.0', 'tifffile>=2019.2.22'],
+    python_requires='>=3.9', # concurrent.futures cancel_futures
+    install_requires=['numpy>=1.17.0', 'tifffile>=2019.2.22'], # numpy.random.Generator
+    extras_require={'hdf5': ['h5py>=2.10']},
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Science/Research',
@@ -5,11 +5,14 @@ Run from inside scanreader/ as:
     `nose2 test_scanreader.ScanTest.test_2020` (a specific test)
 """
 
-from unittest import TestCase
+from unittest import TestCase, mock
 from os import path
 import numpy as np
 import scanreader
-from scanreader.exceptions import ScanReaderException
+from scanreader import synthetic
+from scanreader.exceptions import (ScanReaderException, PageLayoutError, MemoryBudgetError,
+                                   ReadCancelled, CatalogError,
+                                   ScanMismatchError)
 
 # Get data directory
 data_dir = path.join(path.dirname(path.abspath(__file__)), 'data')
@@ -533,6 +536,21 @@ class ScanTest(TestCase):
 
 
 
+def _sum_field(scan, field_id):
+    """ Helper for test_pickle (needs to be importable from worker processes)."""
+    return np.sum(scan[field_id], dtype=int)
+
+
+def _sum_block(block):
+    """ Helper for test_map_blocks."""
+    return np.sum(block, dtype=int)
+
+
+def _block_nbytes(block):
+    """ Helper for test_memory_budget."""
+    return block.nbytes
+
+
 class StackTest(TestCase):
     """ Test reading stacks from different ScanImage versions. """
 
@@ -736,4 +754,841 @@ class StackTest(TestCase):
         first_channel = scan[:, :, :, 0, :]
         self.assertEqualShapeAndSum(first_channel, (204, 360, 120, 10), 26825949131)
         first_frame = scan[:, :, :, :, 0]
-        self.assertEqualShapeAndSum(first_frame, (204, 360, 120, 2), 2952050950)
\ No newline at end of file
+        self.assertEqualShapeAndSum(first_frame, (204, 360, 120, 2), 2952050950)
+
+class SyntheticTest(TestCase):
+    """ Test reading synthetic scans (these do not need the sample data)."""
+
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.prefix = path.join(self.tmp_dir.name, 'scan')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read_pages(self, filenames):
+        """ All pages in the files (as read by tifffile)."""
+        import tifffile
+        pages = []
+        for filename in filenames:
+            with tifffile.TiffFile(filename) as tiff_file:
+                pages.extend(page.asarray() for page in tiff_file.pages)
+        return np.stack(pages)
+
+    def test_scan(self):
+        filenames = synthetic.write_scan(self.prefix, version='2018b', num_channels=2,
+                                         depths=[0, 10, 20], num_frames=7, height=40,
+                                         width=30, num_files=3)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        self.assertEqual(scan.version, '2018b')
+        self.assertEqual(scan.is_multiROI, False)
+        self.assertEqual(scan.is_slow_stack, False)
+        self.assertEqual(scan.scanning_depths, [0, 10, 20])
+        self.assertEqual(scan.shape, (3, 40, 30, 2, 7))
+
+        # Pages are ordered by channel, slice and frame
+        pages = self.read_pages(filenames).reshape(7, 3, 2, 40, 30)
+        self.assertTrue(np.array_equal(scan[:], pages.transpose([1, 3, 4, 2, 0])))
+        scan_as_array = np.asarray(scan, dtype=np.float32)
+        self.assertEqual(scan_as_array.dtype, np.float32)
+        self.assertTrue(np.array_equal(scan_as_array, pages.transpose([1, 3, 4, 2, 0])))
+
+    def test_slow_stack(self):
+        filenames = synthetic.write_scan(self.prefix, version='5.1', num_channels=2,
+                                         depths=[0, 1, 2, 3], num_frames=5, height=16,
+                                         width=16, slow_stack=True)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        self.assertEqual(scan.version, '5.1')
+        self.assertEqual(scan.is_slow_stack, True)
+        self.assertEqual(scan.shape, (4, 16, 16, 2, 5))
+
+        # Pages are ordered by channel, frame and slice
+        pages = self.read_pages(filenames).reshape(4, 5, 2, 16, 16)
+        self.assertTrue(np.array_equal(scan[:], pages.transpose([0, 3, 4, 2, 1])))
+
+        # tifffile (used for pages not stored contiguously) finds every page too
+        for page_index in scan.page_indices:
+            page_index.is_contiguous = False
+        self.assertTrue(np.array_equal(scan[:], pages.transpose([0, 3, 4, 2, 1])))
+
+    def test_multiroi(self):
+        rois = [{'height': 20, 'width': 16}, {'height': 10, 'width': 16, 'depths': [10]},
+                {'height': 30, 'width': 12, 'depths': [0, 20]}]
+        filenames = synthetic.write_scan(self.prefix, num_channels=1, depths=[0, 10, 20],
+                                         num_frames=4, rois=rois, num_files=2)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        self.assertEqual(scan.is_multiROI, True)
+        self.assertEqual(scan.num_rois, 3)
+        self.assertEqual(scan.num_fields, 6)
+        self.assertEqual(scan.field_heights, [20, 30, 20, 10, 20, 30])
+        self.assertEqual(scan.field_widths, [16, 12, 16, 16, 16, 12])
+        self.assertEqual(scan.field_slices, [0, 0, 1, 1, 2, 2])
+
+        # Fields narrower than the page keep the time offsets of the columns they are cut
+        # from (field 1 is imaged after field 0 and its fly to lines)
+        self.assertEqual([offsets.shape for offsets in scan.field_offsets],
+                         list(zip(scan.field_heights, scan.field_widths)))
+        offsets = scan.field_offsets
+        lines_between_fields = scan.field_heights[0] + scan._num_fly_to_lines
+        self.assertTrue(np.allclose(offsets[1][:20] - offsets[0][:, :12],
+                                    lines_between_fields * scan.seconds_per_line))
+
+        # Fields are stacked (with fly to lines in between) in the page of their slice
+        pages = self.read_pages(filenames).reshape(4, 3, scan._page_height, scan._page_width)
+        for field_id, field in enumerate(scan.fields):
+            field_pages = pages[:, field.slice_id, field.yslices[0], field.xslices[0]]
+            self.assertTrue(np.array_equal(scan[field_id, :, :, 0],
+                                           field_pages.transpose([1, 2, 0])))
+
+    def test_join_contiguous(self):
+        rois = [{'height': 20, 'width': 16, 'center': [0, 0], 'size': [1, 1]},
+                {'height': 20, 'width': 16, 'center': [1, 0], 'size': [1, 1]}]
+        synthetic.write_scan(self.prefix, rois=rois)
+        scan = scanreader.read_scan(self.prefix + '_*.tif', join_contiguous=True)
+        self.assertEqual(scan.num_fields, 3)
+        self.assertEqual(scan.field_widths, [32, 32, 32])
+
+    def test_index_pages(self):
+        import tifffile
+        from scanreader import pages
+        data = np.arange(3 * 32 * 32, dtype=np.int16).reshape(3, 32, 32)
+        tifffile.imwrite(self.prefix + '_strips.tif', data, photometric='minisblack')
+        page_index = pages.index_pages(self.prefix + '_strips.tif')
+        self.assertEqual((page_index.num_pages, page_index.is_contiguous), (3, True))
+        with open(self.prefix + '_strips.tif', 'rb') as f:
+            self.assertTrue(np.array_equal(page_index.read_page(f, 2), data[2]))
+
+        # Pages without strips (e.g., tiled) are left to tifffile, not seen as truncated
+        tifffile.imwrite(self.prefix + '_tiles.tif', data, photometric='minisblack',
+                         tile=(16, 16))
+        page_index = pages.index_pages(self.prefix + '_tiles.tif', stop_at_incomplete=True)
+        self.assertEqual((page_index.num_pages, page_index.is_contiguous,
+                          page_index.truncation), (3, False, None))
+
+    def test_pickle(self):
+        import pickle
+        from concurrent.futures import ProcessPoolExecutor
+        rois = [{'height': 20, 'width': 16}, {'height': 12, 'width': 16}]
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=6,
+                             rois=rois, num_files=2)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        unpickled_scan = pickle.loads(pickle.dumps(scan))
+        self.assertEqual(unpickled_scan._tiff_files, None)
+        self.assertEqual(unpickled_scan.num_frames, scan.num_frames)
+        self.assertEqual(unpickled_scan.field_heights, scan.field_heights)
+        self.assertTrue(np.array_equal(unpickled_scan[1], scan[1]))
+
+        # Each worker reads a different field
+        with ProcessPoolExecutor(2) as executor:
+            sums = list(executor.map(_sum_field, [scan] * scan.num_fields,
+                                     range(scan.num_fields)))
+        self.assertEqual(sums, [np.sum(field, dtype=int) for field in scan])
+
+    def test_reduce(self):
+        rois = [{'height': 20, 'width': 16}, {'height': 12, 'width': 10}]
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=20,
+                             rois=rois)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+
+        # Sum images add up to the field sums
+        sum_images = scan.reduce('sum', chunk_frames=6, workers=2)
+        for field_id, sum_image in enumerate(sum_images):
+            self.assertEqual(sum_image.shape, (scan.field_heights[field_id],
+                                               scan.field_widths[field_id], 2))
+            self.assertTrue(np.allclose(sum_image, scan[field_id].sum(axis=-1)))
+
+        # Streamed results match reductions over the whole field
+        field = scan[2, :, :, 1, :]
+        for op in ['mean', 'var', 'max', 'median']:
+            result = scan.reduce(op, fields=2, channels=1, chunk_frames=7)
+            self.assertTrue(np.allclose(result, getattr(np, op)(field, axis=-1)))
+        mean_trace = scan.reduce('mean', axis='pixels', fields=2, channels=1)
+        self.assertTrue(np.allclose(mean_trace, field.mean(axis=(0, 1))))
+
+        # Scans with no frames yet (e.g., live scans) cannot be reduced
+        filenames = synthetic.write_scan(self.prefix + '_live', num_channels=2)
+        scan = scanreader.read_scan(filenames)
+        with open(filenames[0], 'r+b') as f:
+            f.truncate(scan.page_indices[0].offsets[1])
+        scan = scanreader.read_scan(filenames, live=True)
+        self.assertEqual(scan.num_frames, 0)
+        self.assertRaises(ValueError, lambda: scan.reduce('mean'))
+
+    def test_map_blocks(self):
+        rois = [{'height': 20, 'width': 16}, {'height': 12, 'width': 10}]
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=20,
+                             rois=rois)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+
+        num_blocks = 0
+        for field_id, frames, block in scan.map_blocks(np.copy, fields=[3, 0, 2],
+                                                       chunk_frames=6, workers=2):
+            self.assertTrue(np.array_equal(block, scan[field_id, :, :, :, frames]))
+            num_blocks += 1
+        self.assertEqual(num_blocks, 12) # 3 fields x 4 chunks
+
+        # Fields sums (unordered and over a single channel)
+        sums = [0] * scan.num_fields
+        for field_id, frames, block_sum in scan.map_blocks(_sum_block, channels=0,
+                                                           workers=2, ordered=False):
+            sums[field_id] += block_sum
+        self.assertEqual(sums, [np.sum(field[:, :, 0], dtype=int) for field in scan])
+
+    def test_to_zarr(self):
+        import json
+        rois = [{'height': 20, 'width': 16}, {'height': 12, 'width': 10}]
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=10,
+                             rois=rois)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        store = self.prefix + '.zarr'
+        scan.to_zarr(store, chunks=(None, None, 1, 4), workers=2)
+
+        self.assertEqual(json.load(open(path.join(store, '.zattrs')))['num_frames'], 10)
+        for field_id in range(scan.num_fields):
+            array_path = path.join(store, 'field{}'.format(field_id))
+            zarray = json.load(open(path.join(array_path, '.zarray')))
+            self.assertEqual(zarray['shape'], [scan.field_heights[field_id],
+                                               scan.field_widths[field_id], 2, 10])
+            self.assertEqual(json.load(open(path.join(array_path, '.zattrs')))['depth'],
+                             scan.field_depths[field_id])
+
+            # Chunks with the second channel and the last 4 frames (2 are padding)
+            chunk = np.fromfile(path.join(array_path, '0.0.1.2'), dtype=np.int16)
+            chunk = chunk.reshape(zarray['shape'][:2] + [1, 4])
+            self.assertTrue(np.array_equal(chunk[..., 0, :2], scan[field_id, :, :, 1, 8:]))
+
+    def test_to_binary(self):
+        rois = [{'height': 20, 'width': 16}, {'height': 12, 'width': 10}]
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=10,
+                             rois=rois)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        output_dir = self.prefix + '_suite2p'
+        metadata = scan.to_binary(output_dir, fields=[3, 0], channels=[1, 0],
+                                  chunk_frames=3)
+
+        self.assertEqual([plane['field_id'] for plane in metadata['planes']], [3, 0])
+        self.assertEqual([plane['Lx'] for plane in metadata['planes']], [10, 16])
+        for plane in metadata['planes']:
+            self.assertIsInstance(plane['time_offset'], float)
+            for channel, filename in zip([1, 0], plane['filenames']):
+                frames = np.fromfile(path.join(output_dir, filename), dtype=np.int16)
+                frames = frames.reshape(10, plane['Ly'], plane['Lx'])
+                expected = scan[plane['field_id'], :, :, channel].transpose([2, 0, 1])
+                self.assertTrue(np.array_equal(frames, expected))
+        self.assertTrue(path.isfile(path.join(output_dir, 'metadata.json')))
+
+        # Other dtypes are rounded and clipped to int16
+        scan = scanreader.read_scan(self.prefix + '_*.tif', dtype=np.float32)
+        scan.enable_calibration(offsets=[-40000, 0], scale=[1, 0.5])
+        metadata = scan.to_binary(output_dir, fields=1, channels=[0, 1])
+        plane = metadata['planes'][0]
+        for channel, filename in enumerate(plane['filenames']):
+            frames = np.fromfile(path.join(output_dir, filename), dtype=np.int16)
+            frames = frames.reshape(10, plane['Ly'], plane['Lx'])
+            expected = np.clip(np.rint(scan[1, :, :, channel]), -32768, 32767)
+            self.assertTrue(np.array_equal(frames, expected.transpose([2, 0, 1])))
+
+    def test_to_hdf5(self):
+        import h5py
+        rois = [{'height': 20, 'width': 16}, {'height': 12, 'width': 10}]
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=10,
+                             rois=rois)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        filename = self.prefix + '.h5'
+        scan.to_hdf5(filename, chunks=(None, None, 1, 4), workers=2)
+
+        with h5py.File(filename, 'r') as f:
+            self.assertEqual(f.attrs['frames_written'], 10)
+            for field_id in range(scan.num_fields):
+                dataset = f['field{}'.format(field_id)]
+                self.assertEqual(dataset.compression, 'gzip')
+                self.assertEqual(dataset.attrs['depth'], scan.field_depths[field_id])
+                self.assertTrue(np.array_equal(dataset[:], scan[field_id]))
+
+        # Interrupted exports resume where they stopped
+        with h5py.File(filename, 'a') as f:
+            f.attrs['frames_written'] = 4
+            f['field0'][..., 4:] = 0
+        scan.to_hdf5(filename, chunks=(None, None, 1, 4))
+        with h5py.File(filename, 'r') as f:
+            self.assertTrue(np.array_equal(f['field0'][:], scan[0]))
+
+        # Exports of other scans (same shapes, other data) or dtypes start over
+        synthetic.write_scan(self.prefix + '_other', num_channels=2, depths=[0, 10],
+                             num_frames=10, rois=rois, seed=1)
+        other_scan = scanreader.read_scan(self.prefix + '_other_*.tif')
+        other_scan.to_hdf5(filename, chunks=(None, None, 1, 4))
+        with h5py.File(filename, 'r') as f:
+            self.assertTrue(np.array_equal(f['field1'][:], other_scan[1]))
+        scan = scanreader.read_scan(self.prefix + '_0*.tif', dtype=np.float32)
+        scan.to_hdf5(filename, chunks=(None, None, 1, 4))
+        with h5py.File(filename, 'r') as f:
+            self.assertEqual(f['field1'].dtype, np.float32)
+            self.assertTrue(np.array_equal(f['field1'][:], scan[1]))
+
+    def test_pyramid(self):
+        from scanreader.pyramid import downsample
+        rois = [{'height': 40, 'width': 32}, {'height': 12, 'width': 10}]
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=10,
+                             rois=rois)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        pyramid = scan.build_pyramid(self.prefix + '.pyramid', levels=[1, 2, (4, 2)],
+                                     workers=2)
+
+        # Each level holds the field downsampled
+        for level, (spatial, temporal) in enumerate(pyramid.levels):
+            field, _ = pyramid.read(0, level=level)
+            expected = downsample(scan[0], spatial, temporal).astype(np.int16)
+            self.assertTrue(np.array_equal(field, expected))
+
+        # Regions at full resolution
+        region, level = pyramid.read(3, slice(2, 9), slice(1, 8), channel=1,
+                                     frames=slice(2, 9))
+        self.assertEqual(level, 0)
+        self.assertTrue(np.array_equal(region, scan[3, 2:9, 1:8, 1, 2:9]))
+
+        # Coarsest level that gives the requested resolution
+        self.assertEqual(pyramid.select_level(0, (20, 16, 5)), 1)
+        self.assertEqual(pyramid.select_level(0, (10, 8, 5)), 2)
+        self.assertEqual(pyramid.read(0, out_shape=(5, 5, 1))[0].shape, (10, 8, 2, 5))
+
+    def test_live(self):
+        import os
+        rois = [{'height': 20, 'width': 16}, {'height': 12, 'width': 10}]
+        filenames = synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10],
+                                         num_frames=12, rois=rois, num_files=2)
+        full_scan = scanreader.read_scan(filenames)
+        data = [open(filename, 'rb').read() for filename in filenames]
+
+        # First third of the first file
+        live_dir = path.join(self.tmp_dir.name, 'live')
+        os.mkdir(live_dir)
+        live_files = [path.join(live_dir, path.basename(filename)) for filename in
+                      filenames]
+        with open(live_files[0], 'wb') as f:
+            f.write(data[0][:len(data[0]) // 3])
+        scan = scanreader.read_scan(path.join(live_dir, '*.tif'), live=True)
+        self.assertLess(scan.num_frames, full_scan.num_frames)
+        for field_id in range(scan.num_fields):
+            self.assertTrue(np.array_equal(scan[field_id],
+                                           full_scan[field_id, :, :, :, :scan.num_frames]))
+
+        # Rest of the file and a new file matching the pathname (still empty, then with
+        # part of its tiff header and then complete)
+        with open(live_files[0], 'ab') as f:
+            f.write(data[0][len(data[0]) // 3:])
+        num_frames = scan.num_frames
+        for stop in [0, 4, len(data[1])]:
+            with open(live_files[1], 'wb') as f:
+                f.write(data[1][:stop])
+            scan.refresh()
+            if stop < len(data[1]):
+                self.assertEqual(scan.page_indices[1].num_pages, 0)
+                self.assertIn('Tiff header', scan.page_indices[1].truncation)
+        self.assertEqual(scan.num_frames, full_scan.num_frames)
+        self.assertGreater(scan.num_frames, num_frames)
+
+        # follow yields every frame once
+        frames = [block for _, (block, ) in scan.follow(fields=1, start_frame=0,
+                                                       timeout=0)]
+        self.assertTrue(np.array_equal(np.concatenate(frames, axis=-1), full_scan[1]))
+
+    def test_incremental_index(self):
+        from scanreader import pages
+        filenames = synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10],
+                                         num_frames=10)
+        full_index = pages.index_pages(filenames[0])
+        with open(filenames[0], 'rb') as f:
+            data = f.read()
+        growing_file = self.prefix + '_growing.tif'
+        page_index = None
+        for stop in np.linspace(len(data) // 10, len(data), 7).astype(int):
+            with open(growing_file, 'wb') as f:
+                f.write(data[:stop])
+            page_index = pages.index_pages(growing_file, stop_at_incomplete=True,
+                                           previous_index=page_index)
+            self.assertEqual(page_index.file_size, stop)
+        self.assertTrue(np.array_equal(page_index.offsets, full_index.offsets))
+
+    def test_file_pool(self):
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=10,
+                             num_files=3)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        expected = scan[0]
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        scan.max_open_files = 1
+        for field in scan:
+            self.assertLessEqual(scan.file_handles.num_open, 1)
+        self.assertTrue(np.array_equal(scan[0], expected))
+
+        # Same for files read with tifffile
+        for page_index in scan.page_indices:
+            page_index.is_contiguous = False
+        self.assertTrue(np.array_equal(scan[0], expected))
+        self.assertLessEqual(scan.tiff_files.num_open, 1)
+
+        # Files in use are not closed, however they are indexed
+        pool = scanreader.filepool.FilePool(scan.filenames,
+                                            lambda filename: open(filename, 'rb'), max_open=1)
+        with pool.open(-1) as file_handle:
+            pool[0]
+            self.assertFalse(file_handle.closed)
+            self.assertTrue(pool.is_open(2))
+        pool[0]
+        self.assertTrue(file_handle.closed)
+        pool.close()
+
+    def test_read_header(self):
+        import tifffile
+        from scanreader import pages
+        rois = [{'height': 20, 'width': 16}, {'height': 12, 'width': 10, 'depths': [10]}]
+        for version, kwargs in [('5.1', {}), ('5.2', {'slow_stack': True}),
+                                ('2016b', {}), ('2018b', {'rois': rois})]:
+            filenames = synthetic.write_scan('{}_{}'.format(self.prefix, version),
+                                             version=version, depths=[0, 10],
+                                             num_frames=3, **kwargs)
+            header, roi_metadata = pages.read_scanimage_header(filenames[0])
+            with tifffile.TiffFile(filenames[0]) as tiff_file:
+                self.assertEqual(tiff_file.is_bigtiff, not version.startswith('5'))
+                page = tiff_file.pages[0]
+                self.assertEqual(header, page.description + '\n' + page.software)
+                if version.startswith('5'):
+                    self.assertIsNone(roi_metadata)
+                else:
+                    self.assertEqual(roi_metadata['RoiGroups'],
+                                     tiff_file.scanimage_metadata['RoiGroups'])
+            scan = scanreader.read_scan(filenames)
+            self.assertEqual(scan.version, version)
+
+        # multiROI scans only index the first file to create their fields
+        filenames = synthetic.write_scan(self.prefix + '_files', rois=rois, num_frames=6,
+                                         num_files=3)
+        with mock.patch.object(pages, 'index_pages', wraps=pages.index_pages) as index_pages:
+            scan = scanreader.read_scan(filenames)
+            self.assertEqual([call[0][0] for call in index_pages.call_args_list],
+                             filenames[:1])
+            self.assertEqual(scan.num_frames, 6)
+            self.assertEqual(index_pages.call_count, 3) # first file is not indexed again
+
+    def test_plan(self):
+        rois = [{'height': 40, 'width': 32}, {'height': 12, 'width': 10}]
+        filenames = synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10],
+                                         num_frames=20, rois=rois)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        plan = scan.plan((0, slice(10, 30), slice(2, 30, 2), 1))
+        pages = self.read_pages(filenames).reshape(20, 2, 2, scan._page_height,
+                                                   scan._page_width)
+        field = scan.fields[0]
+        expected = pages[:, field.slice_id, 1, field.yslices[0], field.xslices[0]]
+        expected = expected[:, 10:30, 2:30:2].transpose([1, 2, 0])
+        self.assertTrue(np.array_equal(plan[5:17], expected[..., 5:17]))
+        self.assertTrue(np.array_equal(plan[[3, 1, 3]], expected[..., [3, 1, 3]]))
+        self.assertTrue(np.array_equal(plan[-1], expected[..., -1]))
+
+        # Joined fields are pasted together from both ROIs
+        rois = [{'height': 20, 'width': 16, 'center': [0, 0], 'size': [1, 1]},
+                {'height': 20, 'width': 16, 'center': [1, 0], 'size': [1, 1]}]
+        filenames = synthetic.write_scan(self.prefix + '_joined', num_frames=20, rois=rois)
+        scan = scanreader.read_scan(self.prefix + '_joined_*.tif', join_contiguous=True)
+        pages = self.read_pages(filenames).reshape(20, 3, 2, scan._page_height,
+                                                   scan._page_width)
+        field = scan.fields[0]
+        expected = np.zeros([field.height, field.width, 2, 20], dtype=np.int16)
+        for yslice, xslice, output_yslice, output_xslice in zip(
+                field.yslices, field.xslices, field.output_yslices, field.output_xslices):
+            expected[output_yslice, output_xslice] = pages[:, field.slice_id, :, yslice,
+                                                           xslice].transpose([2, 3, 1, 0])
+        plan = scan.plan((0, [5, 3, 19], slice(None, None, -1)))
+        self.assertTrue(np.array_equal(plan[:10], expected[[5, 3, 19], ::-1, :, :10]))
+        self.assertTrue(np.array_equal(scan[0, 2:9, ::3], expected[2:9, ::3]))
+        self.assertRaises(IndexError, lambda: scan.plan((0, 0, 0, 0, 0)))
+        self.assertRaises(IndexError, lambda: plan[scan.num_frames])
+
+    def test_field_view(self):
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=10,
+                             height=20, width=16)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        view = scan.field_view(1, channel=1)
+        self.assertFalse(view.flags.writeable)
+        self.assertTrue(np.array_equal(view.transpose([1, 2, 0]), scan[1, :, :, 1]))
+        self.assertTrue(np.array_equal(view[::3].transpose([1, 2, 0]),
+                                       scan[1, :, :, 1, ::3]))
+
+        # Pages in several files cannot be viewed as a single array
+        synthetic.write_scan(self.prefix + '_split', num_frames=10, num_files=2)
+        scan = scanreader.read_scan(self.prefix + '_split_*.tif')
+        self.assertRaises(PageLayoutError, lambda: scan.field_view(0))
+
+    def test_memory_budget(self):
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=20,
+                             height=20, width=16)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        self.assertEqual(scan.nbytes(), scan[:].nbytes)
+        self.assertEqual(scan.nbytes((0, slice(10, 20), 5, 1)), scan[0, 10:20, 5, 1].nbytes)
+
+        max_memory = 16 * scan.nbytes((slice(None), slice(None), slice(None), slice(None), 0))
+        scan = scanreader.read_scan(self.prefix + '_*.tif', max_memory=max_memory)
+        self.assertRaises(MemoryBudgetError, lambda: scan[:])
+        self.assertRaises(MemoryBudgetError, lambda: np.array(scan))
+        self.assertRaises(MemoryBudgetError, lambda: scan.reduce('max', chunk_frames=1000))
+        for field_id, frames, nbytes in scan.map_blocks(_block_nbytes, workers=2):
+            self.assertLessEqual(nbytes, max_memory)
+
+    def test_stats(self):
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=6,
+                             height=20, width=10, num_files=2)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        self.assertIsNone(scan.stats)
+
+        records = []
+        scan.enable_stats(callback=records.append)
+        field = scan[1, :, :, 0]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['kind'], 'getitem')
+        self.assertEqual(records[0]['pages_read'], 6)
+        self.assertEqual(records[0]['bytes_read'], field.nbytes)
+        self.assertEqual(records[0]['file_cache_misses'], 2) # pages are in both files
+
+        scan[0, :, :, :, 2]
+        stats = scan.stats
+        self.assertEqual(stats['num_reads'], 2)
+        self.assertEqual(stats['pages_read'], 8)
+        self.assertEqual(stats['file_cache_hits'], 1)
+        self.assertGreater(stats['stage_seconds']['io'], 0)
+
+        scan.disable_stats()
+        scan[0]
+        self.assertIsNone(scan.stats)
+        self.assertEqual(len(records), 2)
+
+    def test_progress(self):
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=100,
+                             height=20, width=10, num_files=3)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+
+        # Reads report pages done out of total
+        reports = []
+        field = scan.read((1, slice(None), slice(None), 0), progress=lambda *args:
+                          reports.append(args))
+        self.assertTrue(np.array_equal(field, scan[1, :, :, 0]))
+        self.assertEqual(reports[-1], (100, 100, field.nbytes))
+        self.assertEqual([pages_done for pages_done, _, _ in reports],
+                         sorted(pages_done for pages_done, _, _ in reports))
+
+        # So do chunked operations
+        reports = []
+        scan.reduce('mean', chunk_frames=10, workers=2,
+                    progress=lambda *args: reports.append(args))
+        self.assertEqual(reports[-1][:2], (400, 400))
+
+        # Cancelled reads stop
+        token = scanreader.CancelToken()
+        def cancel_at_half(pages_done, total_pages, bytes_done):
+            if pages_done >= total_pages / 2:
+                token.cancel()
+        self.assertRaises(ReadCancelled, lambda: scan.read(0, progress=cancel_at_half,
+                                                           cancel=token))
+        self.assertRaises(ReadCancelled, lambda: scan.reduce('mean', chunk_frames=10,
+                                                             cancel=token))
+
+    def test_unordered_reads(self):
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=12,
+                             height=8, width=6, num_files=3)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        scan_array = scan[:]
+        scan.enable_stats()
+
+        # Reversed, repeated and random frames give the same as indexing the whole scan
+        frames = [11, 3, 3, 0, 7, 3, 11]
+        self.assertTrue(np.array_equal(scan[:, :, :, :, ::-1], scan_array[..., ::-1]))
+        self.assertTrue(np.array_equal(scan[[1, 0, 1], :, :, [1, 1, 0], frames],
+                                       scan_array[[1, 0, 1]][:, :, :, [1, 1, 0]][..., frames]))
+
+        # Each page is read only once
+        pages_read = scan.stats['pages_read']
+        scan[0, :, :, 0, frames]
+        self.assertEqual(scan.stats['pages_read'] - pages_read, 4)
+
+    def test_crops(self):
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=12,
+                             height=20, width=16, num_files=3)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        samples = [(1, 11, 0, 0, 0), (0, 3, 1, 12, 6), (1, -1, -1, 5, 2), (0, 3, 1, 12, 6)]
+        crops = scan.read_crops(samples, (8, 10))
+        self.assertEqual(crops.shape, (4, 8, 10))
+        for crop, (field, frame, channel, y, x) in zip(crops, samples):
+            self.assertTrue(np.array_equal(crop, scan[field, y:y + 8, x:x + 10, channel,
+                                                      frame]))
+        self.assertRaises(IndexError, lambda: scan.read_crops([(0, 0, 0, 13, 0)], (8, 10)))
+        self.assertRaises(IndexError, lambda: scan.read_crops([(0, 12, 0, 0, 0)], (8, 10)))
+
+        # Crops spanning the subfields of joined multiROI fields
+        prefix = path.join(self.tmp_dir.name, 'mroi')
+        synthetic.write_scan(prefix, depths=[0], num_frames=4, rois=[
+            {'height': 10, 'width': 8, 'center': [0, 0], 'size': [1, 1]},
+            {'height': 10, 'width': 8, 'center': [1, 0], 'size': [1, 1]}])
+        mroi_scan = scanreader.read_scan(prefix + '_*.tif', join_contiguous=True)
+        self.assertEqual(mroi_scan.num_fields, 1)
+        crop = mroi_scan.read_crops([(0, 2, 1, 3, 4)], (6, 9))[0]
+        self.assertTrue(np.array_equal(crop, mroi_scan[0, 3:9, 4:13, 1, 2]))
+
+        # Batches are reproducible and split among shards
+        sampler = scanreader.CropSampler([scan, mroi_scan], (6, 8), frames=slice(0, None, 2),
+                                         seed=3)
+        batches = list(sampler.batches(5, num_batches=4))
+        shards = [list(sampler.batches(5, num_batches=4, shard=k, num_shards=2)) for k in
+                  range(2)]
+        for (crops, samples), (crops2, samples2) in zip(batches, [shards[0][0], shards[1][0],
+                                                                  shards[0][1], shards[1][1]]):
+            self.assertTrue(np.array_equal(samples, samples2))
+            self.assertTrue(np.array_equal(crops, crops2))
+        for crops, samples in batches:
+            self.assertTrue(np.all(samples[:, 2] % 2 == 0))
+            for crop, (scan_id, field, frame, channel, y, x) in zip(crops, samples):
+                expected = [scan, mroi_scan][scan_id][field, y:y + 6, x:x + 8, channel, frame]
+                self.assertTrue(np.array_equal(crop, expected))
+
+    def test_catalog(self):
+        import os
+        root = path.join(self.tmp_dir.name, 'data')
+        os.makedirs(path.join(root, 'mouse1'))
+        synthetic.write_scan(path.join(root, 'mouse1', 'scan_00001'), depths=[0, 10],
+                             num_frames=6, height=12, width=8, num_files=3)
+        synthetic.write_scan(path.join(root, 'scan_00002'), version='5.1', num_channels=1,
+                             num_frames=4, height=10, width=10)
+        with open(path.join(root, 'notes_00001.tif'), 'wb') as f:
+            f.write(b'not a tiff file')
+
+        catalog = scanreader.Catalog(path.join(self.tmp_dir.name, 'scans.db'))
+        summary = catalog.update(root, workers=2)
+        pathname = path.join(root, 'mouse1', 'scan_00001_*.tif')
+        self.assertEqual(sorted(summary['added']), [pathname,
+                                                    path.join(root, 'scan_00002_*.tif')])
+        self.assertEqual(list(summary['failed']), [path.join(root, 'notes_*.tif')])
+        self.assertEqual(len(catalog), 2)
+
+        records = catalog.records('num_channels = ? AND num_fields > ?', (2, 1))
+        self.assertEqual([record['pathname'] for record in records], [pathname])
+        self.assertEqual(records[0]['num_frames'], 6)
+        self.assertEqual(records[0]['field_heights'], [12, 12])
+
+        # Opened scans are the same as read_scan's, without reading the files' headers
+        scan = catalog.open(pathname)
+        self.assertIsNotNone(scan._page_indices)
+        self.assertTrue(np.array_equal(scan[:], scanreader.read_scan(pathname)[:]))
+
+        # Only changed scans are indexed again; removed scans are dropped
+        summary = catalog.update(root)
+        self.assertEqual(len(summary['unchanged']), 2)
+        synthetic.write_scan(path.join(root, 'mouse1', 'scan_00001'), depths=[0, 10],
+                             num_frames=9, height=12, width=8, num_files=3, seed=1)
+        os.remove(path.join(root, 'scan_00002_00001.tif'))
+        self.assertRaises(CatalogError, lambda: catalog.open(pathname))
+        summary = catalog.update(root)
+        self.assertEqual(summary['updated'], [pathname])
+        self.assertEqual(summary['removed'], [path.join(root, 'scan_00002_*.tif')])
+        scan = catalog.open(pathname)
+        self.assertEqual(scan.num_frames, 9)
+        self.assertTrue(np.array_equal(scan[:], scanreader.read_scan(pathname)[:]))
+
+        # MultiROI scans reuse the cataloged page indices to create their fields
+        rois = [{'height': 10, 'width': 8}, {'height': 6, 'width': 4}]
+        filenames = synthetic.write_scan(path.join(root, 'scan_00003'), rois=rois,
+                                         depths=[0], num_frames=8, num_files=4)
+        catalog.update(root)
+        pathname = path.join(root, 'scan_00003_*.tif')
+        stat = os.stat(filenames[2])
+        with mock.patch.object(scanreader.pages, 'index_pages',
+                               wraps=scanreader.pages.index_pages) as index_pages:
+            scan = catalog.open(pathname)
+            self.assertEqual(scan.field_heights, [10, 6])
+            self.assertEqual(index_pages.call_count, 0)
+            os.utime(filenames[2], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            self.assertEqual(catalog.update(root)['updated'], [pathname])
+            self.assertEqual([call[0][0] for call in index_pages.call_args_list],
+                             filenames[2:3])
+        catalog.close()
+
+    def test_concatenate(self):
+        prefixes = [path.join(self.tmp_dir.name, 'session_{}'.format(i)) for i in range(3)]
+        for prefix, num_frames, seed in zip(prefixes, [5, 3, 6], [0, 1, 2]):
+            synthetic.write_scan(prefix, depths=[0, 10], num_frames=num_frames, height=8,
+                                 width=6, seed=seed)
+        scans = [scanreader.read_scan(prefix + '_*.tif') for prefix in prefixes]
+        scan = scanreader.concatenate([prefix + '_*.tif' for prefix in prefixes])
+        self.assertEqual(scan.shape, (2, 8, 6, 2, 14))
+        self.assertEqual(list(scan.frame_offsets), [0, 5, 8, 14])
+        self.assertEqual([list(array) for array in scan.locate([4, 5, 13])],
+                         [[0, 1, 2], [4, 0, 5]])
+
+        scan_array = np.concatenate([scan_[:] for scan_ in scans], axis=-1)
+        self.assertTrue(np.array_equal(scan[:], scan_array))
+        self.assertEqual(np.array(scan, dtype=np.float64).dtype, np.float64)
+        frames = [13, 0, 6, 5, 5, 9]
+        self.assertTrue(np.array_equal(scan[1, 2:7, :, 0, frames],
+                                       scan_array[1, 2:7, :, 0][..., frames]))
+        self.assertTrue(np.array_equal(scan[:, :, :, 1, 7], scan_array[:, :, :, 1, 7]))
+        self.assertTrue(np.array_equal(scan[0, :, :, :, ::-2], scan_array[0, ..., ::-2]))
+
+        # The smallest memory budget of the scans applies
+        scans[1].max_memory = scans[1].nbytes((0, slice(None), slice(None), 0, 0)) * 4
+        scan = scanreader.concatenate(scans)
+        self.assertEqual(scan.max_memory, scans[1].max_memory)
+        self.assertTrue(np.array_equal(scan[0, :, :, 0, :4], scan_array[0, :, :, 0, :4]))
+        self.assertRaises(MemoryBudgetError, lambda: scan[0, :, :, 0, :5])
+
+        # Scans with different fields, page order or frame rate cannot be concatenated
+        for i, kwargs in enumerate([{'height': 10, 'width': 6},
+                                    {'height': 8, 'width': 6, 'slow_stack': True},
+                                    {'height': 8, 'width': 6, 'fps': 10}]):
+            prefix = path.join(self.tmp_dir.name, 'other{}'.format(i))
+            synthetic.write_scan(prefix, depths=[0, 10], num_frames=5, **kwargs)
+            self.assertRaises(ScanMismatchError, lambda: scanreader.concatenate(
+                [scans[0], scanreader.read_scan(prefix + '_*.tif')]))
+
+    def test_verify(self):
+        import os
+        filenames = synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10],
+                                         num_frames=10, height=12, width=8, num_files=2)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        scan_array = scan[:]
+        report = scan.verify()
+        self.assertTrue(report['is_ok'])
+        self.assertEqual((report['num_pages'], report['num_frames']), (40, 10))
+
+        # Crash in the middle of the last page
+        with open(filenames[-1], 'r+b') as f:
+            f.truncate(os.path.getsize(filenames[-1]) - 12 * 8)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        self.assertRaises(ValueError, lambda: scan.num_frames)
+        report = scan.verify()
+        self.assertFalse(report['is_ok'])
+        self.assertEqual([file['truncation'] is None for file in report['files']],
+                         [True, False])
+        self.assertEqual((report['num_pages'], report['num_frames'],
+                          report['num_incomplete_pages']), (39, 9, 3))
+
+        scan = scanreader.read_scan(self.prefix + '_*.tif', allow_truncated=True)
+        self.assertEqual(scan.num_frames, 9)
+        self.assertTrue(np.array_equal(scan[:], scan_array[..., :9]))
+
+        # Only the last file can be truncated
+        with open(filenames[0], 'r+b') as f:
+            f.truncate(os.path.getsize(filenames[0]) - 12 * 8)
+        scan = scanreader.read_scan(self.prefix + '_*.tif', allow_truncated=True)
+        self.assertRaises(ValueError, lambda: scan.num_frames)
+        self.assertIn('misaligned', scan.verify()['errors'][0])
+
+        # Every page is checked, not only the first one of each file
+        import struct, tifffile
+        filenames = synthetic.write_scan(self.prefix + '_corrupt', num_channels=2,
+                                         depths=[0], num_frames=2, height=16, width=8)
+        with tifffile.TiffFile(filenames[0]) as tiff_file:
+            tag = tiff_file.pages[1].tags['ImageWidth']
+        with open(filenames[0], 'r+b') as f:
+            f.seek(tag.valueoffset)
+            f.write(struct.pack('<H' if tag.dtype == 3 else '<I', 4))
+        with tifffile.TiffFile(filenames[0]) as tiff_file:
+            self.assertEqual([page.shape for page in tiff_file.pages],
+                             [(16, 8), (16, 4), (16, 8), (16, 8)])
+        report = scanreader.read_scan(filenames).verify()
+        self.assertFalse(report['is_ok'])
+        self.assertEqual(len(report['errors']), 1)
+        self.assertIn('page 1: shape (16, 4)', report['errors'][0])
+
+        # MultiROI scans (which index pages to find their size) too
+        rois = [{'height': 12, 'width': 8}, {'height': 6, 'width': 8}]
+        filenames = synthetic.write_scan(self.prefix + '_mroi', num_frames=4, rois=rois)
+        scan_array = scanreader.read_scan(filenames)[1]
+        with open(filenames[-1], 'r+b') as f:
+            f.truncate(os.path.getsize(filenames[-1]) - 8)
+        scan = scanreader.read_scan(filenames, allow_truncated=True)
+        self.assertEqual(scan.num_frames, 3)
+        self.assertTrue(np.array_equal(scan[1], scan_array[..., :3]))
+
+    def test_calibration(self):
+        import pickle
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=6,
+                             height=12, width=8, channel_offsets=(-30, 25, 7, 0),
+                             num_files=2)
+        scan = scanreader.read_scan(self.prefix + '_*.tif', dtype=np.float32)
+        self.assertEqual(scan.channel_offsets, [-30, 25])
+        raw = scan[:]
+
+        scan.enable_calibration(scale=[1, 0.5], clip=(0, None))
+        expected = (raw - np.array([-30, 25], dtype=np.float32)[:, None]) * [[1], [0.5]]
+        expected = np.clip(expected, 0, None)
+        self.assertTrue(np.allclose(scan[:], expected))
+        self.assertTrue(np.allclose(scan[1, 2:5, ::-2, 1, [4, 0, 4]],
+                                    expected[1, 2:5, ::-2, 1][..., [4, 0, 4]]))
+        crops = scan.read_crops([(0, 3, 1, 2, 2), (1, 5, 0, 0, 0)], (4, 4))
+        self.assertTrue(np.allclose(crops[0], expected[0, 2:6, 2:6, 1, 3]))
+        self.assertTrue(np.allclose(crops[1], expected[1, 0:4, 0:4, 0, 5]))
+        self.assertIsNotNone(pickle.loads(pickle.dumps(scan)).calibration)
+
+        # Integer outputs are rounded and saturated
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        scan.enable_calibration(offsets=[-32768, 0], scale=2)
+        calibrated = scan[:]
+        self.assertEqual(calibrated.dtype, np.int16)
+        self.assertTrue(np.all(calibrated[:, :, :, 0] == 32767))
+        self.assertTrue(np.array_equal(calibrated[:, :, :, 1],
+                                       np.clip(2 * raw[:, :, :, 1], -32768, 32767)))
+
+        scan.disable_calibration()
+        self.assertTrue(np.array_equal(scan[:], raw))
+        self.assertRaises(ValueError, lambda: scan.enable_calibration(offsets=[0]))
+
+    def test_async(self):
+        import asyncio
+        synthetic.write_scan(self.prefix, num_channels=2, depths=[0, 10], num_frames=20,
+                             height=20, width=10, num_files=2)
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+        scan.enable_stats()
+
+        async def read_concurrently():
+            keys = [(0, slice(None), slice(None), 0, 3), (0, slice(None), slice(None), 0,
+                    [5, 1, 5]), (0, slice(None), slice(None), 0, slice(2, 8)), (1, 2)]
+            return keys, await asyncio.gather(*[scan.aread(key) for key in keys])
+        keys, items = asyncio.run(read_concurrently())
+        self.assertEqual(scan.stats['num_reads'], 2) # requests for field 0 were merged
+        for key, item in zip(keys, items):
+            self.assertTrue(np.array_equal(item, scan[key]))
+        items[1][:] = 0 # each request has its own copy
+        self.assertFalse(np.array_equal(items[2], 0))
+
+        # Invalid keys raise as in scan[...]
+        self.assertRaises(IndexError, lambda: asyncio.run(scan.aread((0, 0, 0, 0, 20))))
+
+        async def iterate():
+            return [(frames, blocks) async for frames, blocks in
+                    scan.aiter_chunks(channels=1, chunk_frames=6)]
+        chunks = asyncio.run(iterate())
+        self.assertEqual([frames for frames, _ in chunks],
+                         [slice(0, 6), slice(6, 12), slice(12, 18), slice(18, 20)])
+        for frames, blocks in chunks:
+            self.assertTrue(np.array_equal(np.stack(blocks), scan[:, :, :, 1, frames]))
+
+        # Cancelled requests stop their read
+        async def cancel_read():
+            task = asyncio.ensure_future(scan.aread(slice(None)))
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return task.cancelled()
+        self.assertTrue(asyncio.run(cancel_read()))
+        del scan.async_reader
+
+    def test_async_multiroi(self):
+        import asyncio
+        synthetic.write_scan(self.prefix, num_frames=5, rois=[{'height': 20, 'width': 10},
+                                                              {'height': 12, 'width': 8}])
+        scan = scanreader.read_scan(self.prefix + '_*.tif')
+
+        async def read_concurrently():
+            return await asyncio.gather(scan.aread((1, slice(None), slice(None), 0, 4)),
+                                        scan.aread((1, slice(None), slice(None), 0)))
+        frame, field = asyncio.run(read_concurrently())
+        self.assertTrue(np.array_equal(frame, scan[1, :, :, 0, 4]))
+        self.assertTrue(np.array_equal(field, scan[1, :, :, 0]))